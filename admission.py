@@ -0,0 +1,244 @@
+"""
+Admission control for the provisioning API.
+Before a new provision is queued we check the per-caller token bucket, the broker queue depth and the
+worker capacity. When the backlog cannot be drained in time the request is refused with 429/503 and a
+Retry-After estimated from the worker capacity and the recent task durations, instead of being accepted and
+timing out later.
+"""
+import logging
+import math
+import time
+import uuid
+from functools import wraps
+
+import redis
+from flask import request, jsonify
+
+from celery_config import celery
+from config import Config
+from redis_store import get_redis
+
+logger = logging.getLogger(__name__)
+
+COMPLETIONS_KEY = "provision:completions"
+CAPACITY_KEY = "provision:capacity"
+BUCKET_KEY = "provision:bucket:{caller}"
+SYNC_WAITERS_KEY = "provision:sync_waiters"
+
+# Refill and take one token atomically. Returns {allowed, seconds until the next token}.
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+# Take a sync wait slot when fewer than ARGV[1] are held. Slots are scored by their expiry, so the ones left
+# behind by a killed web worker are dropped instead of leaking.
+SYNC_SLOT_LUA = """
+local limit = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[4])
+redis.call('EXPIRE', KEYS[1], math.ceil(ttl) + 1)
+return 1
+"""
+
+_token_bucket = None
+_sync_slot = None
+
+
+def caller_identity():
+    """Identify the caller by the first forwarded address, falling back to the peer address."""
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.split(',')[0].strip() or request.remote_addr or 'unknown'
+
+
+def take_token(caller):
+    """Take a token from the caller's bucket. Returns (allowed, seconds to wait)."""
+    global _token_bucket
+    if _token_bucket is None:
+        _token_bucket = get_redis().register_script(TOKEN_BUCKET_LUA)
+    allowed, wait = _token_bucket(
+        keys=[BUCKET_KEY.format(caller=caller)],
+        args=[Config.ADMISSION_RATE, Config.ADMISSION_BURST, time.time()]
+    )
+    return bool(int(allowed)), float(wait)
+
+
+def queue_depth():
+    """Number of provisioning tasks waiting in the broker queue."""
+    return get_redis().llen(Config.PROVISION_QUEUE)
+
+
+def worker_capacity():
+    """Total pool concurrency of the running workers, cached in Redis to avoid a broadcast per request."""
+    r = get_redis()
+    cached = r.get(CAPACITY_KEY)
+    if cached is not None:
+        return int(cached)
+
+    inspect = celery.control.inspect(timeout=Config.ADMISSION_INSPECT_TIMEOUT)
+    capacity = sum(provisioning_pools(inspect).values())
+    r.set(CAPACITY_KEY, capacity, ex=Config.ADMISSION_CAPACITY_TTL)
+    return capacity
+
+
+def provisioning_pools(inspect):
+    """{worker: pool processes} of the workers consuming the provisioning queue (not the maintenance ones)."""
+    stats = inspect.stats() or {}
+    queues = inspect.active_queues() or {}
+    return {
+        name: _pool_size(worker.get('pool', {}))
+        for name, worker in stats.items()
+        if any(queue.get('name') == Config.PROVISION_QUEUE for queue in queues.get(name, []))
+    }
+
+
+def _pool_size(pool):
+    # max-concurrency is the size the worker started with; pool_grow/pool_shrink only change the processes
+    if 'processes' in pool:
+        return len(pool['processes'])
+    return pool.get('max-concurrency', 1)
+
+
+def record_completion(task_id, duration):
+    """Record a finished provisioning task so throughput can be estimated. Called by the worker."""
+    now = time.time()
+    try:
+        r = get_redis()
+        pipe = r.pipeline()
+        pipe.zadd(COMPLETIONS_KEY, {f"{task_id}:{duration:.3f}": now})
+        pipe.zremrangebyscore(COMPLETIONS_KEY, 0, now - Config.ADMISSION_THROUGHPUT_WINDOW)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Could not record task completion: %s", e, extra={"task_id": task_id})
+
+
+def mean_duration():
+    """Mean run time of the tasks completed in the throughput window, or None without recent history."""
+    now = time.time()
+    members = get_redis().zrangebyscore(COMPLETIONS_KEY, now - Config.ADMISSION_THROUGHPUT_WINDOW, now)
+    durations = [float(member.rsplit(b':', 1)[1]) for member in members]
+    return sum(durations) / len(durations) if durations else None
+
+
+def throughput(capacity):
+    """Tasks per second the workers can drain: capacity / mean task duration.
+    Completions over the window would measure recent demand instead, and after a quiet period reject nearly
+    everything. Uses the expected task duration while there is no recent history.
+    """
+    return capacity / (mean_duration() or Config.PROVISION_EXPECTED_SECONDS)
+
+
+def check_capacity():
+    """Decide whether the queue can take another provision.
+    Returns None when admitted, otherwise (status_code, retry_after_seconds, reason).
+    """
+    capacity = worker_capacity()
+    if capacity <= 0:
+        return 503, Config.ADMISSION_NO_WORKER_RETRY, "No provisioning workers available"
+
+    depth = queue_depth()
+    rate = throughput(capacity)
+    # The deepest queue we can accept and still finish within the allowed wait.
+    allowed_depth = min(Config.ADMISSION_MAX_QUEUE_DEPTH, Config.ADMISSION_MAX_WAIT * rate)
+    if depth < allowed_depth:
+        return None
+
+    retry_after = (depth - allowed_depth + 1) / rate
+    return 503, retry_after, "Provisioning queue is full"
+
+
+def estimated_completion():
+    """Seconds until a task queued now is expected to finish, or None when it cannot be estimated."""
+    try:
+        capacity = worker_capacity()
+        if capacity <= 0:
+            return None
+        duration = mean_duration() or Config.PROVISION_EXPECTED_SECONDS
+        return queue_depth() * duration / capacity + duration
+    except redis.RedisError:
+        return None
+
+
+def acquire_sync_slot(budget):
+    """Reserve one of the PROVISION_SYNC_MAX_WAITERS in-request waits for up to budget seconds.
+    Every sync wait pins a web worker, so past the cap callers get the async (202) response instead.
+    Returns a token to pass to release_sync_slot, or None when no slot is available.
+    """
+    global _sync_slot
+    if Config.PROVISION_SYNC_MAX_WAITERS <= 0:
+        return None
+    token = uuid.uuid4().hex
+    try:
+        if _sync_slot is None:
+            _sync_slot = get_redis().register_script(SYNC_SLOT_LUA)
+        acquired = _sync_slot(
+            keys=[SYNC_WAITERS_KEY],
+            args=[Config.PROVISION_SYNC_MAX_WAITERS, time.time(), budget + 1, token]
+        )
+    except redis.RedisError as e:
+        logger.warning("Sync wait slots unavailable: %s", e)
+        return None
+    return token if int(acquired) else None
+
+
+def release_sync_slot(token):
+    try:
+        get_redis().zrem(SYNC_WAITERS_KEY, token)
+    except redis.RedisError as e:
+        logger.warning("Could not release sync wait slot: %s", e)
+
+
+def rejected(status, retry_after, reason):
+    response = jsonify({
+        "error": reason,
+        "retry_after": math.ceil(retry_after)
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def admission_control(f):
+    """Decorator that refuses new work with 429/503 and a Retry-After when the provisioning backlog is too deep."""
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not Config.ADMISSION_ENABLED:
+            return f(*args, **kwargs)
+
+        try:
+            allowed, wait = take_token(caller_identity())
+            if not allowed:
+                return rejected(429, wait, "Too many provisioning requests")
+
+            verdict = check_capacity()
+            if verdict is not None:
+                return rejected(*verdict)
+        except redis.RedisError as e:
+            # Fail open: the broker being unreachable is reported by the task dispatch itself.
+            logger.warning("Admission control unavailable: %s", e)
+
+        return f(*args, **kwargs)
+
+    return decorated_function
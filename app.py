@@ -6,19 +6,37 @@ It wil be used by the main site (myisp.com) to generate new vpn clients for mikr
 It will also be accessed with Mikrotik to fetch these certs and install them on behalf of the user
 """
 import os
-from flask import Flask, jsonify, send_file, send_from_directory, request
-import openvpn_api
+from flask import Flask, jsonify, request
+from celery.exceptions import TimeoutError as TaskTimeoutError
 from celery.result import AsyncResult
+from celery.utils import uuid
+from admission import acquire_sync_slot, admission_control, estimated_completion, release_sync_slot
+from bootstrap import bootstrap_path, is_stale, write_bootstrap_bundle
 from config import Config
+from delivery import send_protected_file
+from logging_config import setup_logging
 from main import admin_routs
-from main.vpn import get_vpn_clients
-from security import generate_secret, require_secret
+from pki import validate_tenant
+import profiling
+import store
+from security import generate_secret, require_secret, validate_provision_identity
 from tasks import generate_certificate
 
+setup_logging()
+
 app = Flask(__name__)
 app.config.from_object(Config)
-# Initialize OpenVPN API
-v = openvpn_api.VPN(Config.VPN_HOST, Config.VPN_PORT)
+profiling.init_app(app)
+# OpenVPN management API, connected on first use (safe with gunicorn preload_app)
+_vpn_api = None
+
+
+def get_vpn_api():
+    global _vpn_api
+    if _vpn_api is None:
+        import openvpn_api
+        _vpn_api = openvpn_api.VPN(Config.VPN_HOST, Config.VPN_PORT)
+    return _vpn_api
 
 
 # @app.route('/')
@@ -27,29 +45,80 @@ v = openvpn_api.VPN(Config.VPN_HOST, Config.VPN_PORT)
 #     return jsonify({"status": "unauthorized"}), 401
 
 
+def sync_budget():
+    """Seconds the caller is willing to wait for in-request issuance, 0 for the async path.
+    Requested with ?sync=1 (server budget) or an RFC 7240 "Prefer: wait=<seconds>" header.
+    """
+    budget = 0.0
+    if request.args.get('sync', '').lower() in ('1', 'true', 'yes'):
+        budget = Config.PROVISION_SYNC_BUDGET
+    for preference in request.headers.get('Prefer', '').split(','):
+        name, _, value = preference.strip().partition('=')
+        if name.lower() == 'wait':
+            try:
+                budget = float(value)
+            except ValueError:
+                pass
+    return max(0.0, min(budget, Config.PROVISION_SYNC_BUDGET))
+
+
 @app.route('/mikrotik/openvpn/create_provision/<provision_identity>', methods=["POST"])
+@admission_control
 def mtk_create_new_provision(provision_identity):
     """Create a new openVPN client with given name.
     provision_identity: its just like name instance  (e.g client1,client2,...)
+    tenant (optional, ?tenant= or X-Tenant): reseller whose intermediate CA signs the certificate
+    When the caller asks for the fast path and issuance finishes within the budget, the rendered
+    config is returned inline (201), otherwise the task id is returned for polling (202).
     """
-
-    print(get_vpn_clients())
     # with REQUEST_LATENCY.labels(endpoint='/create_provision').time():
     try:
         # Validate provision identity
-        # validate_provision_identity(provision_identity)
+        validate_provision_identity(provision_identity)
 
-        # Check if client already exists
+        # Claim the identity; fails when it is already pending or issued
         client_conf_path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
-        if os.path.exists(client_conf_path):
+        tenant = request.args.get('tenant') or request.headers.get('X-Tenant')
+        if tenant:
+            validate_tenant(tenant)
+        task_id = uuid()
+        if not store.claim_provision(provision_identity, task_id, tenant):
             # REQUEST_COUNT.labels(method='POST', endpoint='/create_provision', status='400').inc()
             return jsonify({"error": "Client already exists"}), 400
 
         # Start async certificate generation
-        task = generate_certificate.delay(provision_identity)
+        try:
+            task = generate_certificate.apply_async((provision_identity,), {'tenant': tenant}, task_id=task_id)
+        except Exception as e:
+            store.mark_failed(provision_identity, str(e))
+            raise
 
         # Generate and return the secret
-        secret = generate_secret(provision_identity)
+        secret = generate_secret(provision_identity, store.secret_version(provision_identity))
+
+        # Fast path: when issuance is expected to finish within the caller's budget,
+        # wait for it and return the config inline. Only a few workers may wait at once, the rest poll.
+        budget = sync_budget()
+        eta = estimated_completion() if budget else None
+        slot = acquire_sync_slot(budget) if eta is not None and eta <= budget else None
+        if slot is not None:
+            try:
+                result = task.get(timeout=budget, propagate=False)
+            except TaskTimeoutError:
+                result = None
+            finally:
+                release_sync_slot(slot)
+            if isinstance(result, dict) and result.get('status') == 'success' and os.path.exists(client_conf_path):
+                with open(client_conf_path, 'r') as f:
+                    config = f.read()
+                return jsonify({
+                    "status": "success",
+                    "task_id": task.id,
+                    "provision_identity": provision_identity,
+                    "secret": secret,
+                    "config": config,
+                    "ip_address": request.headers.get('X-Forwarded-For', request.remote_addr)
+                }), 201
 
         # REQUEST_COUNT.labels(method='POST', endpoint='/create_provision', status='202').inc()
         return jsonify({
@@ -74,6 +143,16 @@ def get_task_status(task_id):
     # with REQUEST_LATENCY.labels(endpoint='/task_status').time():
     task_result = AsyncResult(task_id)
 
+    # Results expire from (or are flushed with) Redis; the store still knows how the provision ended
+    provision = store.provision_for_task(task_id) if task_result.state == 'PENDING' else None
+    if provision and provision['status'] != store.PENDING:
+        result = {
+            "status": "success" if provision['status'] == store.ISSUED else "error",
+            "message": provision['error'] or provision['status'],
+            "provision_identity": provision['identity']
+        }
+        return jsonify(result), 200 if provision['status'] == store.ISSUED else 400
+
     if task_result.ready():
         if task_result.successful():
             result = task_result.get()
@@ -107,7 +186,23 @@ def mtk_openvpn(provision_identity, secret):
         path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
         if not os.path.exists(path):
             return jsonify({"error": "Configuration not found"}), 404
-        return send_file(path, as_attachment=True)
+        return send_protected_file(path, as_attachment=True)
+    except Exception as e:
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route("/mikrotik/bootstrap/<provision_identity>/<secret>")
+@require_secret
+def mtk_bootstrap(provision_identity, secret):
+    """Returning the RouterOS bootstrap script (certs, OVPN client and hotspot pages) of a given provision_identity"""
+    try:
+        if not os.path.exists(f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"):
+            return jsonify({"error": "Configuration not found"}), 404
+        # Normally pre-rendered at issuance, re-render only when missing or out of date
+        if is_stale(provision_identity):
+            write_bootstrap_bundle(provision_identity)
+        return send_protected_file(bootstrap_path(provision_identity), as_attachment=True,
+                                   download_name=f"{provision_identity}.rsc", mimetype='text/plain')
     except Exception as e:
         return jsonify({"error": "Internal server error"}), 500
 
@@ -121,7 +216,10 @@ def mtk_hostpot_ui(provision_identity, secret, form):
     try:
         if form not in ["login.html", "rlogin.html"]:
             return jsonify({"error": "Form not found"}), 404
-        return send_from_directory(Config.HOTSPOT_TEMPLATE_DIR, form)
+        path = os.path.join(Config.HOTSPOT_TEMPLATE_DIR, form)
+        if not os.path.exists(path):
+            return jsonify({"error": "Form not found"}), 404
+        return send_protected_file(path, mimetype='text/html')
     except Exception as e:
         return jsonify({"error": "Internal server error"}), 500
 
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Provisioning worker autoscaler.
+Every AUTOSCALE_INTERVAL seconds the controller reads the provisioning queue depth, the busy pool processes and
+the mean task run time, and sizes the worker pools so the backlog drains within AUTOSCALE_TARGET_WAIT:
+
+    desired = busy + ceil(queue depth * mean run time / target wait)
+
+clamped to AUTOSCALE_MIN..AUTOSCALE_MAX processes per worker. It grows at once (pool_grow) and shrinks one
+AUTOSCALE_STEP at a time (pool_shrink), only after the pools have been oversized for AUTOSCALE_SCALE_DOWN_DELAY,
+so a lull between waves does not throw away warm processes. Celery's own --autoscale only sees the tasks a
+worker has already reserved, not the broker backlog, which is why this runs outside the workers.
+The inputs, the decision and the resulting concurrency are exported as Prometheus metrics.
+
+    python autoscaler.py
+"""
+import logging
+import math
+import time
+
+from prometheus_client import Counter, Gauge, start_http_server
+
+from admission import CAPACITY_KEY, mean_duration, provisioning_pools, queue_depth
+from celery_config import celery
+from config import Config
+from logging_config import setup_logging
+from redis_store import get_redis
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = Gauge('provision_queue_depth', 'Provisioning tasks waiting in the broker')
+MEAN_DURATION = Gauge('provision_task_mean_seconds', 'Mean provisioning task run time over the throughput window')
+BUSY = Gauge('provision_workers_busy', 'Pool processes running a task')
+CONCURRENCY = Gauge('provision_worker_concurrency', 'Pool processes per worker', ['worker'])
+DESIRED = Gauge('provision_desired_concurrency', 'Total pool processes the controller aims for')
+DRAIN_SECONDS = Gauge('provision_expected_drain_seconds', 'Expected time to drain the queue at the current size')
+SCALE_EVENTS = Counter('provision_scale_events_total', 'Pool resize commands sent', ['direction'])
+SCALE_ERRORS = Counter('provision_scale_errors_total', 'Control loop iterations that failed')
+
+
+def pool_sizes():
+    """({worker: pool processes}, busy processes) of the provisioning workers."""
+    inspect = celery.control.inspect(timeout=Config.ADMISSION_INSPECT_TIMEOUT)
+    sizes = provisioning_pools(inspect)
+    active = inspect.active() or {}
+    busy = sum(len(tasks) for name, tasks in active.items() if name in sizes)
+    return sizes, busy
+
+
+def desired_total(depth, busy, duration, workers):
+    """Total processes needed to drain `depth` tasks within the target wait, within the per-worker bounds."""
+    backlog = math.ceil(depth * duration / Config.AUTOSCALE_TARGET_WAIT) if depth else 0
+    return max(Config.AUTOSCALE_MIN * workers, min(Config.AUTOSCALE_MAX * workers, busy + backlog))
+
+
+def resize(sizes, target_total, shrink):
+    """Spread the target over the workers and send the grow/shrink commands. Returns the commands sent."""
+    per_worker = math.ceil(target_total / len(sizes))
+    commands = 0
+    for name, size in sizes.items():
+        if per_worker > size:
+            celery.control.pool_grow(per_worker - size, destination=[name])
+            SCALE_EVENTS.labels('up').inc()
+            commands += 1
+        elif shrink and per_worker < size:
+            celery.control.pool_shrink(min(Config.AUTOSCALE_STEP, size - per_worker), destination=[name])
+            SCALE_EVENTS.labels('down').inc()
+            commands += 1
+    return commands
+
+
+class Controller:
+    def __init__(self):
+        self.oversized_since = None
+
+    def step(self):
+        sizes, busy = pool_sizes()
+        for name, size in sizes.items():
+            CONCURRENCY.labels(name).set(size)
+        if not sizes:
+            logger.warning("No provisioning workers to scale")
+            return
+
+        depth = queue_depth()
+        duration = mean_duration() or Config.PROVISION_EXPECTED_SECONDS
+        current = sum(sizes.values())
+        target = desired_total(depth, busy, duration, len(sizes))
+
+        QUEUE_DEPTH.set(depth)
+        MEAN_DURATION.set(duration)
+        BUSY.set(busy)
+        DESIRED.set(target)
+        DRAIN_SECONDS.set(depth * duration / current if current else 0)
+
+        now = time.monotonic()
+        if target < current:
+            self.oversized_since = self.oversized_since or now
+            shrink = now - self.oversized_since >= Config.AUTOSCALE_SCALE_DOWN_DELAY
+        else:
+            self.oversized_since = None
+            shrink = False
+
+        if target != current and resize(sizes, target, shrink):
+            # Admission control reads the pool size from this cache
+            get_redis().delete(CAPACITY_KEY)
+            logger.info("Resized provisioning pools", extra={
+                "queue_depth": depth, "busy": busy, "mean_duration": round(duration, 2),
+                "current": current, "desired": target, "workers": len(sizes)
+            })
+            if shrink:
+                self.oversized_since = now
+
+    def run(self):
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                # Broker or Redis outages must not stop the loop
+                SCALE_ERRORS.inc()
+                logger.warning("Autoscaler iteration failed: %s", e)
+            time.sleep(Config.AUTOSCALE_INTERVAL)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    start_http_server(Config.AUTOSCALE_METRICS_PORT)
+    Controller().run()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Client key benchmark.
+Issues throwaway client certificates with openssl for each key algorithm (signed by a throwaway CA of the
+production type) and reports the key + certificate generation latency and the size of the PEM material that
+ends up inline in every .ovpn.
+
+    python bench_keygen.py [--runs N] [--ca-algo rsa|ec] [--algos rsa:2048,ec:prime256v1,ed:ed25519]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+KEY_OPTIONS = {
+    'rsa': lambda param: ['-algorithm', 'RSA', '-pkeyopt', f'rsa_keygen_bits:{param}'],
+    'ec': lambda param: ['-algorithm', 'EC', '-pkeyopt', f'ec_paramgen_curve:{param}'],
+    'ed': lambda param: ['-algorithm', param.upper()]
+}
+DEFAULT_PARAMS = {'rsa': '2048', 'ec': 'prime256v1', 'ed': 'ed25519'}
+
+
+def openssl(*args):
+    subprocess.run(['openssl', *args], check=True, capture_output=True)
+
+
+def gen_key(algo, param, path):
+    openssl('genpkey', *KEY_OPTIONS[algo](param), '-out', path)
+
+
+def build_ca(workdir, algo):
+    key = os.path.join(workdir, 'ca.key')
+    crt = os.path.join(workdir, 'ca.crt')
+    gen_key(algo, DEFAULT_PARAMS[algo], key)
+    openssl('req', '-x509', '-new', '-key', key, '-subj', '/CN=bench-ca', '-days', '3650', '-out', crt)
+    return key, crt
+
+
+def issue(workdir, ca, algo, param, index):
+    """Generate one client key and certificate. Returns (seconds, key bytes, certificate bytes)."""
+    key = os.path.join(workdir, f'client{index}.key')
+    req = os.path.join(workdir, f'client{index}.req')
+    crt = os.path.join(workdir, f'client{index}.crt')
+
+    started = time.perf_counter()
+    gen_key(algo, param, key)
+    openssl('req', '-new', '-key', key, '-subj', f'/CN=client{index}', '-out', req)
+    openssl('x509', '-req', '-in', req, '-CA', ca[1], '-CAkey', ca[0], '-CAcreateserial', '-days', '3650',
+            '-out', crt)
+    elapsed = time.perf_counter() - started
+    return elapsed, os.path.getsize(key), os.path.getsize(crt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare client key algorithms')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--ca-algo', choices=['rsa', 'ec'], default='rsa', help='Key type of the signing CA')
+    parser.add_argument('--algos', default='rsa:2048,ec:prime256v1,ed:ed25519',
+                        help='Comma-separated algo:parameter pairs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        ca = build_ca(workdir, args.ca_algo)
+        print(f"{'algorithm':<18}{'median ms':>10}{'p95 ms':>10}{'key B':>8}{'cert B':>8}{'inline B':>10}")
+        for spec in args.algos.split(','):
+            algo, _, param = spec.partition(':')
+            param = param or DEFAULT_PARAMS[algo]
+            try:
+                results = [issue(workdir, ca, algo, param, i) for i in range(args.runs)]
+            except subprocess.CalledProcessError as e:
+                print(f"{spec:<18}unsupported by this openssl: {e.stderr.decode().strip().splitlines()[-1]}")
+                continue
+
+            latencies = sorted(seconds * 1000 for seconds, _, _ in results)
+            key_size = results[0][1]
+            cert_size = results[0][2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            print(f"{spec:<18}{statistics.median(latencies):>10.1f}{p95:>10.1f}{key_size:>8}{cert_size:>8}"
+                  f"{key_size + cert_size:>10}")
+
+
+if __name__ == '__main__':
+    main()
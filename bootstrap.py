@@ -0,0 +1,122 @@
+"""
+MikroTik bootstrap bundles.
+A bundle is a RouterOS .rsc script that writes the CA, client certificate and key, imports them, creates the
+OVPN client interface and installs the hotspot pages, so a router can onboard with a single fetch.
+Bundles are rendered at issuance time and cached on disk next to the client configs.
+"""
+import datetime
+import os
+import re
+
+from config import Config
+from fileio import atomic_remove, atomic_write
+
+HOTSPOT_FORMS = ["login.html", "rlogin.html"]
+
+
+def bootstrap_path(provision_identity):
+    return f"{Config.VPN_BOOTSTRAP_DIR}/{provision_identity}.rsc"
+
+
+def routeros_escape(value):
+    """Escape a value for use inside a double-quoted RouterOS string."""
+    return (value.replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('$', '\\$')
+            .replace('?', '\\?')
+            .replace('\r', '\\r')
+            .replace('\n', '\\n')
+            .replace('\t', '\\t'))
+
+
+def parse_ovpn(config):
+    """Extract the connection settings and inline PEM blocks from a rendered .ovpn."""
+    blocks = {tag: body.strip() + "\n" for tag, body in re.findall(r'<(ca|cert|key)>\s*(.*?)</\1>', config, re.S)}
+
+    # Only names for the unquoted arguments (protocol, auth, cipher), the host is quoted and escaped
+    remote = re.search(r'^remote\s+(\S+)(?:\s+(\d+))?(?:\s+([\w-]+))?\s*$', config, re.M)
+    proto = re.search(r'^proto\s+([\w-]+)', config, re.M)
+    auth = re.search(r'^auth\s+([\w-]+)', config, re.M)
+    cipher = re.search(r'^cipher\s+([\w-]+)', config, re.M)
+
+    return {
+        "host": remote.group(1) if remote else Config.VPN_HOST,
+        "port": int(remote.group(2)) if remote and remote.group(2) else Config.VPN_PORT,
+        # First remote wins; its protocol overrides the global one. udp4/tcp-client -> udp/tcp
+        "proto": ((remote and remote.group(3)) or (proto and proto.group(1)) or Config.VPN_PROTO)[:3],
+        "auth": (auth.group(1) if auth else "SHA512").lower(),
+        "cipher": (cipher.group(1) if cipher else "AES-256-GCM").lower().replace('aes-', 'aes'),
+        "ca": blocks.get('ca', ''),
+        "cert": blocks.get('cert', ''),
+        "key": blocks.get('key', ''),
+    }
+
+
+def render_bootstrap_script(provision_identity, config, hotspot_files):
+    """Render the RouterOS import script for one provision.
+    :param config: the rendered .ovpn text
+    :param hotspot_files: mapping of hotspot file name to its content
+    """
+    settings = parse_ovpn(config)
+    # Every value in a string literal is escaped, the identity comes from the API caller
+    identity = routeros_escape(provision_identity)
+    name = f"ovpn-{identity}"
+    generated = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    lines = [
+        f"# Bootstrap bundle for {identity}, generated {generated} UTC",
+        f'/file add name="{name}-ca.crt" contents="{routeros_escape(settings["ca"])}"',
+        f'/file add name="{name}.crt" contents="{routeros_escape(settings["cert"])}"',
+        f'/file add name="{name}.key" contents="{routeros_escape(settings["key"])}"',
+        ":delay 2s",
+        f'/certificate remove [find where name="{name}" or name="{name}-ca"]',
+        f'/certificate import file-name="{name}-ca.crt" passphrase="" name="{name}-ca"',
+        f'/certificate import file-name="{name}.crt" passphrase="" name="{name}"',
+        f'/certificate import file-name="{name}.key" passphrase=""',
+        f'/interface ovpn-client remove [find name="{name}"]',
+        f'/interface ovpn-client add name="{name}" connect-to="{routeros_escape(settings["host"])}" '
+        f'port={settings["port"]} protocol={settings["proto"]} mode=ip user="{identity}" certificate="{name}" '
+        f'auth={settings["auth"]} cipher={settings["cipher"]} add-default-route=no',
+    ]
+    for file_name, content in hotspot_files.items():
+        lines.append(f'/file add name="hotspot/{routeros_escape(file_name)}" contents="{routeros_escape(content)}"')
+    lines.append(f'/file remove [find where name="{name}-ca.crt" or name="{name}.crt" or name="{name}.key"]')
+    return "\n".join(lines) + "\n"
+
+
+def read_hotspot_files():
+    files = {}
+    for form in HOTSPOT_FORMS:
+        path = os.path.join(Config.HOTSPOT_TEMPLATE_DIR, form)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                files[form] = f.read()
+    return files
+
+
+def write_bootstrap_bundle(provision_identity):
+    """Render the bundle from the client's .ovpn and store it in the bundle cache. Returns its path."""
+    config_path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
+    with open(config_path, 'r') as f:
+        config = f.read()
+
+    script = render_bootstrap_script(provision_identity, config, read_hotspot_files())
+
+    path = bootstrap_path(provision_identity)
+    atomic_write(path, script)
+    return path
+
+
+def is_stale(provision_identity):
+    """A cached bundle is stale when it is missing or older than the config or hotspot pages it embeds."""
+    path = bootstrap_path(provision_identity)
+    if not os.path.exists(path):
+        return True
+    rendered = os.path.getmtime(path)
+    sources = [f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"]
+    sources += [os.path.join(Config.HOTSPOT_TEMPLATE_DIR, form) for form in HOTSPOT_FORMS]
+    return any(os.path.exists(source) and os.path.getmtime(source) > rendered for source in sources)
+
+
+def delete_bootstrap_bundle(provision_identity):
+    atomic_remove(bootstrap_path(provision_identity))
@@ -1,6 +1,8 @@
 from celery import Celery
 import os
 
+from config import Config
+
 # Docker Redis configuration
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')  # Using Docker service name
 REDIS_PORT = os.getenv('REDIS_PORT', '6379')  # Using standard Redis port
@@ -29,3 +31,42 @@ celery.conf.update(
     broker_connection_retry=True,
     broker_connection_max_retries=10
 )
+
+# Periodic upkeep runs on its own queue so it never waits behind (or delays) provisioning.
+# Served by the celery_beat and celery_maintenance services in docker-compose.yml.
+celery.conf.task_routes = {
+    'tasks.sample_traffic': {'queue': 'maintenance'},
+    'tasks.probe_fleet': {'queue': 'maintenance'},
+    'tasks.plan_renewals': {'queue': 'maintenance'},
+    'tasks.refresh_registry': {'queue': 'maintenance'},
+    'tasks.dispatch_renewals': {'queue': 'maintenance'},
+    # Not provisioning: kept out of the provisioning queue's depth (admission control) and off its workers
+    'tasks.renew_certificate': {'queue': 'maintenance'},
+    'tasks.reconcile_clients': {'queue': 'maintenance'},
+}
+celery.conf.beat_schedule = {
+    'sample-traffic': {
+        'task': 'tasks.sample_traffic',
+        'schedule': Config.ACCOUNTING_INTERVAL,
+    },
+    'probe-fleet': {
+        'task': 'tasks.probe_fleet',
+        'schedule': Config.PROBE_INTERVAL,
+    },
+    'refresh-registry': {
+        'task': 'tasks.refresh_registry',
+        'schedule': Config.REGISTRY_REFRESH_INTERVAL,
+    },
+    'plan-renewals': {
+        'task': 'tasks.plan_renewals',
+        'schedule': 3600,
+    },
+    'dispatch-renewals': {
+        'task': 'tasks.dispatch_renewals',
+        'schedule': 60,
+    },
+    'reconcile-clients': {
+        'task': 'tasks.reconcile_clients',
+        'schedule': Config.RECONCILE_INTERVAL,
+    },
+}
@@ -1,3 +1,4 @@
+import json
 import os
 
 
@@ -6,21 +7,189 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-here')
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY', 'your-jwt-secret-here')
 
+    # Provisioning state store (SQLite, WAL)
+    STATE_DB = os.getenv('STATE_DB', '/var/lib/vpn_provision/state.db')
+    STATE_DB_BUSY_TIMEOUT = float(os.getenv('STATE_DB_BUSY_TIMEOUT', 5))  # Seconds to wait for the write lock
+    # Initial dashboard user, created when the users table is empty
+    ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
+    ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')  # Change this!
+
     # OpenVPN configuration
     VPN_HOST = os.getenv('VPN_HOST', '34.45.7.160')
     VPN_PORT = int(os.getenv('VPN_PORT', 1194))
     VPN_PROTO = os.getenv('VPN_PROTO', 'udp')  # UDP is recommended for better performance
     VPN_CLIENT_DIR = os.getenv('VPN_CLIENT_DIR', '/etc/openvpn/client')
+    VPN_BOOTSTRAP_DIR = os.getenv('VPN_BOOTSTRAP_DIR', '/etc/openvpn/client/bootstrap')
+    EASYRSA_DIR = os.getenv('EASYRSA_DIR', '/etc/openvpn/easy-rsa')
+    VPN_SERVER_CN = os.getenv('VPN_SERVER_CN', 'server')  # The server's own certificate (vpn_setup.sh), never a client
+    # fsync every produced file (and, once per write group, its directory) so renames survive a crash
+    FSYNC_WRITES = os.getenv('FSYNC_WRITES', 'true').lower() == 'true'
+    # Load tests only: issue placeholder configs after FAKE_PKI_DELAY seconds instead of running easyrsa
+    FAKE_PKI = os.getenv('FAKE_PKI', 'false').lower() == 'true'
+    FAKE_PKI_DELAY = float(os.getenv('FAKE_PKI_DELAY', 0.5))
+    # Client key algorithm: rsa, ec (ECDSA) or ed (EdDSA). RouterOS 7 imports EC keys but not Ed25519.
+    VPN_KEY_ALGO = os.getenv('VPN_KEY_ALGO', 'rsa')
+    VPN_KEY_SIZE = int(os.getenv('VPN_KEY_SIZE', 2048))  # RSA only
+    VPN_KEY_CURVE = os.getenv('VPN_KEY_CURVE', 'ed25519' if VPN_KEY_ALGO == 'ed' else 'prime256v1')
+
+    # Per-tenant intermediate CAs (pki.py); the server needs "ca CA_BUNDLE_PATH" and "crl-verify CRL_PATH"
+    CA_SHARDS_DIR = os.getenv('CA_SHARDS_DIR', '/etc/openvpn/ca-shards')
+    CA_SHARDS_AUTO_CREATE = os.getenv('CA_SHARDS_AUTO_CREATE', 'false').lower() == 'true'  # On first issuance
+    CA_SHARD_DAYS = int(os.getenv('CA_SHARD_DAYS', 3650))
+    CA_BUNDLE_PATH = os.getenv('CA_BUNDLE_PATH', '/etc/openvpn/server/ca-bundle.pem')
+    CRL_DIR = os.getenv('CRL_DIR', '/etc/openvpn/server/crl.d')  # One CRL per shard
+    CRL_PATH = os.getenv('CRL_PATH', '/etc/openvpn/crl.pem')  # Every shard's CRL, concatenated
+    VPN_SERVER_CONF = os.getenv('VPN_SERVER_CONF', '/etc/openvpn/server/server.conf')  # Switched to the above by pki.py
+
+    # Static client addressing (server.conf needs "client-config-dir ccd" for the CCD entries)
+    VPN_NETWORK = os.getenv('VPN_NETWORK', '10.8.0.0/24')
+    VPN_CCD_DIR = os.getenv('VPN_CCD_DIR', '/etc/openvpn/server/ccd')
+    VPN_IPAM_STATE = os.getenv('VPN_IPAM_STATE', '/etc/openvpn/server/ipam.json')
+    # .1 is the server and .2 up to VPN_IPAM_FIRST_HOST - 1 OpenVPN's dynamic "ifconfig-pool" (vpn_setup.sh), so
+    # static CCD addresses start above it
+    VPN_IPAM_FIRST_HOST = int(os.getenv('VPN_IPAM_FIRST_HOST', 32))
+    VPN_STATUS_FILE = os.getenv('VPN_STATUS_FILE', '/var/log/openvpn/openvpn-status.log')
+
+    # Several server instances, e.g. one per core:
+    # [{"name": "server1", "port": 1195, "proto": "udp", "network": "10.8.1.0/24"}, ...]
+    # optional per instance: host, status_file, ccd_dir
+    VPN_INSTANCES = json.loads(os.getenv('VPN_INSTANCES', '[]'))
+    VPN_INSTANCE_STRATEGY = os.getenv('VPN_INSTANCE_STRATEGY', 'hash')  # hash, load or random
+
+    # Dashboard registry snapshot, rebuilt on change or after this many seconds
+    REGISTRY_MAX_AGE = int(os.getenv('REGISTRY_MAX_AGE', 30))
+    # Share one snapshot between all workers through Redis, built by the refresh_registry beat task
+    REGISTRY_SHARED = os.getenv('REGISTRY_SHARED', 'true').lower() == 'true'
+    REGISTRY_REFRESH_INTERVAL = int(os.getenv('REGISTRY_REFRESH_INTERVAL', 5))
+    REGISTRY_STALE_AFTER = int(os.getenv('REGISTRY_STALE_AFTER', 120))  # Build locally when the shared one is older
+
+    # Bulk config export
+    EXPORT_MAX_CLIENTS = int(os.getenv('EXPORT_MAX_CLIENTS', 1000))  # Per archive; larger sets continue by cursor
+    EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 64 * 1024))
+
+    # Per-client traffic accounting ring buffers
+    ACCOUNTING_DIR = os.getenv('ACCOUNTING_DIR', '/var/lib/vpn_provision/accounting')
+    ACCOUNTING_INTERVAL = int(os.getenv('ACCOUNTING_INTERVAL', 300))  # Seconds between samples
+    ACCOUNTING_SAMPLES = int(os.getenv('ACCOUNTING_SAMPLES', 288))  # 24h at the default interval
+    ACCOUNTING_SESSIONS = int(os.getenv('ACCOUNTING_SESSIONS', 64))
+
+    # Fleet health prober (runs over the tunnel addresses)
+    PROBE_INTERVAL = int(os.getenv('PROBE_INTERVAL', 120))
+    PROBE_JITTER = float(os.getenv('PROBE_JITTER', 30))  # Probes start at a random offset within this window
+    PROBE_CONCURRENCY = int(os.getenv('PROBE_CONCURRENCY', 500))
+    PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', 3))
+    PROBE_API_PORT = int(os.getenv('PROBE_API_PORT', 8728))
+    PROBE_HOTSPOT_PORT = int(os.getenv('PROBE_HOTSPOT_PORT', 80))
+    PROBE_HOTSPOT_PATH = os.getenv('PROBE_HOTSPOT_PATH', '/login')
+
+    # RouterOS API queries, cached per (client, path) in Redis
+    ROUTEROS_USERNAME = os.getenv('ROUTEROS_USERNAME', 'admin')
+    ROUTEROS_PASSWORD = os.getenv('ROUTEROS_PASSWORD', 'password')
+    ROUTEROS_PORT = int(os.getenv('ROUTEROS_PORT', 8728))
+    ROUTEROS_CACHE_TTL = float(os.getenv('ROUTEROS_CACHE_TTL', 5))  # Seconds a reply is fresh, unless listed below
+    ROUTEROS_CACHE_TTLS = json.loads(os.getenv('ROUTEROS_CACHE_TTLS', json.dumps({
+        '/system/resource': 10,
+        '/system/identity': 3600,
+        '/system/routerboard': 86400,
+        '/system/package': 3600,
+        '/interface': 30,
+        '/ip/address': 300
+    })))
+    ROUTEROS_STALE_TTL = float(os.getenv('ROUTEROS_STALE_TTL', 60))  # Served stale, and refreshed, this long past TTL
+    ROUTEROS_ERROR_TTL = float(os.getenv('ROUTEROS_ERROR_TTL', 5))  # A failed query is not retried within this
+    ROUTEROS_QUERY_TIMEOUT = float(os.getenv('ROUTEROS_QUERY_TIMEOUT', 15))  # Wait for another caller's query
+    # Per socket operation; connect, login and the query together stay within ROUTEROS_QUERY_TIMEOUT, the lifetime
+    # of the lock that keeps other processes from querying the same router
+    ROUTEROS_SOCKET_TIMEOUT = float(os.getenv('ROUTEROS_SOCKET_TIMEOUT', 3))
+
+    # Certificate renewal ahead of expiry
+    RENEWAL_LEAD_DAYS = int(os.getenv('RENEWAL_LEAD_DAYS', 60))  # Renew certificates expiring within this
+    RENEWAL_WINDOW = int(os.getenv('RENEWAL_WINDOW', 14 * 86400))  # Spread one planning run over this many seconds
+    RENEWAL_MAX_PER_HOUR = int(os.getenv('RENEWAL_MAX_PER_HOUR', 120))
+    RENEWAL_DISPATCH_BATCH = int(os.getenv('RENEWAL_DISPATCH_BATCH', 50))
+
+    # PKI / client config reconciler
+    RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', 300))
+    RECONCILE_BATCH = int(os.getenv('RECONCILE_BATCH', 200))  # Clients settled per run; the rest wait for the next
+    RECONCILE_GRACE = int(os.getenv('RECONCILE_GRACE', 900))  # Leave files younger than this (issuance in progress)
+    RECONCILE_STATE = os.getenv('RECONCILE_STATE', '/var/lib/vpn_provision/reconcile.json')
+    # Changes come from the store and the index.txt tails; a full diff of the indexes and directories only this often
+    RECONCILE_FULL_SCAN_INTERVAL = int(os.getenv('RECONCILE_FULL_SCAN_INTERVAL', 86400))
 
     # Hotspot configuration
     HOTSPOT_TEMPLATE_DIR = os.getenv('HOTSPOT_TEMPLATE_DIR', '/var/www/templates')
 
+    # Hand authorised downloads to the front proxy: '' (serve from Flask), 'x-accel' (nginx) or 'x-sendfile'
+    FILE_OFFLOAD = os.getenv('FILE_OFFLOAD', '')
+    USE_X_SENDFILE = FILE_OFFLOAD == 'x-sendfile'
+    # Directory -> nginx internal location used for X-Accel-Redirect
+    X_ACCEL_LOCATIONS = json.loads(os.getenv('X_ACCEL_LOCATIONS', json.dumps({
+        VPN_CLIENT_DIR: '/protected/clients/',
+        VPN_BOOTSTRAP_DIR: '/protected/bootstrap/',
+        HOTSPOT_TEMPLATE_DIR: '/protected/hotspot/',
+    })))
+
+    # Completion webhooks to the main site (webhooks.py); no URL, no events
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or SECRET_KEY
+    WEBHOOK_BATCH = int(os.getenv('WEBHOOK_BATCH', 100))  # Events per callback
+    WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 0.5))
+    WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', 10))
+    WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 15))  # Then parked until "store.py requeue-events"
+    WEBHOOK_BACKOFF_BASE = float(os.getenv('WEBHOOK_BACKOFF_BASE', 1))  # Doubles per attempt, with jitter
+    WEBHOOK_BACKOFF_MAX = float(os.getenv('WEBHOOK_BACKOFF_MAX', 600))
+    WEBHOOK_LEASE = float(os.getenv('WEBHOOK_LEASE', 60))  # A claimed batch is retried if its dispatcher died
+    WEBHOOK_MAX_SKEW = int(os.getenv('WEBHOOK_MAX_SKEW', 300))  # Receivers reject older signatures
+
     # Redis configuration
     REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
     REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', None)
     REDIS_DB = int(os.getenv('REDIS_DB', 0))
+    REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 0.5))
 
     # Celery configuration
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}')
-    CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}')
\ No newline at end of file
+    CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', f'redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}')
+
+    # Admission control for create_provision
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+    PROVISION_QUEUE = os.getenv('PROVISION_QUEUE', 'celery')  # Broker list the provisioning tasks wait in
+    PROVISION_EXPECTED_SECONDS = float(os.getenv('PROVISION_EXPECTED_SECONDS', 5))  # Used until throughput is known
+    ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 5))  # Tokens per second per caller
+    ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', 20))
+    ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv('ADMISSION_MAX_QUEUE_DEPTH', 500))
+    ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 60))  # Longest acceptable queueing time in seconds
+    ADMISSION_THROUGHPUT_WINDOW = int(os.getenv('ADMISSION_THROUGHPUT_WINDOW', 300))
+    ADMISSION_CAPACITY_TTL = int(os.getenv('ADMISSION_CAPACITY_TTL', 30))
+    ADMISSION_INSPECT_TIMEOUT = float(os.getenv('ADMISSION_INSPECT_TIMEOUT', 0.5))
+    ADMISSION_NO_WORKER_RETRY = int(os.getenv('ADMISSION_NO_WORKER_RETRY', 30))
+
+    # Longest time create_provision may wait in-request for issuance before falling back to polling
+    PROVISION_SYNC_BUDGET = float(os.getenv('PROVISION_SYNC_BUDGET', 8))
+    # Web workers that may wait at once across the fleet; keep well below the gunicorn worker count (0 disables)
+    PROVISION_SYNC_MAX_WAITERS = int(os.getenv('PROVISION_SYNC_MAX_WAITERS', 2))
+
+    # Provisioning worker autoscaler (see autoscaler.py); bounds are pool processes per worker
+    AUTOSCALE_MIN = int(os.getenv('AUTOSCALE_MIN', 2))
+    AUTOSCALE_MAX = int(os.getenv('AUTOSCALE_MAX', 16))
+    AUTOSCALE_TARGET_WAIT = float(os.getenv('AUTOSCALE_TARGET_WAIT', 30))  # Seconds to drain the backlog in
+    AUTOSCALE_INTERVAL = float(os.getenv('AUTOSCALE_INTERVAL', 10))
+    AUTOSCALE_SCALE_DOWN_DELAY = float(os.getenv('AUTOSCALE_SCALE_DOWN_DELAY', 300))
+    AUTOSCALE_STEP = int(os.getenv('AUTOSCALE_STEP', 1))  # Processes removed per shrink
+    AUTOSCALE_METRICS_PORT = int(os.getenv('AUTOSCALE_METRICS_PORT', 9108))
+
+    # Sampling profiler (see profiling.py)
+    PROFILE_ENABLED = os.getenv('PROFILE_ENABLED', 'false').lower() == 'true'
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0.01))  # Fraction of requests and tasks
+    PROFILE_TASKS = os.getenv('PROFILE_TASKS', 'tasks.generate_certificate').split(',')
+    PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')  # X-Profile header value that forces a profile
+    PROFILE_DIR = os.getenv('PROFILE_DIR', '/var/lib/vpn_provision/profiles')
+    PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))
+
+    # Logging (see logging_config.py)
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_LEVELS = os.getenv('LOG_LEVELS', '')  # Per module, e.g. "main.vpn=DEBUG,ipam=WARNING"
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Records beyond this are dropped, never waited on
+    LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', 60))
+    LOG_RATE_BURST = int(os.getenv('LOG_RATE_BURST', 5))  # Same warning/error per window
@@ -0,0 +1,45 @@
+"""
+File delivery for authorised downloads.
+With FILE_OFFLOAD set, the app only authorises the request and hands the transfer to the front proxy:
+ - x-accel:    nginx X-Accel-Redirect to an `internal` location (see X_ACCEL_LOCATIONS and domain.sh)
+ - x-sendfile: X-Sendfile header with the absolute path (Apache mod_xsendfile, lighttpd)
+so the bytes are sent zero-copy by the proxy instead of tying up a sync worker per download.
+Without it, or for files outside the mapped directories, Flask streams the file itself.
+"""
+import os
+from urllib.parse import quote
+
+from flask import Response, send_file
+
+from config import Config
+
+
+def accel_location(path):
+    """Internal nginx URI for a file, using the longest matching directory prefix, or None."""
+    path = os.path.realpath(path)
+    for directory in sorted(Config.X_ACCEL_LOCATIONS, key=len, reverse=True):
+        root = os.path.realpath(directory)
+        if path.startswith(root + os.sep):
+            location = Config.X_ACCEL_LOCATIONS[directory].rstrip('/')
+            return f"{location}/{quote(os.path.relpath(path, root))}"
+    return None
+
+
+def send_protected_file(path, download_name=None, as_attachment=False, mimetype=None):
+    """Send a file that the caller has already been authorised for."""
+    download_name = download_name or os.path.basename(path)
+
+    if Config.FILE_OFFLOAD == 'x-accel':
+        location = accel_location(path)
+        if location is not None:
+            response = Response(mimetype=mimetype or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = location
+            if as_attachment:
+                response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+            return response
+
+    if Config.FILE_OFFLOAD == 'x-sendfile':
+        return send_file(os.path.realpath(path), as_attachment=as_attachment, download_name=download_name,
+                         mimetype=mimetype, conditional=False)
+
+    return send_file(path, as_attachment=as_attachment, download_name=download_name, mimetype=mimetype)
@@ -172,6 +172,28 @@ server {
         proxy_set_header X-Forwarded-Proto \$scheme;
     }
 
+    # Internal locations for X-Accel-Redirect (FILE_OFFLOAD=x-accel), only reachable through the app
+    location /protected/clients/ {
+        internal;
+        alias /etc/openvpn/client/;
+        sendfile on;
+        tcp_nopush on;
+    }
+
+    location /protected/bootstrap/ {
+        internal;
+        alias /etc/openvpn/client/bootstrap/;
+        sendfile on;
+        tcp_nopush on;
+    }
+
+    location /protected/hotspot/ {
+        internal;
+        alias /var/www/templates/;
+        sendfile on;
+        tcp_nopush on;
+    }
+
 #    location /flower {
 #        proxy_pass http://localhost:5555;
 #        proxy_set_header Host \$host;
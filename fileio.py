@@ -0,0 +1,125 @@
+"""
+Atomic file writes with group commit.
+Every file the service produces (.ovpn configs, bootstrap bundles, CCD entries, state files, the CRL copy) is
+written to a temporary file in the target directory, flushed, and renamed over the target, so readers see either
+the old or the new file and a crash never leaves a partial one. Making the renames durable takes an fsync of the
+directory; inside `write_group()` those are deferred and done once per directory when the group ends, so a bulk
+run of thousands of files pays one directory fsync instead of one per file.
+
+    with write_group():
+        for name in names:
+            atomic_write(path_for(name), render(name))
+"""
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+from config import Config
+
+_lock = threading.Lock()
+_depth = 0
+_pending_dirs = set()
+_counter = 0
+
+
+def _fsync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _tmp_path(path):
+    global _counter
+    with _lock:
+        _counter += 1
+        counter = _counter
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.{counter}.tmp")
+
+
+def _commit_dir(directory):
+    if not Config.FSYNC_WRITES:
+        return
+    with _lock:
+        if _depth:
+            _pending_dirs.add(directory)
+            return
+    _fsync_dir(directory)
+
+
+def atomic_write(path, data, mode=None):
+    """Replace `path` with `data` (str or bytes) atomically. `mode` sets the permissions of the new file."""
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    tmp_path = _tmp_path(path)
+    try:
+        with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+            f.flush()
+            if Config.FSYNC_WRITES:
+                os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _commit_dir(directory)
+
+
+def atomic_copy(source, path, mode=None):
+    """Copy `source` over `path` atomically, e.g. a regenerated CRL the VPN server is reading."""
+    path = os.path.abspath(path)
+    directory = os.path.dirname(path)
+    tmp_path = _tmp_path(path)
+    try:
+        shutil.copyfile(source, tmp_path)
+        if Config.FSYNC_WRITES:
+            with open(tmp_path, 'rb+') as f:
+                os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _commit_dir(directory)
+
+
+def atomic_remove(path):
+    """Remove `path` if it exists, durably with the current group."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    _commit_dir(os.path.dirname(os.path.abspath(path)))
+    return True
+
+
+@contextmanager
+def write_group():
+    """Defer the directory fsyncs of every write in this process until the outermost group ends."""
+    global _depth
+    with _lock:
+        _depth += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _depth -= 1
+            directories = set(_pending_dirs) if _depth == 0 else set()
+            if _depth == 0:
+                _pending_dirs.clear()
+        for directory in directories:
+            _fsync_dir(directory)
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 
 # Server socket
 bind = "0.0.0.0:8100"
@@ -11,6 +12,10 @@ worker_connections = 1000
 timeout = 30
 keepalive = 2
 
+# Import the app once in the master and fork workers from it, so boots and recycles skip the imports.
+# Everything that opens connections (OpenVPN API, Redis) is created lazily, after the fork.
+preload_app = os.getenv('GUNICORN_PRELOAD_APP', 'true').lower() == 'true'
+
 # Logging
 accesslog = '-'
 errorlog = '-'
@@ -29,4 +34,12 @@ tmp_upload_dir = None
 
 # SSL
 keyfile = None
-certfile = None 
\ No newline at end of file
+certfile = None
+
+
+def on_starting(server):
+    # Record clients issued before the state store existed (idempotent), once per boot in the master
+    import store
+    imported = store.backfill()
+    if imported:
+        server.log.info(f"Imported {imported} existing provisions into the state store")
@@ -1,6 +1,14 @@
+import logging
 import os
 import subprocess
+import time
 from config import Config
+from fileio import atomic_remove, atomic_write
+from instances import apply_remotes
+from ipam import get_allocator
+import pki
+
+logger = logging.getLogger(__name__)
 
 
 # def generate_openvpn_config(provision_identity, output_path):
@@ -129,31 +137,100 @@ from config import Config
 #         raise Exception(f"Failed to generate OpenVPN configuration: {str(e)}")
 
 
-def generate_openvpn_config(provision_identity, output_path, force=False):
-    """Generate OpenVPN client configuration file matching Bash 'new_client' logic."""
-    easyrsa_dir = '/etc/openvpn/easy-rsa'
-    if not os.path.exists(easyrsa_dir):
+def easyrsa_key_args():
+    """easyrsa options selecting the client key algorithm from VPN_KEY_ALGO (rsa, ec or ed)."""
+    algo = Config.VPN_KEY_ALGO
+    if algo == 'rsa':
+        return ['--use-algo=rsa', f'--keysize={Config.VPN_KEY_SIZE}']
+    if algo in ('ec', 'ed'):
+        return [f'--use-algo={algo}', f'--curve={Config.VPN_KEY_CURVE}']
+    raise Exception(f"Unsupported VPN_KEY_ALGO '{algo}' (expected rsa, ec or ed).")
+
+
+def write_fake_client_config(provision_identity, output_path):
+    """FAKE_PKI (load tests only): take FAKE_PKI_DELAY like a real issuance, write a well-formed config with
+    placeholder certificates and allocate an address, without touching easyrsa.
+    """
+    time.sleep(Config.FAKE_PKI_DELAY)
+    placeholder = "-----BEGIN {0}-----\nRkFLRS1QS0k=\n-----END {0}-----\n"
+    atomic_write(output_path, f"""client
+dev tun
+proto udp
+remote 127.0.0.1 1194
+nobind
+persist-key
+persist-tun
+remote-cert-tls server
+verb 3
+<ca>
+{placeholder.format('CERTIFICATE')}</ca>
+<cert>
+{placeholder.format('CERTIFICATE')}</cert>
+<key>
+{placeholder.format('PRIVATE KEY')}</key>
+""")
+    get_allocator().allocate(provision_identity)
+
+
+def generate_openvpn_config(provision_identity, output_path, force=False, tenant=None):
+    """Generate OpenVPN client configuration file matching Bash 'new_client' logic.
+    The certificate is signed by the tenant's intermediate CA when it has one, otherwise by the root CA.
+    """
+    if Config.FAKE_PKI:
+        return write_fake_client_config(provision_identity, output_path)
+
+    if not os.path.exists(Config.EASYRSA_DIR):
         raise Exception("EasyRSA directory not found.")
 
-    client_cert_path = os.path.join(easyrsa_dir, 'pki', 'issued', f'{provision_identity}.crt')
-
-    # Revoke existing certificate if it exists and force is True
-    if os.path.exists(client_cert_path):
-        if force:
-            os.chdir(easyrsa_dir)
-            print(f"[INFO] Revoking existing cert for {provision_identity}...")
-            subprocess.run(['./easyrsa', 'revoke', provision_identity], check=True, cwd=easyrsa_dir)
-            subprocess.run(['./easyrsa', 'gen-crl'], check=True, cwd=easyrsa_dir)
-            os.remove(client_cert_path)
-            key_path = os.path.join(easyrsa_dir, 'pki', 'private', f'{provision_identity}.key')
-            if os.path.exists(key_path):
-                os.remove(key_path)
-        else:
-            raise Exception(f"Client '{provision_identity}' already exists. Use force=True to regenerate.")
-    os.chdir(easyrsa_dir)
-    subprocess.run([
-        './easyrsa', '--batch', '--days=3650', 'build-client-full', provision_identity, 'nopass'
-    ], check=True)
+    shard = pki.shard_for_tenant(tenant)
+    # Issuance in other shards runs in parallel
+    with shard.lock():
+        client_cert_path = shard.path('issued', f'{provision_identity}.crt')
+
+        # Revoke existing certificate if it exists and force is True
+        if os.path.exists(client_cert_path):
+            if force:
+                logger.info("Revoking existing cert", extra={"provision_identity": provision_identity})
+                pki.revoke(shard, provision_identity)
+                atomic_remove(client_cert_path)
+                atomic_remove(shard.path('private', f'{provision_identity}.key'))
+            else:
+                raise Exception(f"Client '{provision_identity}' already exists. Use force=True to regenerate.")
+        shard.easyrsa('--batch', '--days=3650', *easyrsa_key_args(), 'build-client-full', provision_identity, 'nopass')
+
+    write_client_config(provision_identity, output_path, shard.directory)
+
+    # Pin the client's tunnel address (kept across forced re-issues)
+    get_allocator().allocate(provision_identity)
+
+    logger.info("Client config written",
+                extra={"provision_identity": provision_identity, "path": output_path, "ca": shard.name})
+
+
+def renew_openvpn_config(provision_identity, output_path):
+    """Re-issue a client's certificate ahead of expiry and re-render its config.
+    The old certificate stays valid until it expires, so the router keeps working until it fetches the new one.
+    """
+    if Config.FAKE_PKI:
+        return write_fake_client_config(provision_identity, output_path)
+
+    shard = pki.shard_of(provision_identity)
+    with shard.lock():
+        if not os.path.exists(shard.path('issued', f'{provision_identity}.crt')):
+            raise Exception(f"Client '{provision_identity}' has no certificate to renew.")
+        shard.easyrsa('--batch', '--days=3650', *easyrsa_key_args(), 'renew', provision_identity, 'nopass')
+
+    write_client_config(provision_identity, output_path, shard.directory)
+    get_allocator().allocate(provision_identity)
+
+    logger.info("Renewed client config written",
+                extra={"provision_identity": provision_identity, "path": output_path, "ca": shard.name})
+
+
+def write_client_config(provision_identity, output_path, easyrsa_dir):
+    """Compose the .ovpn of an issued client from the PKI (easyrsa_dir of the CA that signed it) and write it
+    to output_path. The <ca> is always the root CA, which signed the server certificate.
+    """
 
     # Read required parts
     def read_file(path):
@@ -163,11 +240,15 @@ def generate_openvpn_config(provision_identity, output_path, force=False):
     def read_cert_body(path):
         return subprocess.check_output(f"sed -ne '/BEGIN CERTIFICATE/,$ p' {path}", shell=True).decode()
 
+    def read_key_body(path):
+        # EC keys may be preceded by an EC PARAMETERS block the client does not need
+        return subprocess.check_output(f"sed -ne '/BEGIN .*PRIVATE KEY/,$ p' {path}", shell=True).decode()
+
     def read_common():
         return read_file("/etc/openvpn/server/client-common.txt")
 
     def read_ca():
-        return read_file("/etc/openvpn/easy-rsa/pki/ca.crt")
+        return read_file(f"{Config.EASYRSA_DIR}/pki/ca.crt")
 
     def read_tls_crypt(path):
         return subprocess.check_output(f"sed -ne '/BEGIN OpenVPN Static key/,$ p' {path}", shell=True).decode()
@@ -175,9 +256,9 @@ def generate_openvpn_config(provision_identity, output_path, force=False):
     # Compose .ovpn file
     ca = read_ca()
     cert = read_cert_body(f"{easyrsa_dir}/pki/issued/{provision_identity}.crt")
-    key = read_file(f"{easyrsa_dir}/pki/private/{provision_identity}.key")
+    key = read_key_body(f"{easyrsa_dir}/pki/private/{provision_identity}.key")
     tls_crypt = read_tls_crypt(f"/etc/openvpn/server/tc.key")
-    common_config = read_common()
+    common_config = apply_remotes(read_common(), provision_identity)
 
     full_config = f"""{common_config}
 <ca>
@@ -190,8 +271,4 @@ def generate_openvpn_config(provision_identity, output_path, force=False):
     {tls_crypt} < / tls - crypt >
 """
 
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    with open(output_path, 'w') as f:
-        f.write(full_config)
-
-    print(f"[SUCCESS] .ovpn config written to {output_path}")
+    atomic_write(output_path, full_config)
@@ -0,0 +1,180 @@
+"""
+OpenVPN server instances.
+A single OpenVPN process is single-threaded, so a host can run several instances (one per core, on different
+ports/protocols, or on other hosts). Each instance has its own tunnel subnet, status file and CCD directory.
+Client configs list every instance as a `remote`, ordered by the configured assignment strategy:
+ - hash:   consistent hashing of the CN, so a client keeps its instance when instances are added
+ - load:   least connected clients first, from the instances' status files
+ - random: all remotes with `remote-random`, letting clients spread themselves
+Without VPN_INSTANCES the single server from Config is used and client-common.txt is left untouched.
+"""
+import bisect
+import hashlib
+import ipaddress
+import re
+
+from config import Config
+from pki import shard_names
+
+RING_REPLICAS = 64
+
+
+class VPNInstance:
+    def __init__(self, name, host, port, proto, network, status_file, ccd_dir):
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.proto = proto
+        self.network = ipaddress.ip_network(network)
+        self.status_file = status_file
+        self.ccd_dir = ccd_dir
+
+    def dynamic_pool(self):
+        """First and last address OpenVPN may hand out dynamically; the static CCD addresses start after it."""
+        return self.network.network_address + 2, self.network.network_address + Config.VPN_IPAM_FIRST_HOST - 1
+
+    def remote(self):
+        return f"remote {self.host} {self.port} {self.proto}"
+
+    def __repr__(self):
+        return f"VPNInstance({self.name}, {self.host}:{self.port}/{self.proto}, {self.network})"
+
+
+def load_instances():
+    """Instances from the VPN_INSTANCES json list, or the single default server."""
+    if not Config.VPN_INSTANCES:
+        return [VPNInstance('server', Config.VPN_HOST, Config.VPN_PORT, Config.VPN_PROTO, Config.VPN_NETWORK,
+                            Config.VPN_STATUS_FILE, Config.VPN_CCD_DIR)]
+
+    instances = []
+    for spec in Config.VPN_INSTANCES:
+        name = spec['name']
+        instances.append(VPNInstance(
+            name,
+            spec.get('host', Config.VPN_HOST),
+            spec['port'],
+            spec.get('proto', Config.VPN_PROTO),
+            spec['network'],
+            spec.get('status_file', f"/var/log/openvpn/{name}-status.log"),
+            spec.get('ccd_dir', f"/etc/openvpn/server/ccd-{name}")
+        ))
+    return instances
+
+
+_instances = None
+
+
+def get_instances():
+    global _instances
+    if _instances is None:
+        _instances = load_instances()
+    return _instances
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+_ring = None
+
+
+def _build_ring(instances):
+    global _ring
+    if _ring is None or _ring[0] is not instances:
+        ring = sorted(((_ring_hash(f"{instance.name}#{replica}"), instance)
+                       for instance in instances for replica in range(RING_REPLICAS)), key=lambda entry: entry[0])
+        _ring = (instances, [key for key, _ in ring], ring)
+    return _ring[1], _ring[2]
+
+
+def hash_order(cn, instances):
+    """Instances in consistent-hash ring order starting from the CN's position."""
+    keys, ring = _build_ring(instances)
+    start = bisect.bisect(keys, _ring_hash(cn)) % len(ring)
+
+    ordered = []
+    for i in range(len(ring)):
+        instance = ring[(start + i) % len(ring)][1]
+        if instance not in ordered:
+            ordered.append(instance)
+            if len(ordered) == len(instances):
+                break
+    return ordered
+
+
+def load_order(instances):
+    """Instances ordered by their current number of connected clients."""
+    from main.status import parse_status_file
+    load = {instance.name: len(parse_status_file(instance.status_file)) for instance in instances}
+    return sorted(instances, key=lambda instance: load[instance.name])
+
+
+def remote_lines(cn):
+    """The `remote` directives for a client, in the order the client should try them."""
+    instances = get_instances()
+    strategy = Config.VPN_INSTANCE_STRATEGY
+    if strategy == 'hash':
+        ordered = hash_order(cn, instances)
+    elif strategy == 'load':
+        ordered = load_order(instances)
+    else:
+        ordered = instances
+
+    lines = [instance.remote() for instance in ordered]
+    if strategy == 'random':
+        lines.append("remote-random")
+    return lines
+
+
+def get_instance(name):
+    """The instance of a name (as tagged on connected clients by the status reader)."""
+    for instance in get_instances():
+        if instance.name == name:
+            return instance
+    raise KeyError(f"No VPN instance '{name}'")
+
+
+def preferred_instance(cn):
+    """The instance a client is expected to be connected to."""
+    instances = get_instances()
+    if Config.VPN_INSTANCE_STRATEGY == 'hash':
+        return hash_order(cn, instances)[0]
+    return instances[0]
+
+
+def apply_remotes(common_config, cn):
+    """Replace the remote lines of client-common.txt with the instance remotes for a client."""
+    if not Config.VPN_INSTANCES:
+        return common_config
+
+    lines = [line for line in common_config.splitlines()
+             if not re.match(r'^\s*(remote|remote-random|proto)(\s|$)', line)]
+    return "\n".join(lines + remote_lines(cn)) + "\n"
+
+
+def render_server_conf(base_conf, instance):
+    """Derive an instance's server.conf from the base one by rewriting its per-instance directives."""
+    overrides = {
+        'port': str(instance.port),
+        'proto': instance.proto,
+        # An explicit pool below the static addresses (ipam.py) instead of the default one over the whole subnet
+        'server': f"{instance.network.network_address} {instance.network.netmask} nopool",
+        'ifconfig-pool': "{} {} {}".format(*instance.dynamic_pool(), instance.network.netmask),
+        'status': instance.status_file,
+        'client-config-dir': instance.ccd_dir,
+        'ifconfig-pool-persist': f"ipp-{instance.name}.txt",
+    }
+    if shard_names():
+        # Clients signed by intermediate CAs: trust every CA and check every shard's CRL
+        overrides['ca'] = Config.CA_BUNDLE_PATH
+        overrides['crl-verify'] = Config.CRL_PATH
+    lines = []
+    for line in base_conf.splitlines():
+        directive = line.split(' ', 1)[0]
+        if directive in overrides:
+            continue
+        if directive == 'explicit-exit-notify' and not instance.proto.startswith('udp'):
+            continue
+        lines.append(line)
+    lines += [f"{directive} {value}" for directive, value in overrides.items()]
+    return "\n".join(lines) + "\n"
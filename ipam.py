@@ -0,0 +1,152 @@
+"""
+Static VPN address allocation.
+Every client CN gets a fixed address in the server subnet at issuance time, backed by a bitmap of host
+offsets. The allocation is pushed to OpenVPN through a client-config-dir (CCD) entry, so a router keeps the
+same tunnel address across reconnects and can be found without parsing the status log.
+Static addresses start at VPN_IPAM_FIRST_HOST, above OpenVPN's dynamic ifconfig-pool.
+With several server instances the same host offset is reserved in every instance subnet, so a client that
+fails over to another instance still gets a predictable address there.
+"""
+import fcntl
+import ipaddress
+import json
+import os
+from contextlib import contextmanager
+
+from config import Config
+from fileio import atomic_remove, atomic_write
+from instances import get_instances
+
+# Maps every byte to 1 unless all of its bits are taken, so bytearray.find() can locate free slots.
+_HAS_FREE_BIT = bytes(0 if b == 0xff else 1 for b in range(256))
+
+
+class IPAllocator:
+    def __init__(self, networks, state_path, first_host=32):
+        """:param networks: list of (network, ccd_dir), the first one is the primary"""
+        self.networks = [(ipaddress.ip_network(network), ccd_dir) for network, ccd_dir in networks]
+        self.network = self.networks[0][0]
+        self.state_path = state_path
+        self.first_host = first_host
+        # Offsets 0 and the broadcast address are never handed out
+        self.size = min(network.num_addresses for network, _ in self.networks) - 1
+
+        self._mtime = None
+        self.bitmap = bytearray((self.size + 7) // 8)
+        self.by_cn = {}
+        self.by_offset = {}
+
+    @contextmanager
+    def _locked(self):
+        """Serialise writers across gunicorn and celery processes."""
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(f"{self.state_path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._reload()
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reload(self):
+        """Re-read the allocation table when another process changed it."""
+        try:
+            mtime = os.stat(self.state_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+
+        allocations = {}
+        if mtime is not None:
+            with open(self.state_path, 'r') as f:
+                allocations = json.load(f)
+
+        self.bitmap = bytearray(len(self.bitmap))
+        self.by_cn = {}
+        self.by_offset = {}
+        for cn, offset in allocations.items():
+            self._mark(cn, offset)
+        self._mtime = mtime
+
+    def _save(self):
+        atomic_write(self.state_path, json.dumps(self.by_cn))
+        self._mtime = os.stat(self.state_path).st_mtime_ns
+
+    def _mark(self, cn, offset):
+        self.bitmap[offset >> 3] |= 1 << (offset & 7)
+        self.by_cn[cn] = offset
+        self.by_offset[offset] = cn
+
+    def _free_offset(self):
+        start = self.first_host >> 3
+        candidates = self.bitmap.translate(_HAS_FREE_BIT)
+        index = candidates.find(1, start)
+        while index != -1:
+            for bit in range(8):
+                offset = (index << 3) + bit
+                if self.first_host <= offset < self.size and not self.bitmap[index] & (1 << bit):
+                    return offset
+            index = candidates.find(1, index + 1)
+        raise Exception(f"No free VPN addresses left in {self.network}")
+
+    def _address(self, offset, network=None):
+        return str((network or self.network).network_address + offset)
+
+    def _write_ccd(self, cn, offset):
+        for network, ccd_dir in self.networks:
+            atomic_write(os.path.join(ccd_dir, cn),
+                         f"ifconfig-push {self._address(offset, network)} {network.netmask}\n")
+
+    def allocate(self, cn):
+        """Return the CN's address, assigning one and writing its CCD entry if it has none yet."""
+        with self._locked():
+            offset = self.by_cn.get(cn)
+            if offset is not None and offset < self.first_host:
+                # Assigned before the dynamic pool was carved out; move it out of the pool
+                del self.by_offset[offset]
+                self.bitmap[offset >> 3] &= ~(1 << (offset & 7))
+                offset = None
+            if offset is None:
+                offset = self._free_offset()
+                self._mark(cn, offset)
+                self._save()
+            self._write_ccd(cn, offset)
+            return self._address(offset)
+
+    def release(self, cn):
+        """Return the CN's address to the pool and remove its CCD entry."""
+        with self._locked():
+            offset = self.by_cn.pop(cn, None)
+            if offset is not None:
+                del self.by_offset[offset]
+                self.bitmap[offset >> 3] &= ~(1 << (offset & 7))
+                self._save()
+            for _, ccd_dir in self.networks:
+                atomic_remove(os.path.join(ccd_dir, cn))
+
+    def ip_for(self, cn, network=None):
+        """Address assigned to a CN in the given (default primary) network, or None."""
+        self._reload()
+        offset = self.by_cn.get(cn)
+        return self._address(offset, network) if offset is not None else None
+
+    def cn_for(self, ip):
+        """CN holding an address in any of the networks, or None."""
+        self._reload()
+        address = ipaddress.ip_address(ip)
+        for network, _ in self.networks:
+            if address in network:
+                return self.by_offset.get(int(address) - int(network.network_address))
+        return None
+
+
+_allocator = None
+
+
+def get_allocator():
+    global _allocator
+    if _allocator is None:
+        networks = [(instance.network, instance.ccd_dir) for instance in get_instances()]
+        _allocator = IPAllocator(networks, Config.VPN_IPAM_STATE, Config.VPN_IPAM_FIRST_HOST)
+    return _allocator
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+MikroTik fleet load test.
+Simulates routers coming online against a running provisioning API. Each router provisions
+(create_provision, retrying on 429/503 as told by Retry-After), polls its task, downloads its .ovpn and fetches
+both hotspot forms, like a real router's bootstrap. Arrivals follow a profile:
+
+    constant    --rate routers per second
+    poisson     random arrivals averaging --rate per second
+    boot-storm  every router within --window seconds (fleet reboot after a power cut)
+    wave        onboarding campaign, arrivals bunched around the middle of --duration
+
+and the report gives latency percentiles, error rate and throughput per endpoint.
+
+Capacity runs use a local stack with the fake PKI, so no real certificates are issued:
+
+    redis-server &
+    FAKE_PKI=true REDIS_HOST=localhost VPN_CLIENT_DIR=/tmp/lt/clients ... celery -A tasks worker &
+    FAKE_PKI=true REDIS_HOST=localhost VPN_CLIENT_DIR=/tmp/lt/clients ... gunicorn -c gunicorn_config.py app:app &
+    python loadtest.py --base-url http://localhost:8100 --routers 2000 --profile boot-storm --window 60
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ENDPOINTS = ['create', 'task', 'config', 'hotspot']
+
+
+def arrival_times(profile, routers, rate, window, duration, rng):
+    """Start offsets in seconds for every router, sorted."""
+    if profile == 'constant':
+        times = [i / rate for i in range(routers)]
+    elif profile == 'poisson':
+        times, now = [], 0.0
+        for _ in range(routers):
+            now += rng.expovariate(rate)
+            times.append(now)
+    elif profile == 'boot-storm':
+        times = [rng.uniform(0, window) for _ in range(routers)]
+    elif profile == 'wave':
+        times = [min(max(rng.gauss(duration / 2, duration / 6), 0), duration) for _ in range(routers)]
+    else:
+        raise ValueError(f"Unknown profile {profile}")
+    return sorted(times)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.statuses = {endpoint: {} for endpoint in ENDPOINTS}
+        self.routers_ok = 0
+        self.routers_failed = 0
+        self.provision_seconds = []
+
+    def record(self, endpoint, started, status):
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            self.statuses[endpoint][status] = self.statuses[endpoint].get(status, 0) + 1
+
+    def router_done(self, ok, provision_seconds=None):
+        with self.lock:
+            if ok:
+                self.routers_ok += 1
+                self.provision_seconds.append(provision_seconds)
+            else:
+                self.routers_failed += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Router:
+    def __init__(self, args, identity, address, stats):
+        self.args = args
+        self.identity = identity
+        self.stats = stats
+        self.session = requests.Session()
+        # Distinct callers, as seen by admission control behind the proxy
+        self.session.headers['X-Forwarded-For'] = address
+
+    def request(self, endpoint, method, path, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.args.base_url}{path}", timeout=self.args.timeout,
+                                            **kwargs)
+        except requests.RequestException as e:
+            self.stats.record(endpoint, started, type(e).__name__)
+            return None
+        self.stats.record(endpoint, started, response.status_code)
+        return response
+
+    def provision(self):
+        """Create the provision, retrying when told to. Returns (response body, status) or (None, None)."""
+        path = f"/mikrotik/openvpn/create_provision/{self.identity}"
+        params = {'sync': '1'} if self.args.sync else None
+        for _ in range(self.args.retries + 1):
+            response = self.request('create', 'POST', path, params=params)
+            if response is None:
+                return None, None
+            if response.status_code in (429, 503):
+                time.sleep(min(float(response.headers.get('Retry-After', 1)), self.args.max_backoff))
+                continue
+            try:
+                return response.json(), response.status_code
+            except ValueError:
+                return None, response.status_code
+        return None, None
+
+    def wait_for_task(self, task_id):
+        deadline = time.monotonic() + self.args.task_timeout
+        while time.monotonic() < deadline:
+            response = self.request('task', 'GET', f"/mikrotik/openvpn/task/{task_id}")
+            if response is None:
+                return False
+            if response.status_code != 202:
+                return response.status_code == 200
+            time.sleep(self.args.poll_interval)
+        return False
+
+    def run(self):
+        try:
+            self.bootstrap()
+        except Exception as e:
+            print(f"{self.identity}: {e}", file=sys.stderr)
+            self.stats.router_done(False)
+
+    def bootstrap(self):
+        started = time.perf_counter()
+        body, status = self.provision()
+        if not body or status not in (201, 202):
+            return self.stats.router_done(False)
+        if status == 202 and not self.wait_for_task(body['task_id']):
+            return self.stats.router_done(False)
+        provisioned = time.perf_counter() - started
+
+        secret = body['secret']
+        ok = True
+        response = self.request('config', 'GET', f"/mikrotik/openvpn/{self.identity}/{secret}")
+        ok = ok and response is not None and response.status_code == 200
+        for form in ('login.html', 'rlogin.html'):
+            response = self.request('hotspot', 'GET', f"/mikrotik/hotspot/{self.identity}/{secret}/{form}")
+            ok = ok and response is not None and response.status_code == 200
+        self.stats.router_done(ok, provisioned)
+
+
+def report(stats, elapsed, as_json):
+    rows = {}
+    for endpoint in ENDPOINTS:
+        latencies = stats.latencies[endpoint]
+        total = len(latencies)
+        errors = sum(count for status, count in stats.statuses[endpoint].items()
+                     if not isinstance(status, int) or status >= 400)
+        rows[endpoint] = {
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2),
+            'error_rate': round(errors / total, 4) if total else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if total else None,
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if total else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if total else None,
+            'max_ms': round(max(latencies) * 1000, 1) if total else None,
+            'statuses': {str(status): count for status, count in sorted(stats.statuses[endpoint].items(), key=str)}
+        }
+    summary = {
+        'elapsed_s': round(elapsed, 1),
+        'routers_ok': stats.routers_ok,
+        'routers_failed': stats.routers_failed,
+        'provision_p50_s': round(statistics.median(stats.provision_seconds), 2) if stats.provision_seconds else None,
+        'provision_p95_s': round(percentile(stats.provision_seconds, 0.95), 2) if stats.provision_seconds else None,
+        'endpoints': rows
+    }
+    if as_json:
+        print(json.dumps(summary, indent=2))
+        return
+
+    print(f"\n{stats.routers_ok} routers provisioned, {stats.routers_failed} failed in {elapsed:.1f}s "
+          f"(provision p50 {summary['provision_p50_s']}s, p95 {summary['provision_p95_s']}s)")
+    print(f"{'endpoint':<10}{'reqs':>8}{'req/s':>9}{'err %':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}  statuses")
+    for endpoint, row in rows.items():
+        if not row['requests']:
+            continue
+        print(f"{endpoint:<10}{row['requests']:>8}{row['throughput_rps']:>9.1f}{row['error_rate'] * 100:>8.2f}"
+              f"{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}  {row['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a MikroTik fleet against the provisioning API')
+    parser.add_argument('--base-url', default='http://localhost:8100')
+    parser.add_argument('--routers', type=int, default=500)
+    parser.add_argument('--profile', choices=['constant', 'poisson', 'boot-storm', 'wave'], default='constant')
+    parser.add_argument('--rate', type=float, default=10.0, help='Routers per second (constant, poisson)')
+    parser.add_argument('--window', type=float, default=30.0, help='Seconds the boot storm is spread over')
+    parser.add_argument('--duration', type=float, default=300.0, help='Length of the onboarding wave')
+    parser.add_argument('--concurrency', type=int, default=200, help='Routers in flight at once')
+    parser.add_argument('--sync', action='store_true', help='Ask for the inline fast path (?sync=1)')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--task-timeout', type=float, default=300.0)
+    parser.add_argument('--retries', type=int, default=5, help='Retries of create on 429/503')
+    parser.add_argument('--max-backoff', type=float, default=30.0)
+    parser.add_argument('--timeout', type=float, default=30.0, help='Per-request timeout')
+    parser.add_argument('--prefix', default=f"lt-{uuid.uuid4().hex[:6]}", help='Identity prefix of this run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    schedule = arrival_times(args.profile, args.routers, args.rate, args.window, args.duration, rng)
+    stats = Stats()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for i, offset in enumerate(schedule):
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            address = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+            pool.submit(Router(args, f"{args.prefix}-{i:05d}", address, stats).run)
+            if i and i % 1000 == 0:
+                print(f"{i} routers started", file=sys.stderr)
+    report(stats, time.monotonic() - started, args.json)
+
+
+if __name__ == '__main__':
+    main()
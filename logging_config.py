@@ -0,0 +1,147 @@
+"""
+Non-blocking structured logging.
+Request and task threads only put records on a bounded in-memory queue; one listener thread per process formats
+them as JSON lines and writes them to stdout. When the queue is full (stdout stalled) records are dropped and
+counted instead of blocking the caller. Repeated warnings and errors with the same message template are limited
+to LOG_RATE_BURST per LOG_RATE_WINDOW seconds; the next record that gets through reports how many were
+suppressed. Levels are set globally with LOG_LEVEL and per module with LOG_LEVELS ("main.vpn=DEBUG,ipam=WARNING").
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from config import Config
+
+# Attributes every LogRecord has; anything else was passed with extra= and goes into the JSON record
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_listener = None
+_handler = None
+_configured_pid = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler that never waits for the listener."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Format the message (and traceback) in the caller, where the arguments are still valid
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                record.dropped = self.dropped
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most LOG_RATE_BURST warnings/errors per message template through every LOG_RATE_WINDOW seconds."""
+
+    def __init__(self):
+        super().__init__()
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            started, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - started >= Config.LOG_RATE_WINDOW:
+                if suppressed:
+                    record.suppressed = suppressed
+                started, count, suppressed = now, 0, 0
+            if count >= Config.LOG_RATE_BURST:
+                self.windows[key] = (started, count, suppressed + 1)
+                return False
+            self.windows[key] = (started, count + 1, suppressed)
+        return True
+
+
+def _module_levels():
+    levels = {}
+    for item in Config.LOG_LEVELS.split(','):
+        name, _, level = item.strip().partition('=')
+        if name and level:
+            levels[name] = level.upper()
+    return levels
+
+
+def _start_listener():
+    """Create this process's queue and listener thread (again after a fork, where threads don't survive)."""
+    global _listener, _handler, _configured_pid
+    log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    _handler = DroppingQueueHandler(log_queue)
+    _handler.addFilter(RateLimitFilter())
+    root.addHandler(_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+    _listener.start()
+    _configured_pid = os.getpid()
+
+
+def _stop_listener():
+    if _listener is not None and _configured_pid == os.getpid():
+        _listener.stop()
+
+
+def setup_logging():
+    """Route all logging of this process through the queue. Safe to call more than once."""
+    if _configured_pid is not None:
+        return
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.setLevel(Config.LOG_LEVEL.upper())
+    for name, level in _module_levels().items():
+        logging.getLogger(name).setLevel(level)
+
+    _start_listener()
+    os.register_at_fork(after_in_child=_start_listener)
+    atexit.register(_stop_listener)
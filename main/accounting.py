@@ -0,0 +1,154 @@
+"""
+Per-client traffic and session accounting.
+The sampler records the byte counters and session changes from the status files into fixed-size ring buffers,
+one pair of files per CN. Each ring is a preallocated array of packed records, so memory and disk use per
+client stay bounded no matter how long the fleet runs, and readers only touch the files of the client they show.
+"""
+import json
+import os
+import struct
+import time
+
+from config import Config
+from fileio import atomic_write, write_group
+from main.status import read_connected_clients
+
+TRAFFIC_RECORD = struct.Struct('<dQQ')  # timestamp, bytes received, bytes sent
+SESSION_RECORD = struct.Struct('<dBdQQ')  # timestamp, event, connected since, bytes received, bytes sent
+HEADER = struct.Struct('<QQ')  # next slot, number of records
+
+SESSION_CONNECT = 1
+SESSION_DISCONNECT = 0
+
+
+class RingBuffer:
+    """Fixed-capacity ring of packed records stored in one file."""
+
+    def __init__(self, path, record, capacity):
+        self.path = path
+        self.record = record
+        self.capacity = capacity
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            atomic_write(self.path, HEADER.pack(0, 0) + bytes(self.record.size * self.capacity))
+        return os.open(self.path, os.O_RDWR)
+
+    def append(self, *values):
+        fd = self._open()
+        try:
+            head, count = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            os.pwrite(fd, self.record.pack(*values), HEADER.size + head * self.record.size)
+            os.pwrite(fd, HEADER.pack((head + 1) % self.capacity, min(count + 1, self.capacity)), 0)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        """All records, oldest first."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        head, count = HEADER.unpack_from(data)
+        records = list(self.record.iter_unpack(data[HEADER.size:HEADER.size + self.record.size * self.capacity]))
+        start = (head - count) % self.capacity
+        return [records[(start + i) % self.capacity] for i in range(count)]
+
+    def last(self):
+        records = self.read()
+        return records[-1] if records else None
+
+
+def traffic_ring(cn):
+    return RingBuffer(os.path.join(Config.ACCOUNTING_DIR, f"{cn}.traffic"), TRAFFIC_RECORD, Config.ACCOUNTING_SAMPLES)
+
+
+def session_ring(cn):
+    return RingBuffer(os.path.join(Config.ACCOUNTING_DIR, f"{cn}.sessions"), SESSION_RECORD,
+                      Config.ACCOUNTING_SESSIONS)
+
+
+def _online_state_path():
+    return os.path.join(Config.ACCOUNTING_DIR, 'online.json')
+
+
+def _load_online():
+    try:
+        with open(_online_state_path(), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_online(online):
+    atomic_write(_online_state_path(), json.dumps(online))
+
+
+def sample():
+    """Record one traffic sample per connected client and the sessions that started or ended since the last run."""
+    with write_group():
+        return _sample()
+
+
+def _sample():
+    now = time.time()
+    connected = read_connected_clients()
+    # CN -> [connected since, bytes received, bytes sent] for the clients online at the previous sample
+    previous = _load_online()
+    online = {}
+
+    for cn, client in connected.items():
+        since = client.get('connected_since', 0.0)
+        received = client.get('bytes_received', 0)
+        sent = client.get('bytes_sent', 0)
+        traffic_ring(cn).append(now, received, sent)
+
+        before = previous.get(cn)
+        if before is None or before[0] != since:
+            if before is not None:
+                # Reconnected between two samples
+                session_ring(cn).append(now, SESSION_DISCONNECT, before[0], before[1], before[2])
+            session_ring(cn).append(now, SESSION_CONNECT, since, received, sent)
+        online[cn] = [since, received, sent]
+
+    for cn, before in previous.items():
+        if cn not in online:
+            session_ring(cn).append(now, SESSION_DISCONNECT, before[0], before[1], before[2])
+
+    _save_online(online)
+    return len(connected)
+
+
+def traffic_series(cn):
+    """Traffic samples of a client with the transfer rate since the previous sample, oldest first."""
+    series = []
+    previous = None
+    for timestamp, received, sent in traffic_ring(cn).read():
+        rx_rate = tx_rate = None
+        if previous is not None and timestamp > previous[0]:
+            elapsed = timestamp - previous[0]
+            # Counters restart with every session
+            rx_delta = received - previous[1] if received >= previous[1] else received
+            tx_delta = sent - previous[2] if sent >= previous[2] else sent
+            rx_rate = rx_delta / elapsed
+            tx_rate = tx_delta / elapsed
+        series.append({
+            'timestamp': timestamp,
+            'bytes_received': received,
+            'bytes_sent': sent,
+            'rx_bps': rx_rate * 8 if rx_rate is not None else None,
+            'tx_bps': tx_rate * 8 if tx_rate is not None else None
+        })
+        previous = (timestamp, received, sent)
+    return series
+
+
+def session_events(cn):
+    """Connect and disconnect events of a client, oldest first."""
+    return [{
+        'timestamp': timestamp,
+        'event': 'connect' if event == SESSION_CONNECT else 'disconnect',
+        'connected_since': since,
+        'bytes_received': received,
+        'bytes_sent': sent
+    } for timestamp, event, since, received, sent in session_ring(cn).read()]
@@ -1,29 +1,31 @@
 # app.py
-import requests
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_file, jsonify, Response, \
+    stream_with_context
 import os
 import subprocess
-import json
 import datetime
-import secrets
+import re
 from functools import wraps
 
-from main.vpn import OpenVPNManager
+import redis
 
-# In-memory user store - replace with database later
-USERS = {
-    "admin": {
-        "password": "admin123",  # Change this!
-        "role": "admin"
-    }
-}
+from bootstrap import delete_bootstrap_bundle
+from config import Config
+from fileio import atomic_remove
+from ipam import get_allocator
+from main.accounting import session_events, traffic_series
+from main.expiry import get_expiry_index, scheduled_renewals
+from main.export import FORMATS, stream_archive
+from main.registry import fleet_health, get_snapshot, refresh_snapshot
+import pki
+import profiling
+import store
 
 # OpenVPN configuration
 OPENVPN_DIR = "/etc/openvpn"
 SERVER_DIR = "/etc/openvpn/server"
 CLIENT_DIR = f"{OPENVPN_DIR}/client"
 CA_DIR = f"{SERVER_DIR}/easy-rsa/pki"
-STATUS_FILE = f"/var/log/openvpn/openvpn-status.log"
 
 
 # Login required decorator
@@ -42,9 +44,102 @@ def init(app: Flask):
     @app.route('/')
     @login_required
     def index():
-        clients = get_client_list()
-        connected = get_connected_clients()
-        return render_template('index.html', clients=clients, connected=connected)
+        # The client cards are fetched page by page from /api/clients
+        return render_template('index.html', counts=get_snapshot().counts)
+
+    @app.route('/api/clients')
+    @login_required
+    def api_clients():
+        """Cursor-paginated client listing.
+        Query: cursor (last name of the previous page), limit, q (name prefix), status (connected/disconnected)
+        """
+        status = request.args.get('status')
+        if status not in (None, '', 'connected', 'disconnected'):
+            return jsonify({"error": "Invalid status filter"}), 400
+        try:
+            limit = int(request.args.get('limit', 50))
+        except ValueError:
+            return jsonify({"error": "Invalid limit"}), 400
+
+        snapshot = get_snapshot()
+        clients, next_cursor = snapshot.page(
+            cursor=request.args.get('cursor'),
+            limit=limit,
+            prefix=request.args.get('q', ''),
+            status=status or None
+        )
+        return jsonify({
+            "clients": clients,
+            "next_cursor": next_cursor,
+            "counts": snapshot.counts,
+            "version": snapshot.version
+        })
+
+    @app.route('/export')
+    @login_required
+    def export_configs():
+        """Stream an archive of client configs.
+        Query: format (zip, tar, tar.gz), names (comma-separated) or q/status as in /api/clients, cursor, limit.
+        X-Export-Next-Cursor names the cursor of the next part when the selection does not fit in one archive.
+        """
+        archive_format = request.args.get('format', 'zip')
+        if archive_format not in FORMATS:
+            return jsonify({"error": "Invalid format"}), 400
+        status = request.args.get('status')
+        if status not in (None, '', 'connected', 'disconnected'):
+            return jsonify({"error": "Invalid status filter"}), 400
+        try:
+            limit = min(int(request.args.get('limit', Config.EXPORT_MAX_CLIENTS)), Config.EXPORT_MAX_CLIENTS)
+        except ValueError:
+            return jsonify({"error": "Invalid limit"}), 400
+
+        snapshot = get_snapshot()
+        cursor = request.args.get('cursor')
+        if request.args.get('names'):
+            requested = sorted(name for name in set(request.args['names'].split(','))
+                               if name in snapshot.clients and (not cursor or name > cursor))
+            names = requested[:limit]
+            next_cursor = names[-1] if len(requested) > limit else None
+        else:
+            names, next_cursor = snapshot.select(
+                cursor=cursor,
+                limit=limit,
+                prefix=request.args.get('q', ''),
+                status=status or None
+            )
+        if not names:
+            return jsonify({"error": "No clients selected"}), 404
+
+        mimetype, extension = FORMATS[archive_format]
+        part = f"-after-{cursor}" if cursor else ''
+        headers = {
+            'Content-Disposition': f'attachment; filename="clients{part}.{extension}"',
+            'X-Export-Count': str(len(names)),
+            # Never buffered by the proxy, so the first bytes leave as soon as they are compressed
+            'X-Accel-Buffering': 'no'
+        }
+        if next_cursor:
+            headers['X-Export-Next-Cursor'] = next_cursor
+        return Response(stream_with_context(stream_archive(names, archive_format)), mimetype=mimetype,
+                        headers=headers)
+
+    @app.route('/api/profiles')
+    @login_required
+    def api_profiles():
+        """Top functions of the recent profiles. Query: kind (route/task), name, sort (cumulative/own), limit."""
+        if session.get('role') != 'admin':
+            return jsonify({"error": "Forbidden"}), 403
+        try:
+            limit = int(request.args.get('limit', 25))
+        except ValueError:
+            return jsonify({"error": "Invalid limit"}), 400
+
+        kind = request.args.get('kind')
+        name = request.args.get('name')
+        summary = profiling.summarize(kind, name, limit=limit, sort=request.args.get('sort', 'cumulative'))
+        summary['dumps'] = [{key: value for key, value in dump.items() if key != 'path'}
+                            for dump in profiling.list_dumps(kind, name)[:limit]]
+        return jsonify(summary)
 
     @app.route('/login', methods=['GET', 'POST'])
     def login():
@@ -52,9 +147,10 @@ def init(app: Flask):
             username = request.form.get('username')
             password = request.form.get('password')
 
-            if username in USERS and USERS[username]['password'] == password:
-                session['username'] = username
-                session['role'] = USERS[username]['role']
+            user = store.verify_user(username, password)
+            if user:
+                session['username'] = user['username']
+                session['role'] = user['role']
                 flash('Login successful', 'success')
                 return redirect(url_for('index'))
             else:
@@ -72,22 +168,74 @@ def init(app: Flask):
     @login_required
     def client_details(client_name):
         # Get client status
-        clients = get_client_list()
-        connected = get_connected_clients()
+        client_data = get_snapshot().client(client_name)
 
-        if client_name not in clients:
+        if client_data is None:
             flash('Client not found', 'danger')
             return redirect(url_for('index'))
 
-        client_data = {
-            'name': client_name,
-            'created': clients[client_name].get('created', 'Unknown'),
-            'connected': client_name in connected,
-            'ip': connected.get(client_name, {}).get('vpn_ip', 'Not connected'),
-            'last_seen': connected.get(client_name, {}).get('last_seen', 'Never')
-        }
+        client_data['health'] = fleet_health([client_name])[0]
+
+        # Most recent traffic samples and sessions, newest first
+        traffic = [dict(sample, time=format_timestamp(sample['timestamp']))
+                   for sample in reversed(traffic_series(client_name)[-12:])]
+        sessions = [dict(event, time=format_timestamp(event['timestamp']))
+                    for event in reversed(session_events(client_name)[-10:])]
 
-        return render_template('client_details.html', client=client_data)
+        return render_template('client_details.html', client=client_data, traffic=traffic, sessions=sessions)
+
+    @app.route('/api/certificates/expiring')
+    @login_required
+    def api_expiring_certificates():
+        """Valid certificates expiring within ?days= (default 30), soonest first, with planned renewals."""
+        try:
+            days = int(request.args.get('days', 30))
+        except ValueError:
+            return jsonify({"error": "Invalid days"}), 400
+
+        try:
+            planned = dict(scheduled_renewals())
+        except redis.RedisError:
+            planned = {}
+        return jsonify({
+            "days": days,
+            "certificates": [{
+                "name": entry['cn'],
+                "serial": entry['serial'],
+                "ca": entry['ca'],
+                "expires": format_timestamp(entry['expires']),
+                "renewal_due": format_timestamp(planned[entry['cn']]) if entry['cn'] in planned else None
+            } for entry in get_expiry_index().expiring_within(days)]
+        })
+
+    @app.route('/api/clients/<client_name>/traffic')
+    @login_required
+    def api_client_traffic(client_name):
+        """Traffic time series and session events of one client, oldest first."""
+        return jsonify({
+            "name": client_name,
+            "traffic": traffic_series(client_name),
+            "sessions": session_events(client_name)
+        })
+
+    @app.route('/api/clients/<client_name>/routeros')
+    @login_required
+    def api_client_routeros(client_name):
+        """Read-only RouterOS query (?path=/system/resource), served from the cache when fresh enough."""
+        from main.vpn import communicate_with_mikrotik
+
+        path = request.args.get('path', '/system/resource')
+        if not re.match(r'^(/[a-z0-9-]+)+$', path):
+            return jsonify({"error": "Invalid path"}), 400
+
+        result = communicate_with_mikrotik(client_name, path)
+        response = jsonify({"name": client_name, "path": path, **result})
+        response.status_code = 502 if 'error' in result else 200
+        if 'age' in result:
+            response.headers['Age'] = str(int(result['age']))
+        if result.get('stale'):
+            response.headers['Warning'] = '110 - "Response is Stale"'
+        return response
 
     @app.route('/create_client', methods=['GET', 'POST'])
     @login_required
@@ -100,16 +248,19 @@ def init(app: Flask):
                 return redirect(url_for('create_client'))
 
             # Check if client already exists
-            if os.path.exists(f"{CLIENT_DIR}/{client_name}.ovpn"):
+            if os.path.exists(f"{CLIENT_DIR}/{client_name}.ovpn") or not store.claim_provision(client_name):
                 flash('Client already exists', 'danger')
                 return redirect(url_for('create_client'))
 
             try:
                 # Create client certificate and config
                 create_client_certificate(client_name)
+                store.mark_issued(client_name)
+                refresh_snapshot()
                 flash(f'Client {client_name} created successfully', 'success')
                 return redirect(url_for('client_details', client_name=client_name))
             except Exception as e:
+                store.mark_failed(client_name, str(e))
                 flash(f'Error creating client: {str(e)}', 'danger')
                 return redirect(url_for('create_client'))
 
@@ -120,6 +271,7 @@ def init(app: Flask):
     def revoke_client(client_name):
         try:
             revoke_client_certificate(client_name)
+            refresh_snapshot()
             flash(f'Client {client_name} revoked successfully', 'success')
         except Exception as e:
             flash(f'Error revoking client: {str(e)}', 'danger')
@@ -131,6 +283,7 @@ def init(app: Flask):
     def delete_client(client_name):
         try:
             delete_client_files(client_name)
+            refresh_snapshot()
             flash(f'Client {client_name} deleted successfully', 'success')
         except Exception as e:
             flash(f'Error deleting client: {str(e)}', 'danger')
@@ -151,55 +304,15 @@ def init(app: Flask):
 
 # Helper functions
 def get_client_list():
-    clients = {}
+    return get_snapshot().clients
 
-    # Check client directory
-    if os.path.exists(CLIENT_DIR):
-        for file in os.listdir(CLIENT_DIR):
-            if file.endswith('.ovpn'):
-                client_name = file.replace('.ovpn', '')
-                stat = os.stat(f"{CLIENT_DIR}/{file}")
-                clients[client_name] = {
-                    'created': datetime.datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-                    'file_size': stat.st_size
-                }
 
-    return clients
+def format_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
 
 def get_connected_clients():
-    connected = {}
-
-    if os.path.exists(STATUS_FILE):
-        try:
-            with open(STATUS_FILE, 'r') as f:
-                lines = f.readlines()
-                client_section = False
-
-                for line in lines:
-                    if line.strip() == "ROUTING TABLE":
-                        client_section = False
-                        continue
-
-                    if client_section and line.strip() and not line.startswith('Common Name'):
-                        parts = line.strip().split(',')
-                        if len(parts) >= 3:
-                            client_name = parts[0]
-                            real_ip = parts[1]
-                            vpn_ip = parts[2].split(':')[0]
-                            connected_since = parts[3] if len(parts) > 3 else 'Unknown'
-                            connected[client_name] = {
-                                'real_ip': real_ip,
-                                'vpn_ip': vpn_ip,
-                                'last_seen': connected_since
-                            }
-
-                    if line.strip() == "CLIENT LIST":
-                        client_section = True
-        except Exception as e:
-            print(f"Error reading VPN status: {e}")
-
-    return connected
+    return get_snapshot().connected
 
 
 def read_file(path):
@@ -244,9 +357,13 @@ echo "</tls-crypt>" >> {output_file}
 
 
 def create_client_certificate(client_name):
+    # Imported on first use so workers don't load the CLI manager on boot
+    from main.vpn import OpenVPNManager
+
     os.makedirs(CLIENT_DIR, exist_ok=True)
     openvpn = OpenVPNManager()
-    openvpn.create_client(client_name)
+    if not openvpn.create_client(client_name):
+        raise RuntimeError(f"Could not create the certificate of '{client_name}'")
 
     # Generate client certificate and key
     # os.chdir("/etc/openvpn/server/easy-rsa/")
@@ -322,25 +439,13 @@ def create_client_certificate(client_name):
 
 
 def revoke_client_certificate(client_name):
-    # Revoke the client certificate
-    subprocess.run([
-        f"{OPENVPN_DIR}/easy-rsa/easyrsa",
-        "revoke",
-        client_name
-    ], check=True)
-
-    # Update CRL
-    subprocess.run([
-        f"{OPENVPN_DIR}/easy-rsa/easyrsa",
-        "gen-crl"
-    ], check=True)
-
-    # Copy CRL to OpenVPN directory
-    subprocess.run([
-        "cp",
-        f"{CA_DIR}/crl.pem",
-        f"{OPENVPN_DIR}/crl.pem"
-    ], check=True)
+    # Revoke the client certificate in the CA that issued it; only that CA's CRL is regenerated and the
+    # combined CRL the server reads is replaced atomically
+    pki.revoke(pki.shard_of(client_name), client_name)
+
+    # Reclaim the client's static VPN address
+    get_allocator().release(client_name)
+    store.mark_revoked(client_name)
 
     # Restart OpenVPN
     subprocess.run(["systemctl", "restart", "openvpn@server"], check=False)
@@ -349,8 +454,9 @@ def revoke_client_certificate(client_name):
 
 def delete_client_files(client_name):
     # Remove client config
-    if os.path.exists(f"{CLIENT_DIR}/{client_name}.ovpn"):
-        os.remove(f"{CLIENT_DIR}/{client_name}.ovpn")
+    atomic_remove(f"{CLIENT_DIR}/{client_name}.ovpn")
+    delete_bootstrap_bundle(client_name)
+    store.mark_deleted(client_name)
 
     # Note: This doesn't remove the certificate from PKI,
     # it should be revoked first using revoke_client_certificate()
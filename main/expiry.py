@@ -0,0 +1,154 @@
+"""
+Certificate expiry index and renewal scheduling.
+Clients are onboarded in waves with ten-year certificates, so whole cohorts expire together. The index reads
+the index.txt of every CA shard into a list sorted by expiry, so "expiring within N days" is one bisect. The planner
+spreads the renewals of that set over RENEWAL_WINDOW at no more than RENEWAL_MAX_PER_HOUR by giving each CN
+a due time in the `renewal:schedule` Redis sorted set; the dispatcher enqueues only what is due, so the CA
+never sees a thundering herd and no long-countdown tasks sit in the broker.
+Only issued clients in the store are planned: the index also holds the server's and the intermediate CAs' own
+certificates, which are not renewed this way.
+"""
+import bisect
+import calendar
+import os
+import time
+
+from config import Config
+from pki import index_paths
+from redis_store import get_redis
+import store
+
+SCHEDULE_KEY = "renewal:schedule"
+
+
+def parse_expiry(value):
+    """Epoch seconds of an index.txt date (YYMMDDHHMMSSZ or YYYYMMDDHHMMSSZ)."""
+    layout = '%y%m%d%H%M%SZ' if len(value) == 13 else '%Y%m%d%H%M%SZ'
+    return calendar.timegm(time.strptime(value, layout))
+
+
+def parse_index_lines(lines):
+    """Entries of easyrsa index.txt lines as dicts (status, expires, revoked, serial, cn)."""
+    entries = []
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 6:
+            continue
+        status, expires, revoked, serial, _, subject = fields[:6]
+        cn = subject.split('/CN=', 1)[1].split('/', 1)[0] if '/CN=' in subject else subject
+        entries.append({
+            'status': status,
+            'expires': parse_expiry(expires),
+            'revoked': revoked,
+            'serial': serial,
+            'cn': cn
+        })
+    return entries
+
+
+def read_index(path):
+    """Entries of an easyrsa index.txt."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return parse_index_lines(f)
+
+
+class ExpiryIndex:
+    """Valid certificates sorted by expiry, newest certificate per CN only."""
+
+    def __init__(self, entries):
+        latest = {}
+        for entry in entries:
+            if entry['status'] != 'V':
+                continue
+            if entry['cn'] not in latest or entry['expires'] > latest[entry['cn']]['expires']:
+                latest[entry['cn']] = entry
+
+        self.by_cn = latest
+        self.entries = sorted(latest.values(), key=lambda entry: entry['expires'])
+        self.keys = [entry['expires'] for entry in self.entries]
+
+    def expiring_within(self, days, now=None):
+        """Certificates expiring within `days` (already expired ones included), soonest first."""
+        now = time.time() if now is None else now
+        return self.entries[:bisect.bisect_right(self.keys, now + days * 86400)]
+
+    def expires(self, cn):
+        entry = self.by_cn.get(cn)
+        return entry['expires'] if entry else None
+
+
+def read_indexes(paths):
+    """Entries of every CA shard's index.txt, each tagged with its shard ('ca')."""
+    entries = []
+    for name, path in paths:
+        for entry in read_index(path):
+            entry['ca'] = name
+            entries.append(entry)
+    return entries
+
+
+_index = None
+_index_mtime = None
+
+
+def get_expiry_index():
+    """Expiry index of the root and intermediate CAs, re-read only when one of their index.txt changes."""
+    global _index, _index_mtime
+    paths = index_paths()
+    mtimes = []
+    for _, path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    mtime = (tuple(paths), tuple(mtimes))
+    if _index is None or mtime != _index_mtime:
+        _index = ExpiryIndex(read_indexes(paths))
+        _index_mtime = mtime
+    return _index
+
+
+def plan_renewals(now=None):
+    """Give every client certificate expiring within RENEWAL_LEAD_DAYS a due time, spread over the renewal window
+    and after anything already planned. Returns the number of newly planned renewals.
+    """
+    now = time.time() if now is None else now
+    r = get_redis()
+    expiring = [entry['cn'] for entry in get_expiry_index().expiring_within(Config.RENEWAL_LEAD_DAYS, now)]
+    issued = store.issued_identities(expiring)
+    candidates = [cn for cn in expiring if cn in issued]
+    if not candidates:
+        return 0
+
+    planned = r.zmscore(SCHEDULE_KEY, candidates)
+    pending = [cn for cn, score in zip(candidates, planned) if score is None]
+    if not pending:
+        return 0
+
+    # Evenly over the window, but never faster than the hourly limit
+    spacing = max(Config.RENEWAL_WINDOW / len(pending), 3600 / Config.RENEWAL_MAX_PER_HOUR)
+    last = r.zrange(SCHEDULE_KEY, -1, -1, withscores=True)
+    start = max(now, last[0][1] + spacing) if last else now
+
+    r.zadd(SCHEDULE_KEY, {cn: start + i * spacing for i, cn in enumerate(pending)}, nx=True)
+    return len(pending)
+
+
+def due_renewals(now=None, limit=None):
+    """Take the renewals that are due off the schedule. Each CN is returned to exactly one caller."""
+    now = time.time() if now is None else now
+    r = get_redis()
+    due = r.zrangebyscore(SCHEDULE_KEY, '-inf', now, start=0, num=limit or Config.RENEWAL_DISPATCH_BATCH)
+    taken = []
+    for cn in due:
+        if r.zrem(SCHEDULE_KEY, cn):
+            taken.append(cn.decode() if isinstance(cn, bytes) else cn)
+    return taken
+
+
+def scheduled_renewals():
+    """(CN, due time) of every planned renewal, soonest first."""
+    return [(cn.decode() if isinstance(cn, bytes) else cn, due)
+            for cn, due in get_redis().zrange(SCHEDULE_KEY, 0, -1, withscores=True)]
@@ -0,0 +1,78 @@
+"""
+Bulk client config export.
+Archives are produced by a generator that writes each .ovpn into the archive and yields the compressed bytes
+as soon as a chunk is ready, so neither the archive nor the file list is ever held in memory or staged on disk.
+Large selections are exported in parts of at most EXPORT_MAX_CLIENTS clients; the response names the cursor of
+the next part, so an interrupted export resumes from the last complete part instead of starting over.
+"""
+import os
+import tarfile
+import zipfile
+
+from config import Config
+
+FORMATS = {
+    'zip': ('application/zip', 'zip'),
+    'tar': ('application/x-tar', 'tar'),
+    'tar.gz': ('application/gzip', 'tar.gz')
+}
+
+
+class ChunkBuffer:
+    """Write-only, non-seekable sink that hands its contents back in chunks."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def config_path(name):
+    return os.path.join(Config.VPN_CLIENT_DIR, f"{name}.ovpn")
+
+
+def _stream(names, buffer, add):
+    """Add every existing config with `add(path, arcname)` and yield the buffered bytes in chunks."""
+    for name in names:
+        try:
+            add(config_path(name), f"{name}.ovpn")
+        except FileNotFoundError:
+            # Deleted since the selection was made
+            continue
+        if buffer.size >= Config.EXPORT_CHUNK_SIZE:
+            yield buffer.drain()
+
+
+def stream_zip(names):
+    buffer = ChunkBuffer()
+    # On a non-seekable sink zipfile writes data descriptors instead of seeking back to patch headers
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        yield from _stream(names, buffer, lambda path, arcname: archive.write(path, arcname))
+    yield buffer.drain()
+
+
+def stream_tar(names, compress=False):
+    buffer = ChunkBuffer()
+    with tarfile.open(fileobj=buffer, mode='w|gz' if compress else 'w|') as archive:
+        yield from _stream(names, buffer, lambda path, arcname: archive.add(path, arcname, recursive=False))
+    yield buffer.drain()
+
+
+def stream_archive(names, archive_format):
+    """Generator of the archive bytes of the given clients' configs."""
+    if archive_format == 'zip':
+        return stream_zip(names)
+    return stream_tar(names, compress=archive_format == 'tar.gz')
@@ -0,0 +1,131 @@
+"""
+Fleet health prober.
+The status log only says a tunnel is up. This checks, for every connected router, that its RouterOS API port
+accepts connections and that the hotspot answers HTTP, over the tunnel address. Probes run concurrently on one
+asyncio loop, bounded by a semaphore, with a per-probe timeout and a random start delay so a large fleet is
+spread over the jitter window instead of probed in one burst.
+Results go to the `fleet:health` Redis hash (CN -> json) where the registry and client pages read them.
+A sweep of a large fleet can outlast PROBE_INTERVAL; a Redis lock skips the runs that would overlap it.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+
+import redis
+
+from config import Config
+from ipam import get_allocator
+from instances import get_instance
+from main.status import read_connected_clients
+from redis_store import get_redis
+
+HEALTH_KEY = "fleet:health"
+LOCK_KEY = "fleet:probe:lock"
+
+
+async def probe_tcp(ip, port, timeout):
+    """Connect time in milliseconds, or None when the port does not answer in time."""
+    started = time.monotonic()
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    elapsed = (time.monotonic() - started) * 1000
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return elapsed
+
+
+async def probe_http(ip, port, path, timeout):
+    """(response time in milliseconds, HTTP status) of a GET, or (None, None) on failure."""
+    started = time.monotonic()
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {ip}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        status = int(status_line.split()[1])
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        return None, None
+    finally:
+        if writer is not None:
+            writer.close()
+    return (time.monotonic() - started) * 1000, status
+
+
+async def probe_router(cn, ip, semaphore):
+    # Spread the probes over the jitter window
+    await asyncio.sleep(random.uniform(0, Config.PROBE_JITTER))
+    async with semaphore:
+        api_ms = await probe_tcp(ip, Config.PROBE_API_PORT, Config.PROBE_TIMEOUT)
+        hotspot_ms, hotspot_status = await probe_http(ip, Config.PROBE_HOTSPOT_PORT, Config.PROBE_HOTSPOT_PATH,
+                                                      Config.PROBE_TIMEOUT)
+    return cn, {
+        'ip': ip,
+        'checked_at': time.time(),
+        'api_ok': api_ms is not None,
+        'api_ms': round(api_ms, 1) if api_ms is not None else None,
+        'hotspot_ok': hotspot_status is not None and hotspot_status < 500,
+        'hotspot_ms': round(hotspot_ms, 1) if hotspot_ms is not None else None,
+        'hotspot_status': hotspot_status,
+        'healthy': api_ms is not None and hotspot_status is not None and hotspot_status < 500
+    }
+
+
+def probe_targets():
+    """(CN, tunnel address) of every connected client."""
+    allocator = get_allocator()
+    targets = []
+    for cn, client in read_connected_clients().items():
+        ip = client.get('vpn_ip') or allocator.ip_for(cn, get_instance(client['instance']).network)
+        if ip:
+            targets.append((cn, ip))
+    return targets
+
+
+async def probe_fleet(targets):
+    semaphore = asyncio.Semaphore(Config.PROBE_CONCURRENCY)
+    return dict(await asyncio.gather(*(probe_router(cn, ip, semaphore) for cn, ip in targets)))
+
+
+def run_probe():
+    """Probe every connected router once and publish the results. Returns the number of healthy routers, or
+    None when the previous sweep is still running.
+    """
+    targets = probe_targets()
+    r = get_redis()
+    # Longest a sweep can take, so a crashed one does not hold the lock for long: the jitter, then the probes in
+    # waves of PROBE_CONCURRENCY, each waiting up to three timeouts (API connect, hotspot connect and answer)
+    waves = max(1, math.ceil(len(targets) / Config.PROBE_CONCURRENCY))
+    lock = r.lock(LOCK_KEY, timeout=Config.PROBE_JITTER + waves * 3 * Config.PROBE_TIMEOUT + 60, blocking=False)
+    if not lock.acquire():
+        return None
+    try:
+        results = asyncio.run(probe_fleet(targets))
+
+        pipe = r.pipeline()
+        pipe.delete(HEALTH_KEY)
+        if results:
+            pipe.hset(HEALTH_KEY, mapping={cn: json.dumps(result) for cn, result in results.items()})
+        pipe.execute()
+        return sum(1 for result in results.values() if result['healthy'])
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            # Expired (and maybe taken by the next sweep) meanwhile
+            pass
+
+
+def get_health(names):
+    """Latest probe result for each of the given CNs (None when not probed)."""
+    if not names:
+        return {}
+    values = get_redis().hmget(HEALTH_KEY, names)
+    return {name: json.loads(value) if value else None for name, value in zip(names, values)}
@@ -0,0 +1,332 @@
+"""
+PKI / client config reconciler.
+Issuance, revocation and deletion touch the index.txt, pki/issued and pki/private of the root and intermediate
+CAs (pki.py) and VPN_CLIENT_DIR in separate steps, so a crash or a failed task leaves them disagreeing: configs
+of revoked clients, valid certificates without a config, keys nobody needs. The reconciler brings them back in
+line incrementally.
+Changes are tracked, not rescanned: the store records every identity whose status changes (store.changes), and
+of each index.txt only the lines appended since the previous run are read. An index.txt rewritten other than by
+appending (a revocation) is re-read and diffed as a whole, and every RECONCILE_FULL_SCAN_INTERVAL the indexes and
+the tracked directories are diffed against the state of the previous scan, to catch changes made behind the
+store's back (easyrsa by hand, a crash between two steps). Dirty CNs are then settled RECONCILE_BATCH at a time;
+whatever is left stays dirty for the next run, so a run's cost follows the amount of change, not the size of the
+fleet.
+
+Per CN, with anything younger than RECONCILE_GRACE left alone (issuance may be in progress):
+ - valid certificate and key but no config, provisioned and not deleted in the store: the config is re-rendered
+ - revoked or expired, or unknown to the CA but known to the store: config, bootstrap bundle, private key,
+   request and address are removed
+The server's and the CAs' own files (pki.infrastructure_names) and files of CNs neither the CA nor the store
+knows are never touched.
+
+    python -m main.reconcile [--dry-run] [--batch N]
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from bootstrap import delete_bootstrap_bundle, write_bootstrap_bundle
+from config import Config
+from fileio import atomic_remove, atomic_write, write_group
+from helper import write_client_config
+from ipam import get_allocator
+from main.expiry import get_expiry_index, parse_index_lines, read_indexes
+import pki
+import store
+
+logger = logging.getLogger(__name__)
+
+
+def _config_path(cn):
+    return os.path.join(Config.VPN_CLIENT_DIR, f"{cn}.ovpn")
+
+
+# Tracked directories: name -> (path, file suffix)
+def _directories(shards):
+    directories = {'configs': (Config.VPN_CLIENT_DIR, '.ovpn')}
+    for shard in shards:
+        directories[f"{shard.name}:issued"] = (shard.path('issued'), '.crt')
+        directories[f"{shard.name}:private"] = (shard.path('private'), '.key')
+    return directories
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def _list_names(path, suffix):
+    names = set()
+    if not os.path.isdir(path):
+        return names
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and not entry.name.startswith('.'):
+                names.add(entry.name[:-len(suffix)])
+    return names
+
+
+def index_states(entries):
+    """CN -> [status, CA shard]: 'V' and its CA when any of its certificates is valid, otherwise the newest entry."""
+    states = {}
+    for entry in entries:
+        state = states.get(entry['cn'])
+        if state is None or state[0] != 'V':
+            states[entry['cn']] = [entry['status'], entry['ca']]
+    return states
+
+
+def _load_state():
+    try:
+        with open(Config.RECONCILE_STATE, 'r') as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        state = {'signatures': {}, 'index': {}, 'names': {}, 'dirty': []}
+    state.setdefault('tails', {})
+    state.setdefault('scanned_at', 0)
+    return state
+
+
+def _save_state(state):
+    atomic_write(Config.RECONCILE_STATE, json.dumps(state))
+
+
+@contextmanager
+def _exclusive():
+    """Only one reconciler at a time; a second one returns immediately."""
+    os.makedirs(os.path.dirname(Config.RECONCILE_STATE), exist_ok=True)
+    with open(f"{Config.RECONCILE_STATE}.lock", 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Bytes before the previous end of an index.txt compared to tell an append from a rewrite
+TAIL_CHECK = 4096
+
+
+def _read_tail(path, tail):
+    """Lines appended to an index.txt since `tail` ([size, digest of the TAIL_CHECK bytes before it]).
+    Returns (lines, new tail), with None for lines when the file was rewritten rather than appended to.
+    """
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if tail is None or size < tail[0]:
+                return None, None
+            f.seek(max(0, tail[0] - TAIL_CHECK))
+            head = f.read(tail[0] - f.tell())
+            appended = f.read(size - tail[0])
+    except FileNotFoundError:
+        return ([], None) if tail is None else (None, None)
+    if hashlib.sha1(head).hexdigest() != tail[1]:
+        return None, None
+    # Up to the last complete line; a partial one is read on the next run
+    appended = appended[:appended.rfind(b'\n') + 1]
+    seen = head + appended
+    return appended.decode().splitlines(), [tail[0] + len(appended), hashlib.sha1(seen[-TAIL_CHECK:]).hexdigest()]
+
+
+def _tail_of(path):
+    """Tail ([size, digest]) of an index.txt as it is now, None when there is none."""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(max(0, size - TAIL_CHECK))
+            return [size, hashlib.sha1(f.read(size - f.tell())).hexdigest()]
+    except FileNotFoundError:
+        return None
+
+
+def _update_index(state, paths, dirty, full):
+    """Bring state['index'] up to date, reading only what was appended unless an index was rewritten."""
+    # A shard added or removed needs a full read too
+    full = full or set(state['tails']) != {name for name, _ in paths}
+    tails = {}
+    appended = []
+    for name, path in paths:
+        if full:
+            break
+        lines, tails[name] = _read_tail(path, state['tails'][name])
+        if lines is None:
+            full = True
+            break
+        for entry in parse_index_lines(lines):
+            entry['ca'] = name
+            appended.append(entry)
+
+    if full:
+        states = index_states(read_indexes(paths))
+        previous = state['index']
+        dirty.update(cn for cn in states.keys() | previous.keys() if states.get(cn) != previous.get(cn))
+        state['index'] = states
+        state['tails'] = {name: _tail_of(path) for name, path in paths}
+        return
+
+    for cn, cn_state in index_states(appended).items():
+        previous = state['index'].get(cn)
+        # Valid when any of its certificates is (index_states)
+        if previous and previous[0] == 'V' and cn_state[0] != 'V':
+            continue
+        if cn_state != previous:
+            state['index'][cn] = cn_state
+            dirty.add(cn)
+    state['tails'] = tails
+
+
+def collect_changes(state, now):
+    """Add the CNs that changed since the last run to the dirty set. Returns (dirty, store changes taken)."""
+    dirty = set(state['dirty'])
+    changes = store.pending_changes()
+    dirty.update(changes)
+
+    full_scan = now - state['scanned_at'] >= Config.RECONCILE_FULL_SCAN_INTERVAL
+    _update_index(state, pki.index_paths(), dirty, full_scan)
+    if full_scan:
+        _scan_directories(state, dirty)
+        state['scanned_at'] = now
+
+    state['dirty'] = sorted(dirty)
+    return dirty, changes
+
+
+def _scan_directories(state, dirty):
+    """Diff the tracked directories whose signature changed against their listing of the previous scan."""
+    signatures = state['signatures']
+    for name, (path, suffix) in _directories(pki.all_shards()).items():
+        signature = _signature(path)
+        if signature == signatures.get(name):
+            continue
+        names = _list_names(path, suffix)
+        previous = set(state['names'].get(name, []))
+        dirty.update(names ^ previous)
+        state['names'][name] = sorted(names)
+        signatures[name] = signature
+
+
+def _young(path, now):
+    try:
+        return now - os.path.getmtime(path) < Config.RECONCILE_GRACE
+    except FileNotFoundError:
+        return False
+
+
+def settle(cn, state, now, dry_run=False):
+    """Repair or clean up one CN. Returns the action taken, 'wait' to retry later, or None when consistent."""
+    status, ca = state or (None, pki.ROOT)
+    shard = pki.get_shard(ca)
+    config_path = _config_path(cn)
+    cert_path = shard.path('issued', f"{cn}.crt")
+    key_path = shard.path('private', f"{cn}.key")
+    has_config = os.path.exists(config_path)
+
+    if cn in pki.infrastructure_names():
+        return None
+    if any(_young(path, now) for path in (config_path, cert_path, key_path)):
+        return 'wait'
+
+    if status == 'V':
+        if has_config or not (os.path.exists(cert_path) and os.path.exists(key_path)):
+            return None
+        provision = store.get_provision(cn)
+        # Only clients the store knows about (backfill imports the older ones) get a config
+        if provision is None or provision['status'] == store.DELETED:
+            return None
+        pending = provision and provision['status'] == store.PENDING
+        if pending and now - provision['updated_at'] < Config.RECONCILE_GRACE:
+            return 'wait'
+        if not dry_run:
+            write_client_config(cn, config_path, shard.directory)
+            write_bootstrap_bundle(cn)
+            get_allocator().allocate(cn)
+            certificate = get_expiry_index().by_cn.get(cn)
+            store.mark_issued(cn, certificate['serial'] if certificate else None,
+                              certificate['expires'] if certificate else None)
+        return 'repaired'
+
+    # Revoked, expired or never issued by this CA
+    leftovers = [path for path in (config_path, key_path, shard.path('reqs', f"{cn}.req")) if os.path.exists(path)]
+    if not leftovers:
+        return None
+    provision = store.get_provision(cn)
+    if status is None:
+        # Files the CA database says nothing about are only removed for clients the store knows
+        if provision is None:
+            return None
+        if provision['status'] == store.PENDING and now - provision['updated_at'] < Config.RECONCILE_GRACE:
+            return 'wait'
+    if not dry_run:
+        for path in leftovers:
+            atomic_remove(path)
+        delete_bootstrap_bundle(cn)
+        get_allocator().release(cn)
+        if provision and provision['status'] == store.ISSUED:
+            store.mark_revoked(cn)
+    return 'removed'
+
+
+def reconcile(batch=None, dry_run=False):
+    """One incremental pass. Returns the counts of each action and the number of CNs still dirty."""
+    if Config.FAKE_PKI:
+        # No CA to reconcile against
+        return {'skipped': 'fake pki'}
+
+    with _exclusive() as acquired:
+        if not acquired:
+            return {'skipped': 'already running'}
+
+        state = _load_state()
+        now = time.time()
+        dirty, changes = collect_changes(state, now)
+        counts = {'repaired': 0, 'removed': 0, 'wait': 0, 'consistent': 0}
+        budget = batch or Config.RECONCILE_BATCH
+
+        with write_group():
+            for cn in sorted(dirty):
+                if budget <= 0:
+                    break
+                try:
+                    action = settle(cn, state['index'].get(cn), now, dry_run)
+                except Exception as e:
+                    logger.error("Could not reconcile client: %s", e, extra={"client": cn})
+                    action = 'wait'
+                if action == 'wait':
+                    # Stays dirty; only a stat or two, so it does not use up the batch
+                    counts['wait'] += 1
+                    continue
+                budget -= 1
+                counts[action or 'consistent'] += 1
+                if action:
+                    logger.info("Reconciled client", extra={"client": cn, "action": action, "dry_run": dry_run})
+                if not dry_run or action is None:
+                    dirty.discard(cn)
+
+            if not dry_run:
+                state['dirty'] = sorted(dirty)
+                _save_state(state)
+                # Only once they are in the saved dirty set
+                store.clear_changes(changes)
+        counts['dirty'] = len(dirty)
+        return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconcile the PKI with the client configs')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would change without touching files')
+    parser.add_argument('--batch', type=int, help='Clients to settle in this run')
+    args = parser.parse_args()
+    print(json.dumps(reconcile(args.batch, args.dry_run)))
@@ -0,0 +1,209 @@
+"""
+Client registry snapshot.
+Reading the client directory and the status files for every dashboard request does not scale to thousands of
+routers, so both are read into one snapshot with sorted name indexes and precomputed counts. The snapshot is
+rebuilt only when the client directory or a status file changes (or it gets older than REGISTRY_MAX_AGE),
+and pages are served from it with cursor pagination and prefix search. Pages carry the latest prober health.
+With REGISTRY_SHARED, one refresher (the `refresh_registry` beat task) builds the snapshot and publishes it to
+Redis with a version stamp. Workers check the version with one HGET per request and only download the snapshot
+when it changed, so every worker serves the same view and none of them parses the sources. Without a recent
+published snapshot (Redis down, refresher stopped) workers fall back to building their own.
+"""
+import bisect
+import datetime
+import json
+import os
+import time
+import zlib
+
+import redis
+
+from config import Config
+from instances import get_instances
+from main.prober import get_health
+from main.status import read_connected_clients
+from redis_store import get_redis
+
+MAX_PAGE_SIZE = 500
+SNAPSHOT_KEY = "registry:snapshot"
+
+
+def read_client_list():
+    """Issued clients with a config in the client directory, keyed by name."""
+    clients = {}
+    if not os.path.exists(Config.VPN_CLIENT_DIR):
+        return clients
+
+    with os.scandir(Config.VPN_CLIENT_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.ovpn') and entry.is_file():
+                stat = entry.stat()
+                clients[entry.name[:-len('.ovpn')]] = {
+                    'created': datetime.datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
+                    'file_size': stat.st_size
+                }
+    return clients
+
+
+class ClientSnapshot:
+    def __init__(self, clients, connected, built_at=None, version=None):
+        self.clients = clients
+        self.connected = connected
+        self.built_at = time.time() if built_at is None else built_at
+        self.version = version
+
+        self.names = sorted(clients)
+        self.connected_names = [name for name in self.names if name in connected]
+        self.disconnected_names = [name for name in self.names if name not in connected]
+        self.counts = {
+            'total': len(self.names),
+            'connected': len(self.connected_names),
+            'disconnected': len(self.disconnected_names)
+        }
+
+    def client(self, name):
+        """Registry entry of one client merged with its connection state."""
+        if name not in self.clients:
+            return None
+        connection = self.connected.get(name, {})
+        return {
+            'name': name,
+            'created': self.clients[name].get('created', 'Unknown'),
+            'file_size': self.clients[name].get('file_size', 0),
+            'connected': name in self.connected,
+            'ip': connection.get('vpn_ip'),
+            'real_ip': connection.get('real_ip'),
+            'last_seen': connection.get('last_seen'),
+            'instance': connection.get('instance')
+        }
+
+    def select(self, cursor=None, limit=50, prefix='', status=None):
+        """Up to `limit` names after `cursor` (a name), filtered by name prefix and connection status.
+        Returns (names, next_cursor); next_cursor is None on the last page.
+        """
+        names = {'connected': self.connected_names, 'disconnected': self.disconnected_names}.get(status, self.names)
+        limit = max(1, limit)
+
+        start = bisect.bisect_left(names, prefix)
+        if cursor:
+            start = max(start, bisect.bisect_right(names, cursor))
+
+        selected = []
+        for name in names[start:start + limit + 1]:
+            if not name.startswith(prefix):
+                break
+            selected.append(name)
+
+        next_cursor = selected[limit - 1] if len(selected) > limit else None
+        return selected[:limit], next_cursor
+
+    def page(self, cursor=None, limit=50, prefix='', status=None):
+        """One page of client entries with their prober health. Returns (clients, next_cursor)."""
+        names, next_cursor = self.select(cursor, min(limit, MAX_PAGE_SIZE), prefix, status)
+        clients = [self.client(name) for name in names]
+        for client, health in zip(clients, fleet_health(names)):
+            client['health'] = health
+        return clients, next_cursor
+
+
+def fleet_health(names):
+    """Prober results for the given names, in order; empty when the health store is unreachable."""
+    try:
+        health = get_health(names)
+    except redis.RedisError:
+        health = {}
+    return [health.get(name) for name in names]
+
+
+_snapshot = None
+_signature = None
+
+
+def _source_signature():
+    """Modification times of everything the snapshot is built from."""
+    paths = [Config.VPN_CLIENT_DIR] + [instance.status_file for instance in get_instances()]
+    signature = []
+    for path in paths:
+        try:
+            signature.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def local_snapshot():
+    """Snapshot built by this process, rebuilt only when its sources changed."""
+    global _snapshot, _signature
+    signature = _source_signature()
+    if _snapshot is None or signature != _signature or time.time() - _snapshot.built_at > Config.REGISTRY_MAX_AGE:
+        _snapshot = ClientSnapshot(read_client_list(), read_connected_clients())
+        _signature = signature
+    return _snapshot
+
+
+_shared = None
+
+
+def shared_snapshot():
+    """Latest published snapshot, downloaded only when its version changed. None when there is no recent one."""
+    global _shared
+    r = get_redis()
+    version = r.hget(SNAPSHOT_KEY, 'version')
+    if version is None:
+        return None
+    if _shared is None or _shared.version != int(version):
+        version, data = r.hmget(SNAPSHOT_KEY, ['version', 'data'])
+        if data is None:
+            return None
+        payload = json.loads(zlib.decompress(data))
+        _shared = ClientSnapshot(payload['clients'], payload['connected'], payload['built_at'], int(version))
+    if time.time() - _shared.built_at > Config.REGISTRY_STALE_AFTER:
+        return None
+    return _shared
+
+
+def get_snapshot():
+    """Current snapshot: the shared one when enabled and fresh, otherwise this process's own."""
+    if Config.REGISTRY_SHARED:
+        try:
+            snapshot = shared_snapshot()
+        except redis.RedisError:
+            snapshot = None
+        if snapshot is not None:
+            return snapshot
+    return local_snapshot()
+
+
+def publish_snapshot(force=False):
+    """Build the snapshot and publish it to every worker when its sources changed (or it reached
+    REGISTRY_MAX_AGE). Returns the new version, or None when the published snapshot is still current.
+    """
+    r = get_redis()
+    signature = json.dumps(_source_signature())
+    if not force:
+        published_signature, built_at = r.hmget(SNAPSHOT_KEY, ['signature', 'built_at'])
+        if (published_signature is not None and published_signature.decode() == signature
+                and time.time() - float(built_at) < Config.REGISTRY_MAX_AGE):
+            return None
+
+    snapshot = ClientSnapshot(read_client_list(), read_connected_clients())
+    data = zlib.compress(json.dumps({
+        'clients': snapshot.clients,
+        'connected': snapshot.connected,
+        'built_at': snapshot.built_at
+    }).encode())
+
+    pipe = r.pipeline()
+    pipe.hset(SNAPSHOT_KEY, mapping={'data': data, 'signature': signature, 'built_at': snapshot.built_at})
+    pipe.hincrby(SNAPSHOT_KEY, 'version', 1)
+    return pipe.execute()[-1]
+
+
+def refresh_snapshot():
+    """Publish the registry right after a change made through the dashboard, when sharing is enabled."""
+    if not Config.REGISTRY_SHARED:
+        return
+    try:
+        publish_snapshot(force=True)
+    except redis.RedisError:
+        pass
@@ -0,0 +1,199 @@
+"""
+Read-through cache for RouterOS queries.
+Routers run the API on weak CPUs, and the dashboard and the main site often ask the same router for the same
+data at once. Replies are cached in Redis per (CN, command path) for the path's TTL (ROUTEROS_CACHE_TTLS,
+ROUTEROS_CACHE_TTL otherwise), so every web worker and Celery process shares them, and concurrent identical
+queries are coalesced: within a process callers wait on the one in flight, across processes a Redis lock lets
+one caller query the router while the others wait for its reply.
+For ROUTEROS_STALE_TTL past its TTL a reply is still served, marked stale with its age, while one caller
+refreshes it in the background; a failed refresh keeps serving the stale reply. Failures without a reply to
+fall back on are cached for ROUTEROS_ERROR_TTL, so an unreachable router is not retried by every caller.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+
+import redis
+
+from config import Config
+from redis_store import get_redis
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "routeros:cache:"
+LOCK_PREFIX = "routeros:lock:"
+
+# Delete the lock only while it still holds our token: once it expired another caller may hold it.
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_lock = None
+
+# key -> _Flight of the query this process is running
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+def ttl_for(path):
+    return Config.ROUTEROS_CACHE_TTLS.get(path, Config.ROUTEROS_CACHE_TTL)
+
+
+def _cache_key(cn, path):
+    return f"{cn}:{path}"
+
+
+def _read(key):
+    raw = get_redis().get(CACHE_PREFIX + key)
+    return json.loads(raw) if raw else None
+
+
+def _write(key, entry, ttl):
+    get_redis().set(CACHE_PREFIX + key, json.dumps(entry), px=int(ttl * 1000))
+
+
+def _live(fetch):
+    """Query the router. Returns a cache entry (data or error)."""
+    try:
+        return {'data': fetch(), 'fetched_at': time.time()}
+    except Exception as e:
+        return {'error': f"Failed to communicate with router: {e}", 'fetched_at': time.time()}
+
+
+def _release(key, token):
+    global _release_lock
+    if _release_lock is None:
+        _release_lock = get_redis().register_script(RELEASE_LOCK_LUA)
+    _release_lock(keys=[LOCK_PREFIX + key], args=[token])
+
+
+def _fetch_and_store(key, path, fetch, token):
+    """Query the router while holding the lock, cache the reply and release the lock."""
+    try:
+        entry = _live(fetch)
+        if 'error' not in entry:
+            _write(key, entry, ttl_for(path) + Config.ROUTEROS_STALE_TTL)
+        else:
+            previous = _read(key)
+            if previous and 'error' not in previous:
+                # Keep serving the stale reply rather than the failure
+                return previous
+            _write(key, entry, Config.ROUTEROS_ERROR_TTL)
+        return entry
+    finally:
+        _release(key, token)
+
+
+def _acquire(key):
+    token = uuid.uuid4().hex
+    if get_redis().set(LOCK_PREFIX + key, token, nx=True, px=int(Config.ROUTEROS_QUERY_TIMEOUT * 1000)):
+        return token
+    return None
+
+
+def _fill(key, path, fetch, since):
+    """Get a reply newer than `since`: query the router when no other process is, otherwise wait for its reply."""
+    deadline = time.monotonic() + Config.ROUTEROS_QUERY_TIMEOUT
+    delay = 0.02
+    while True:
+        token = _acquire(key)
+        if token:
+            return _fetch_and_store(key, path, fetch, token)
+        entry = _read(key)
+        if entry and entry['fetched_at'] >= since:
+            return entry
+        if time.monotonic() >= deadline:
+            return entry or {'error': "Timed out waiting for the router", 'fetched_at': time.time()}
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+def _coalesced(key, path, fetch, since):
+    """Run `_fill` once per key in this process; concurrent callers get the same entry."""
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        flight.done.wait(Config.ROUTEROS_QUERY_TIMEOUT)
+        return flight.entry or {'error': "Timed out waiting for the router", 'fetched_at': time.time()}
+
+    try:
+        flight.entry = _fill(key, path, fetch, since)
+        return flight.entry
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def _revalidate(key, path, fetch):
+    """Refresh a stale reply in the background, unless someone already is."""
+    with _flights_lock:
+        if key in _flights:
+            return
+    try:
+        token = _acquire(key)
+    except redis.RedisError:
+        return
+    if token is None:
+        return
+
+    def refresh():
+        try:
+            _fetch_and_store(key, path, fetch, token)
+        except redis.RedisError as e:
+            logger.warning("RouterOS cache refresh failed: %s", e, extra={"key": key})
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def _response(entry, cached, stale=False):
+    response = dict(entry)
+    response['age'] = round(max(0.0, time.time() - entry['fetched_at']), 3)
+    response['cached'] = cached
+    response['stale'] = stale
+    return response
+
+
+def query(cn, path, fetch):
+    """Reply of `fetch()` (the router's answer to `path`) through the cache. The returned dict has either
+    'data' or 'error', plus 'fetched_at', 'age', 'cached' and 'stale'.
+    """
+    key = _cache_key(cn, path)
+    started = time.time()
+    try:
+        entry = _read(key)
+    except redis.RedisError as e:
+        # No cache, no coalescing across processes; still answer
+        logger.warning("RouterOS cache unavailable: %s", e)
+        return _response(_live(fetch), cached=False)
+
+    if entry:
+        age = started - entry['fetched_at']
+        if age < ttl_for(path) or 'error' in entry:
+            # Errors are only cached for ROUTEROS_ERROR_TTL, so one still in Redis is current
+            return _response(entry, cached=True)
+        if age < ttl_for(path) + Config.ROUTEROS_STALE_TTL:
+            _revalidate(key, path, fetch)
+            return _response(entry, cached=True, stale=True)
+
+    try:
+        entry = _coalesced(key, path, fetch, started)
+    except redis.RedisError as e:
+        logger.warning("RouterOS cache unavailable: %s", e)
+        return _response(_live(fetch), cached=False)
+    return _response(entry, cached=entry['fetched_at'] < started)
+
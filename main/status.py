@@ -0,0 +1,107 @@
+"""
+OpenVPN status file parsing.
+Handles the v1 layout ("OpenVPN CLIENT LIST" / "ROUTING TABLE" sections) and the v2/v3 layouts
+(CLIENT_LIST / ROUTING_TABLE rows), and aggregates the connected clients of every server instance.
+"""
+import logging
+import os
+import time
+
+from instances import get_instances
+
+logger = logging.getLogger(__name__)
+
+
+def _strip_port(address):
+    return address.rsplit(':', 1)[0] if address.count(':') == 1 else address
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def _since_epoch(value):
+    """Epoch seconds of a v1 "Connected Since" value (2.4 and 2.6 formats)."""
+    for layout in ('%a %b %d %H:%M:%S %Y', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return time.mktime(time.strptime(value, layout))
+        except ValueError:
+            continue
+    return 0.0
+
+
+def parse_status_file(path):
+    """Connected clients of one status file, keyed by common name."""
+    clients = {}
+    routes = {}
+    if not os.path.exists(path):
+        return clients
+
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError as e:
+        logger.error("Error reading VPN status: %s", e, extra={"path": path})
+        return clients
+
+    section = None
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            continue
+
+        # v1 section headers
+        if stripped in ("OpenVPN CLIENT LIST", "CLIENT LIST"):
+            section = 'clients'
+            continue
+        if stripped == "ROUTING TABLE":
+            section = 'routes'
+            continue
+        if stripped in ("GLOBAL STATS", "END"):
+            section = None
+            continue
+
+        parts = stripped.split('\t' if '\t' in stripped else ',')
+
+        # v2/v3 rows carry their own type
+        if parts[0] == 'CLIENT_LIST' and len(parts) >= 8:
+            clients[parts[1]] = {
+                'real_ip': _strip_port(parts[2]),
+                'vpn_ip': parts[3],
+                'last_seen': parts[7],
+                'bytes_received': _int(parts[5]),
+                'bytes_sent': _int(parts[6]),
+                'connected_since': float(_int(parts[8])) if len(parts) > 8 else _since_epoch(parts[7])
+            }
+        elif parts[0] == 'ROUTING_TABLE' and len(parts) >= 3:
+            routes.setdefault(parts[2], parts[1])
+        elif section == 'clients' and parts[0] not in ('Updated', 'Common Name') and len(parts) >= 5:
+            clients[parts[0]] = {
+                'real_ip': _strip_port(parts[1]),
+                'vpn_ip': '',
+                'last_seen': parts[4],
+                'bytes_received': _int(parts[2]),
+                'bytes_sent': _int(parts[3]),
+                'connected_since': _since_epoch(parts[4])
+            }
+        elif section == 'routes' and parts[0] != 'Virtual Address' and len(parts) >= 2:
+            routes.setdefault(parts[1], parts[0])
+
+    # v1 only reports the tunnel address in the routing table
+    for cn, client in clients.items():
+        if not client['vpn_ip']:
+            client['vpn_ip'] = routes.get(cn, '')
+    return clients
+
+
+def read_connected_clients():
+    """Connected clients across all server instances, each tagged with the instance serving it."""
+    connected = {}
+    for instance in get_instances():
+        for cn, client in parse_status_file(instance.status_file).items():
+            client['instance'] = instance.name
+            connected[cn] = client
+    return connected
@@ -1,17 +1,29 @@
 #!/usr/bin/env python3
-import os
-import subprocess
-import sys
-import tempfile
-
-# !/usr/bin/env python3
+import csv
+import io
+import json
+import logging
 import os
 import subprocess
 import sys
 import re
-import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
+from config import Config
+from fileio import atomic_remove, atomic_write, write_group
+from helper import easyrsa_key_args
+from logging_config import setup_logging
+from instances import get_instance, get_instances, preferred_instance, render_server_conf
+from ipam import get_allocator
+from main import router_cache
+from main.expiry import read_indexes
+import pki
+import store
+from main.status import read_connected_clients
+
+logger = logging.getLogger(__name__)
 
 
 class OpenVPNManager:
@@ -21,16 +33,17 @@ class OpenVPNManager:
         self.easy_rsa_dir = f"{self.base_dir}/easy-rsa"
         self.pki_dir = f"{self.easy_rsa_dir}/pki"
         self.script_dir = os.path.dirname(os.path.realpath(__file__))
+        # easyrsa signing and revocation rewrite index.txt and the serial file, so they never run concurrently
+        self._ca_lock = threading.Lock()
+        self._public_ip = None
 
         # Check if user has root privileges
         if os.geteuid() != 0:
-            print("This script must be run as root.")
-            sys.exit(1)
+            raise RuntimeError("This script must be run as root.")
 
         # Check if OpenVPN is installed
         if not os.path.exists(f"{self.base_dir}/server.conf"):
-            print("OpenVPN is not installed. Please install it first.")
-            sys.exit(1)
+            raise RuntimeError("OpenVPN is not installed. Please install it first.")
 
     def get_group_name(self):
         """Get the correct group name based on OS"""
@@ -40,33 +53,35 @@ class OpenVPNManager:
         else:
             return "nobody"
 
+    def index_entries(self, include_revoked=False):
+        """Client certificates of the root and intermediate CAs, parsed from their index.txt"""
+        infrastructure = pki.infrastructure_names()
+        entries = [entry for entry in read_indexes(pki.index_paths()) if entry['cn'] not in infrastructure]
+        if include_revoked:
+            return entries
+        return [entry for entry in entries if entry['status'] == 'V']
+
     def list_clients(self):
         """List all existing clients"""
-        if not os.path.exists(f"{self.pki_dir}/index.txt"):
-            print("No clients found.")
-            return []
-
-        try:
-            # Get list of valid certificates from index.txt
-            result = subprocess.run(
-                f"tail -n +2 {self.pki_dir}/index.txt | grep '^V' | cut -d '=' -f 2",
-                shell=True, check=True, text=True, capture_output=True
-            )
-
-            clients = result.stdout.strip().split('\n')
-            if clients == ['']:
-                print("No clients found.")
-                return []
-
-            # Print clients with numbers
-            print("\nAvailable clients:")
-            for i, client in enumerate(clients, 1):
-                print(f"{i}) {client}")
-
-            return clients
-        except subprocess.CalledProcessError as e:
-            print(f"Error listing clients: {e}")
-            return []
+        clients = [entry['cn'] for entry in self.index_entries()]
+        if not clients:
+            logger.info("No clients found.")
+        return clients
+
+    def public_ip(self):
+        """Public address for the client configs, looked up once per run"""
+        if self._public_ip is None:
+            # Imported here: only the CLI path needs it, web workers should not pay for it on boot
+            import requests
+            self._public_ip = requests.get("https://api.ipify.org").text.strip()
+        return self._public_ip
+
+    def easyrsa(self, *args):
+        """Run an easyrsa command in the host container"""
+        subprocess.run(
+            ["docker", "exec", "host", f"{self.easy_rsa_dir}/easyrsa", "--batch", *args],
+            check=True, capture_output=True, text=True
+        )
 
     def create_client(self, client_name):
         """Create a new OpenVPN client"""
@@ -74,12 +89,12 @@ class OpenVPNManager:
         sanitized_client = re.sub(r'[^0-9a-zA-Z_-]', '_', client_name)
 
         if not sanitized_client:
-            print("Invalid client name.")
+            logger.error("Invalid client name.", extra={"client": client_name})
             return False
 
         # Check if client already exists
         if os.path.exists(f"{self.pki_dir}/issued/{sanitized_client}.crt"):
-            print(f"Client '{sanitized_client}' already exists.")
+            logger.warning("Client already exists", extra={"client": sanitized_client})
             return False
 
         try:
@@ -87,12 +102,13 @@ class OpenVPNManager:
             # os.chdir(self.easy_rsa_dir)
 
             # Generate client certificates
-            print(f"Creating client '{sanitized_client}'...")
+            logger.info("Creating client", extra={"client": sanitized_client})
             subprocess.run(
                 [
                     "docker", "exec", "host", "/etc/openvpn/server/easy-rsa/easyrsa",
                     "--batch",
                     "--days=3650",
+                    *easyrsa_key_args(),
                     "build-client-full",
                     sanitized_client,
                     "nopass"
@@ -102,13 +118,14 @@ class OpenVPNManager:
 
             # Generate client config file
             self.generate_client_config(sanitized_client)
+            get_allocator().allocate(sanitized_client)
 
-            print(f"Client '{sanitized_client}' created successfully.")
-            print(f"Configuration file saved to: /etc/openvpn/client/{client_name}.ovpn")
+            logger.info("Client created", extra={"client": sanitized_client,
+                                                 "path": f"/etc/openvpn/client/{client_name}.ovpn"})
             return True
         except subprocess.CalledProcessError as e:
             raise
-            print(f"Error creating client: {e}")
+            logger.error("Error creating client: %s", e, extra={"client": sanitized_client})
             return False
 
     def generate_client_config(self, client_name):
@@ -124,12 +141,12 @@ class OpenVPNManager:
 
             protocol = proto_match.group(1) if proto_match else "udp"
             port = port_match.group(1) if port_match else "1194"
-            ip = requests.get("https://api.ipify.org").text.strip()
+            ip = self.public_ip()
 
             # Create client config file
             client_file = f"/etc/openvpn/client/{client_name}.ovpn"
 
-            with open(client_file, 'w') as f:
+            with io.StringIO() as f:
                 # Common client settings
                 f.write(f"client\n")
                 f.write(f"dev tun\n")
@@ -170,12 +187,12 @@ class OpenVPNManager:
                 f.write(tls_content)
                 f.write("</tls-crypt>\n")
 
-            # Set permissions
-            os.chmod(client_file, 0o600)
+                # Replace the file in one step, readable only by root
+                atomic_write(client_file, f.getvalue(), mode=0o600)
 
             return True
         except Exception as e:
-            print(f"Error generating client config: {e}")
+            logger.error("Error generating client config: %s", e, extra={"client": client_name})
             return False
 
     def revoke_client(self, client_selector):
@@ -193,110 +210,264 @@ class OpenVPNManager:
             if 0 <= index < len(clients):
                 client = clients[index]
             else:
-                print(f"Invalid client number: {client_selector}")
+                logger.error("Invalid client number", extra={"client": client_selector})
                 return False
         except ValueError:
             # If it's a name
             if client_selector in clients:
                 client = client_selector
             else:
-                print(f"Client '{client_selector}' not found.")
+                logger.error("Client not found", extra={"client": client_selector})
                 return False
 
-        print(f"Revoking certificate for client '{client}'...")
+        logger.info("Revoking certificate", extra={"client": client})
 
         try:
-            # Change to easy-rsa directory
-            os.chdir(self.easy_rsa_dir)
-
-            # Revoke certificate
-            subprocess.run(
-                f"./easyrsa --batch revoke '{client}'",
-                shell=True, check=True
-            )
-
-            # Generate new CRL
-            subprocess.run(
-                f"./easyrsa --batch --days=3650 gen-crl",
-                shell=True, check=True
-            )
-
-            # Clean up files
-            if os.path.exists(f"{self.base_dir}/crl.pem"):
-                os.remove(f"{self.base_dir}/crl.pem")
-
-            if os.path.exists(f"{self.pki_dir}/reqs/{client}.req"):
-                os.remove(f"{self.pki_dir}/reqs/{client}.req")
-
-            if os.path.exists(f"{self.pki_dir}/private/{client}.key"):
-                os.remove(f"{self.pki_dir}/private/{client}.key")
-
-            # Copy new CRL to server directory
-            subprocess.run(
-                f"cp {self.pki_dir}/crl.pem {self.base_dir}/crl.pem",
-                shell=True, check=True
-            )
-
-            # Update permissions
-            group_name = self.get_group_name()
-            subprocess.run(
-                f"chown nobody:{group_name} {self.base_dir}/crl.pem",
-                shell=True, check=True
-            )
-
-            print(f"Client '{client}' revoked successfully.")
+            shard = self.revoke_certificate(client)
+            self.publish_crl([shard])
+            logger.info("Client revoked", extra={"client": client})
             return True
         except subprocess.CalledProcessError as e:
-            print(f"Error revoking client: {e}")
+            logger.error("Error revoking client: %s", e, extra={"client": client})
             return False
 
+    def revoke_certificate(self, client):
+        """Revoke one certificate in the CA that issued it and clean up after it, without publishing a new CRL.
+        Returns the CA shard.
+        """
+        shard = pki.shard_of(client)
+        with shard.lock():
+            shard.easyrsa("--batch", "revoke", client)
+
+        # Clean up files
+        for path in (shard.path('reqs', f"{client}.req"), shard.path('private', f"{client}.key")):
+            atomic_remove(path)
+
+        # Reclaim the client's static VPN address
+        get_allocator().release(client)
+        # The reconciler removes its config and bundle
+        store.record_changes([client])
+        return shard
+
+    def publish_crl(self, shards):
+        """Regenerate the CRLs of these shards and the combined CRL the server reads (pki.publish_crl)"""
+        for shard in shards:
+            pki.publish_crl(shard)
+
+    def create_clients(self, names, workers):
+        """Create many clients: keys are generated in parallel, certificates are signed one at a time"""
+        existing = {entry['cn'] for entry in self.index_entries()}
+        names = [re.sub(r'[^0-9a-zA-Z_-]', '_', name) for name in names]
+        skipped = [name for name in names if name in existing]
+        todo = [name for name in dict.fromkeys(names) if name and name not in existing]
+
+        def create(name):
+            self.easyrsa(*easyrsa_key_args(), "gen-req", name, "nopass")
+            with self._ca_lock:
+                self.easyrsa("--days=3650", "sign-req", "client", name)
+            if not self.generate_client_config(name):
+                raise Exception("config generation failed")
+            get_allocator().allocate(name)
+
+        # The public address is looked up once, not by every worker
+        if todo:
+            self.public_ip()
+        with write_group():
+            failed = run_bulk(todo, create, workers, "create")
+        return len(todo) - len(failed), skipped, failed
+
+    def revoke_clients(self, names, workers):
+        """Revoke many clients and publish a single CRL at the end"""
+        valid = {entry['cn'] for entry in self.index_entries()}
+        skipped = [name for name in names if name not in valid]
+        todo = [name for name in dict.fromkeys(names) if name in valid]
+
+        shards = {}
+
+        def revoke(name):
+            shard = self.revoke_certificate(name)
+            shards[shard.name] = shard
+
+        with write_group():
+            failed = run_bulk(todo, revoke, workers, "revoke")
+        # One CRL per shard that revoked anything
+        self.publish_crl(shards.values())
+        return len(todo) - len(failed), skipped, failed
+
+    def write_instance_configs(self):
+        """Write one server config per configured instance, derived from server.conf"""
+        with open(f"{self.base_dir}/server.conf", 'r') as f:
+            base_conf = f.read()
+
+        for instance in get_instances():
+            path = f"{self.base_dir}/{instance.name}.conf"
+            atomic_write(path, render_server_conf(base_conf, instance))
+            os.makedirs(instance.ccd_dir, exist_ok=True)
+            logger.info("Wrote instance config (systemctl enable --now openvpn-server@%s)", instance.name,
+                        extra={"path": path})
+        return True
+
     def restart_service(self):
         """Restart the OpenVPN service"""
         try:
-            print("Restarting OpenVPN service...")
+            logger.info("Restarting OpenVPN service...")
             subprocess.run(
                 "systemctl restart openvpn-server@server.service",
                 shell=True, check=True
             )
-            print("OpenVPN service restarted successfully.")
+            logger.info("OpenVPN service restarted successfully.")
             return True
         except subprocess.CalledProcessError as e:
-            print(f"Error restarting OpenVPN service: {e}")
+            logger.error("Error restarting OpenVPN service: %s", e)
             return False
 
 
+def run_bulk(names, action, workers, label):
+    """Run `action(name)` for every name on a thread pool, reporting progress and throughput on stderr.
+    Returns the failures as (name, error) pairs.
+    """
+    failed = []
+    done = 0
+    started = last_report = time.monotonic()
+
+    def report(final=False):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        print(f"{label}: {done}/{len(names)} done, {len(failed)} failed, {done / elapsed:.1f}/s"
+              f"{' in %.1fs' % elapsed if final else ''}", file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(action, name): name for name in names}
+        for future in as_completed(futures):
+            done += 1
+            try:
+                future.result()
+            except Exception as e:
+                error = e.stderr.strip() if getattr(e, 'stderr', None) else str(e)
+                failed.append((futures[future], error))
+                logger.error("Bulk %s failed: %s", label, error, extra={"client": futures[future]})
+            if time.monotonic() - last_report >= 1:
+                last_report = time.monotonic()
+                report()
+    report(final=True)
+    return failed
+
+
+def read_names(path):
+    """Client names from a CSV (a `name` column, else the first one) or NDJSON ({"name": ...}) file, or - for stdin.
+    Raises ValueError naming the line of a malformed NDJSON entry.
+    """
+    with (sys.stdin if path == '-' else open(path, 'r', newline='')) as f:
+        lines = [(number, line) for number, line in enumerate(f, 1)
+                 if line.strip() and not line.lstrip().startswith('#')]
+    if not lines:
+        return []
+
+    if lines[0][1].lstrip().startswith('{'):
+        names = []
+        for number, line in lines:
+            try:
+                name = json.loads(line)['name']
+            except (ValueError, KeyError, TypeError):
+                name = None
+            if not isinstance(name, str):
+                raise ValueError(f"{path}, line {number}: expected a JSON object with a \"name\" string")
+            names.append(name.strip())
+        return names
+
+    rows = list(csv.reader(line for _, line in lines))
+    header = [column.strip().lower() for column in rows[0]]
+    if 'name' in header:
+        column = header.index('name')
+        rows = rows[1:]
+    else:
+        column = 0
+    return [row[column].strip() for row in rows if len(row) > column and row[column].strip()]
+
+
+def print_entries(entries, output_format):
+    """Print index entries as a numbered list, JSON, NDJSON or CSV"""
+    status_names = {'V': 'valid', 'R': 'revoked', 'E': 'expired'}
+    rows = [{
+        'name': entry['cn'],
+        'status': status_names.get(entry['status'], entry['status']),
+        'serial': entry['serial'],
+        'expires': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(entry['expires']))
+    } for entry in entries]
+
+    if output_format == 'json':
+        json.dump(rows, sys.stdout)
+        sys.stdout.write('\n')
+    elif output_format == 'ndjson':
+        sys.stdout.writelines(json.dumps(row) + '\n' for row in rows)
+    elif output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=['name', 'status', 'serial', 'expires'])
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for i, row in enumerate(rows, 1):
+            print(f"{i}) {row['name']}")
+
+
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser(description='OpenVPN Client Manager')
     subparsers = parser.add_subparsers(dest='command', help='Command to run')
 
     # List clients command
     list_parser = subparsers.add_parser('list', help='List all OpenVPN clients')
+    list_parser.add_argument('--format', choices=['table', 'json', 'ndjson', 'csv'], default='table')
+    list_parser.add_argument('--all', action='store_true', help='Include revoked and expired certificates')
 
     # Create client command
     create_parser = subparsers.add_parser('create', help='Create a new OpenVPN client')
-    create_parser.add_argument('name', help='Client name')
+    create_parser.add_argument('name', nargs='?', help='Client name')
+    create_parser.add_argument('--from-file', help='CSV or NDJSON file of client names (- for stdin)')
+    create_parser.add_argument('--workers', type=int, default=os.cpu_count() or 4)
 
     # Revoke client command
     revoke_parser = subparsers.add_parser('revoke', help='Revoke an existing OpenVPN client')
-    revoke_parser.add_argument('client', help='Client number or name')
+    revoke_parser.add_argument('client', nargs='?', help='Client number or name')
+    revoke_parser.add_argument('--from-file', help='CSV or NDJSON file of client names (- for stdin)')
+    revoke_parser.add_argument('--workers', type=int, default=4)
 
     # Restart service command
     restart_parser = subparsers.add_parser('restart', help='Restart the OpenVPN service')
 
+    # Server instances command
+    instances_parser = subparsers.add_parser('instances', help='Write server configs for the configured instances')
+
     args = parser.parse_args()
+    setup_logging()
 
     # Initialize OpenVPN manager
-    manager = OpenVPNManager()
+    try:
+        manager = OpenVPNManager()
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
 
     # Execute command
     if args.command == 'list':
-        manager.list_clients()
-    elif args.command == 'create':
+        print_entries(manager.index_entries(include_revoked=args.all), args.format)
+    elif args.command in ('create', 'revoke') and args.from_file:
+        bulk = manager.create_clients if args.command == 'create' else manager.revoke_clients
+        try:
+            names = read_names(args.from_file)
+        except ValueError as e:
+            parser.error(str(e))
+        succeeded, skipped, failed = bulk(names, args.workers)
+        print(json.dumps({"succeeded": succeeded, "skipped": skipped, "failed": dict(failed)}))
+        if failed:
+            sys.exit(1)
+    elif args.command == 'create' and args.name:
         manager.create_client(args.name)
-    elif args.command == 'revoke':
+    elif args.command == 'revoke' and args.client:
         manager.revoke_client(args.client)
     elif args.command == 'restart':
         manager.restart_service()
+    elif args.command == 'instances':
+        manager.write_instance_configs()
     else:
         parser.print_help()
 
@@ -306,66 +477,39 @@ if __name__ == '__main__':
 
 
 def get_vpn_clients():
-    """Get list of connected OpenVPN clients and their virtual IPs"""
-    # Read from OpenVPN status file
-    status_file = "/etc/openvpn/openvpn-status.log"
-    clients = {}
-
+    """Get list of connected OpenVPN clients and their virtual IPs, across all server instances"""
+    return read_connected_clients()
+
+
+def fetch_router_path(vpn_ip, path):
+    """Run a read-only (print) query on a router over the RouterOS API."""
+    import routeros_api
+    connection = routeros_api.RouterOsApiPool(
+        vpn_ip,
+        username=Config.ROUTEROS_USERNAME,
+        password=Config.ROUTEROS_PASSWORD,
+        port=Config.ROUTEROS_PORT,
+        socket_timeout=Config.ROUTEROS_SOCKET_TIMEOUT
+    )
     try:
-        with open(status_file, 'r') as f:
-            lines = f.readlines()
-            client_section = False
-
-            for line in lines:
-                if line.strip() == "ROUTING TABLE":
-                    client_section = False
-                    continue
-
-                if client_section and line.strip() and not line.startswith('Common Name'):
-                    parts = line.strip().split(',')
-                    if len(parts) >= 3:
-                        common_name = parts[0]
-                        real_ip = parts[1]
-                        vpn_ip = parts[2].split(':')[0]
-                        clients[common_name] = {
-                            'real_ip': real_ip,
-                            'vpn_ip': vpn_ip
-                        }
-
-                if line.strip() == "CLIENT LIST":
-                    client_section = True
-    except Exception as e:
-        print(f"Error reading VPN status: {e}")
-
-    return clients
-
-
-def communicate_with_mikrotik(client_name):
-    """Send commands to a specific Mikrotik router"""
-    clients = get_vpn_clients()
-
-    if client_name not in clients:
-        return {"error": "Client not connected to VPN"}
+        api = connection.get_api()
+        return api.get_resource(path).get()
+    finally:
+        connection.disconnect()
 
-    vpn_ip = clients[client_name]['vpn_ip']
 
-    # Use RouterOS API to communicate with the Mikrotik
-    # Example using librouteros
-    try:
-        import routeros_api
-        connection = routeros_api.RouterOsApiPool(
-            vpn_ip,
-            username='admin',
-            password='password',
-            port=8728
-        )
-        api = connection.get_api()
+def communicate_with_mikrotik(client_name, path='/system/resource'):
+    """Query a specific Mikrotik router, through the RouterOS cache (main/router_cache.py).
+    Returns 'data' (or 'error') with 'age', 'cached' and 'stale', so callers can tell a cached reply from a live one.
+    """
+    client = get_vpn_clients().get(client_name)
+    if client:
+        # The instance it is connected to decides the subnet, whatever the assignment strategy or failover
+        vpn_ip = client['vpn_ip'] or get_allocator().ip_for(client_name, get_instance(client['instance']).network)
+    else:
+        # Not in the status logs (yet): its static address in the instance it is expected on
+        vpn_ip = get_allocator().ip_for(client_name, preferred_instance(client_name).network)
+    if not vpn_ip:
+        return {"error": "Client not connected to VPN"}
 
-        # Example: Get system resource info
-        resource = api.get_resource('/system/resource')
-        return resource.get()
-    except Exception as e:
-        return {"error": f"Failed to communicate with router: {e}"}
-    finally:
-        if 'connection' in locals():
-            connection.disconnect()
+    return router_cache.query(client_name, path, lambda: fetch_router_path(vpn_ip, path))
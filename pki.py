@@ -0,0 +1,256 @@
+"""
+Per-tenant intermediate CAs.
+The root easyrsa CA (EASYRSA_DIR) can delegate issuing to one intermediate CA per tenant (reseller), each an
+easyrsa PKI of its own under CA_SHARDS_DIR/<tenant>. Every shard has its own index.txt, serial and CRL, and its
+own issuance lock, so certificates of different tenants are signed in parallel and a revocation only
+regenerates the (small) CRL of its shard. Clients without a tenant, or whose tenant has no shard, stay on the
+root CA, which is the only shard until one is created.
+
+The server trusts the root and every intermediate through CA_BUNDLE_PATH and checks revocations against
+CRL_PATH, the concatenation of the per-shard CRLs kept in CRL_DIR (OpenVPN loads every CRL in the file).
+Creating a shard points VPN_SERVER_CONF at both; the server has to be restarted to load the new CAs, and
+instance configs re-rendered with `python -m main.vpn instances`. Client configs carry the root CA, which
+signed the server certificate.
+
+    python pki.py create-shard <tenant>
+    python pki.py list
+"""
+import fcntl
+import glob
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+from contextlib import contextmanager
+
+from config import Config
+from fileio import atomic_copy, atomic_write
+
+logger = logging.getLogger(__name__)
+
+ROOT = '_root'
+TENANT_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+
+
+class CAShard:
+    def __init__(self, name, directory):
+        self.name = name
+        # An easyrsa directory: the PKI lives in <directory>/pki
+        self.directory = directory
+        self._local = threading.local()
+
+    @property
+    def is_root(self):
+        return self.name == ROOT
+
+    def path(self, *parts):
+        return os.path.join(self.directory, 'pki', *parts)
+
+    def exists(self):
+        return os.path.exists(self.path('ca.crt'))
+
+    @contextmanager
+    def lock(self):
+        """Serialise changes to this shard's CA database across processes. Re-entrant within a thread."""
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        os.makedirs(self.path(), exist_ok=True)
+        with open(self.path('.issue.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._local.depth = 1
+            try:
+                yield
+            finally:
+                self._local.depth = 0
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def easyrsa(self, *args):
+        """Run the root's easyrsa against this shard's PKI."""
+        pki_args = [] if self.is_root else [f'--pki-dir={self.path()}']
+        subprocess.run(['./easyrsa', *pki_args, *args], check=True, cwd=Config.EASYRSA_DIR)
+
+    def __repr__(self):
+        return f"CAShard({self.name}, {self.directory})"
+
+
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+def get_shard(name):
+    """The shard object of a name (ROOT for the root CA); one per process, so its lock is re-entrant."""
+    with _shards_lock:
+        shard = _shards.get(name)
+        if shard is None:
+            directory = Config.EASYRSA_DIR if name == ROOT else os.path.join(Config.CA_SHARDS_DIR, name)
+            shard = _shards[name] = CAShard(name, directory)
+        return shard
+
+
+def root_shard():
+    return get_shard(ROOT)
+
+
+def validate_tenant(tenant):
+    if not TENANT_PATTERN.match(tenant or ''):
+        raise ValueError(f"Invalid tenant '{tenant}'.")
+    return tenant
+
+
+def shard_names():
+    """Tenants that have an intermediate CA."""
+    if not os.path.isdir(Config.CA_SHARDS_DIR):
+        return []
+    return sorted(name for name in os.listdir(Config.CA_SHARDS_DIR)
+                  if TENANT_PATTERN.match(name) and get_shard(name).exists())
+
+
+def infrastructure_names():
+    """Names in the CA directories that are not clients: the server's certificate, every CA's own key and
+    request (ca.key, ca.req), and the intermediate CAs' certificates (<tenant>-ca) and requests (shard-<tenant>).
+    """
+    names = {Config.VPN_SERVER_CN, 'ca'}
+    for tenant in shard_names():
+        names.update((f"{tenant}-ca", f"shard-{tenant}"))
+    return names
+
+
+def all_shards():
+    """The root CA followed by every intermediate."""
+    return [root_shard()] + [get_shard(name) for name in shard_names()]
+
+
+def shard_for_tenant(tenant):
+    """Shard that issues the certificates of a tenant, creating it when CA_SHARDS_AUTO_CREATE is set."""
+    if not tenant:
+        return root_shard()
+    shard = get_shard(validate_tenant(tenant))
+    if shard.exists():
+        return shard
+    if Config.CA_SHARDS_AUTO_CREATE:
+        return create_shard(tenant)
+    return root_shard()
+
+
+def shard_of(cn):
+    """Shard holding a client's certificate: its tenant's when issued there, otherwise wherever it is found."""
+    import store
+
+    provision = store.get_provision(cn)
+    if provision and provision.get('tenant'):
+        shard = get_shard(provision['tenant'])
+        if shard.exists() and os.path.exists(shard.path('issued', f"{cn}.crt")):
+            return shard
+    for shard in all_shards():
+        if os.path.exists(shard.path('issued', f"{cn}.crt")):
+            return shard
+    return root_shard()
+
+
+def create_shard(tenant):
+    """Create a tenant's intermediate CA, signed by the root, and publish the new CA and CRL bundles."""
+    shard = get_shard(validate_tenant(tenant))
+    root = root_shard()
+    with shard.lock():
+        if shard.exists():
+            return shard
+        shard.easyrsa('--batch', 'init-pki', 'soft')
+        shard.easyrsa('--batch', f'--req-cn={tenant}-ca', 'build-ca', 'subca', 'nopass')
+
+        request_name = f"shard-{tenant}"
+        with root.lock():
+            root.easyrsa('--batch', 'import-req', shard.path('reqs', 'ca.req'), request_name)
+            root.easyrsa('--batch', f'--days={Config.CA_SHARD_DAYS}', 'sign-req', 'ca', request_name)
+        atomic_copy(root.path('issued', f"{request_name}.crt"), shard.path('ca.crt'), mode=0o644)
+
+        publish_crl(shard)
+    publish_ca_bundle()
+    if configure_server():
+        logger.warning("Server config now trusts the intermediate CAs; restart the server to apply",
+                       extra={"path": Config.VPN_SERVER_CONF})
+    return shard
+
+
+def revoke(shard, cn):
+    """Revoke a client's certificate in its shard and publish the shard's new CRL."""
+    with shard.lock():
+        shard.easyrsa('--batch', 'revoke', cn)
+        publish_crl(shard)
+
+
+@contextmanager
+def _crl_dir_lock():
+    os.makedirs(Config.CRL_DIR, exist_ok=True)
+    with open(os.path.join(Config.CRL_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def publish_crl(shard):
+    """Regenerate a shard's CRL, copy it to CRL_DIR and rebuild the combined CRL the server reads."""
+    with shard.lock():
+        if not shard.is_root and not os.path.exists(os.path.join(Config.CRL_DIR, f"{ROOT}.pem")):
+            # Before the first shard CRL_PATH was the root's CRL alone; it must stay in the combined one
+            publish_crl(root_shard())
+        shard.easyrsa('--batch', 'gen-crl')
+        with _crl_dir_lock():
+            atomic_copy(shard.path('crl.pem'), os.path.join(Config.CRL_DIR, f"{shard.name}.pem"), mode=0o644)
+            crls = []
+            for path in sorted(glob.glob(os.path.join(Config.CRL_DIR, '*.pem'))):
+                with open(path, 'r') as f:
+                    crls.append(f.read())
+            # The server re-reads it on every connection
+            atomic_write(Config.CRL_PATH, ''.join(crls), mode=0o644)
+
+
+def publish_ca_bundle():
+    """Write the root and every intermediate CA certificate to CA_BUNDLE_PATH."""
+    certificates = []
+    for shard in all_shards():
+        with open(shard.path('ca.crt'), 'r') as f:
+            certificates.append(f.read())
+    atomic_write(Config.CA_BUNDLE_PATH, ''.join(certificates), mode=0o644)
+
+
+def configure_server():
+    """Point the server config at CA_BUNDLE_PATH and CRL_PATH. Returns True when it was changed."""
+    try:
+        with open(Config.VPN_SERVER_CONF, 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return False
+    overrides = {'ca': Config.CA_BUNDLE_PATH, 'crl-verify': Config.CRL_PATH}
+    if all(f"{directive} {value}" in lines for directive, value in overrides.items()):
+        return False
+    lines = [line for line in lines if line.split(' ', 1)[0] not in overrides]
+    lines += [f"{directive} {value}" for directive, value in overrides.items()]
+    atomic_write(Config.VPN_SERVER_CONF, "\n".join(lines) + "\n", mode=0o644)
+    return True
+
+
+def index_paths():
+    """(shard name, index.txt path) of every shard."""
+    return [(shard.name, shard.path('index.txt')) for shard in all_shards()]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 3 and sys.argv[1] == 'create-shard':
+        print(create_shard(sys.argv[2]))
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'list':
+        for shard in all_shards():
+            print(f"{shard.name}\t{shard.directory}")
+    else:
+        print(__doc__)
+        sys.exit(1)
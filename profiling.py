@@ -0,0 +1,166 @@
+"""
+On-demand sampling profiler.
+A fraction (PROFILE_SAMPLE_RATE) of Flask requests and of the Celery tasks listed in PROFILE_TASKS run under
+cProfile when PROFILE_ENABLED is set; a single request can also be profiled with the `X-Profile` header
+(PROFILE_TOKEN, or any value from a logged-in admin). Unsampled requests only pay for one random() call.
+Each profile is written as a pstats dump to PROFILE_DIR, keeping the newest PROFILE_KEEP, and `summarize`
+merges the recent dumps into the top functions by cumulative or own time.
+"""
+import cProfile
+import glob
+import hmac
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _should_profile(forced=False):
+    if getattr(_local, 'profiler', None) is not None:
+        # Already profiling this thread (cProfile can't nest)
+        return False
+    return forced or (Config.PROFILE_ENABLED and random.random() < Config.PROFILE_SAMPLE_RATE)
+
+
+def _start():
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is active in this process
+        return
+    _local.profiler = profiler
+    _local.started = time.perf_counter()
+
+
+def _stop(kind, name):
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    elapsed_ms = (time.perf_counter() - _local.started) * 1000
+    _local.profiler = None
+    try:
+        save(profiler, kind, name, elapsed_ms)
+    except OSError as e:
+        logger.warning("Could not save profile: %s", e)
+
+
+def save(profiler, kind, name, elapsed_ms):
+    """Write a profile dump and drop the oldest ones beyond PROFILE_KEEP."""
+    os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+    safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)
+    path = os.path.join(Config.PROFILE_DIR,
+                        f"{time.time():.3f}-{kind}-{safe_name}-{os.getpid()}-{elapsed_ms:.0f}ms.prof")
+    profiler.dump_stats(path)
+
+    dumps = sorted(glob.glob(os.path.join(Config.PROFILE_DIR, '*.prof')))
+    for old in dumps[:-Config.PROFILE_KEEP]:
+        try:
+            os.remove(old)
+        except FileNotFoundError:
+            pass
+
+
+def _forced_by_header():
+    from flask import request, session
+
+    value = request.headers.get('X-Profile')
+    if not value:
+        return False
+    if Config.PROFILE_TOKEN and hmac.compare_digest(value, Config.PROFILE_TOKEN):
+        return True
+    return session.get('role') == 'admin'
+
+
+def init_app(app):
+    """Profile sampled (or explicitly requested) Flask requests."""
+    from flask import request
+
+    @app.before_request
+    def _profile_request():
+        if _should_profile(_forced_by_header()):
+            _start()
+
+    @app.teardown_request
+    def _save_request_profile(exc=None):
+        _stop('route', request.endpoint or 'unknown')
+
+
+def init_celery():
+    """Profile sampled executions of the tasks in PROFILE_TASKS."""
+    from celery.signals import task_postrun, task_prerun
+
+    @task_prerun.connect(weak=False)
+    def _profile_task(task=None, **kwargs):
+        if task is not None and task.name in Config.PROFILE_TASKS and _should_profile():
+            _start()
+
+    @task_postrun.connect(weak=False)
+    def _save_task_profile(task=None, **kwargs):
+        _stop('task', task.name if task is not None else 'unknown')
+
+
+def list_dumps(kind=None, name=None):
+    """Dump files, newest first, optionally filtered by kind (route/task) and endpoint or task name."""
+    dumps = []
+    for path in sorted(glob.glob(os.path.join(Config.PROFILE_DIR, '*.prof')), reverse=True):
+        parts = os.path.basename(path)[:-len('.prof')].split('-')
+        if len(parts) < 5:
+            continue
+        dump_kind, dump_name = parts[1], '-'.join(parts[2:-2])
+        if (kind and dump_kind != kind) or (name and dump_name != name):
+            continue
+        dumps.append({
+            'file': os.path.basename(path),
+            'path': path,
+            'timestamp': float(parts[0]),
+            'kind': dump_kind,
+            'name': dump_name,
+            'elapsed_ms': int(parts[-1][:-len('ms')])
+        })
+    return dumps
+
+
+def summarize(kind=None, name=None, limit=25, sort='cumulative', max_dumps=50):
+    """Top functions across the most recent dumps."""
+    stats = None
+    dumps = []
+    for dump in list_dumps(kind, name)[:max_dumps]:
+        # Any dump, the first one included, may be rotated away or still being written meanwhile
+        try:
+            if stats is None:
+                stats = pstats.Stats(dump['path'])
+            else:
+                stats.add(dump['path'])
+        except (OSError, EOFError, TypeError, ValueError):
+            continue
+        dumps.append(dump)
+    if not dumps:
+        return {'profiles': 0, 'functions': []}
+
+    key = 3 if sort == 'cumulative' else 2  # (cc, nc, tt, ct, callers)
+    functions = []
+    for (filename, line, function), values in sorted(stats.stats.items(), key=lambda item: item[1][key],
+                                                     reverse=True)[:limit]:
+        calls, _, own, cumulative, _ = values
+        functions.append({
+            'function': f"{filename}:{line}({function})",
+            'calls': calls,
+            'own_ms': round(own * 1000, 3),
+            'cumulative_ms': round(cumulative * 1000, 3),
+            'cumulative_ms_per_profile': round(cumulative * 1000 / len(dumps), 3)
+        })
+    return {
+        'profiles': len(dumps),
+        'mean_elapsed_ms': round(sum(dump['elapsed_ms'] for dump in dumps) / len(dumps), 1),
+        'functions': functions
+    }
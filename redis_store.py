@@ -0,0 +1,15 @@
+"""Shared Redis client for application state (admission control, fleet health, ...)."""
+import redis
+
+from celery_config import redis_url
+from config import Config
+
+_redis = None
+
+
+def get_redis():
+    """Return the shared Redis client, created on first use (after any gunicorn fork)."""
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(redis_url, socket_timeout=Config.REDIS_SOCKET_TIMEOUT)
+    return _redis
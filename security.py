@@ -1,13 +1,20 @@
 import hashlib
 import hmac
+import re
+import time
 from functools import wraps
 from flask import request, jsonify
 from config import Config
+from store import secret_version
 
+PROVISION_IDENTITY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
 
-def generate_secret(provision_identity):
-    """Generate a secret for a provision identity."""
+
+def generate_secret(provision_identity, version=1):
+    """Generate a secret for a provision identity. Version 1 is the original, unversioned secret."""
     message = f"{provision_identity}{Config.SECRET_KEY}".encode()
+    if version > 1:
+        message += f":{version}".encode()
     return hmac.new(
         Config.SECRET_KEY.encode(),
         message,
@@ -15,9 +22,29 @@ def generate_secret(provision_identity):
     ).hexdigest()
 
 
+def sign_payload(body, timestamp, key=None):
+    """HMAC-SHA256 signature of a webhook body (bytes), bound to its timestamp."""
+    return hmac.new(
+        (key or Config.WEBHOOK_SECRET).encode(),
+        f"{timestamp}.".encode() + body,
+        hashlib.sha256
+    ).hexdigest()
+
+
+def verify_signature(body, timestamp, signature, key=None, max_skew=None):
+    """Check a webhook signature and that its timestamp is recent (replay protection)."""
+    try:
+        skew = abs(time.time() - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+    if skew > (Config.WEBHOOK_MAX_SKEW if max_skew is None else max_skew):
+        return False
+    return hmac.compare_digest(signature or '', sign_payload(body, timestamp, key))
+
+
 def validate_provision_identity(provision_identity):
-    """Validate a provision identity."""
-    if not provision_identity or len(provision_identity) > 32:
+    """Validate a provision identity: it names files and ends up in RouterOS scripts and easyrsa arguments."""
+    if not PROVISION_IDENTITY_PATTERN.match(provision_identity or ''):
         raise ValueError("Invalid provision identity")
     return True
 
@@ -33,7 +60,7 @@ def require_secret(f):
         if not secret or not provision_identity:
             return jsonify({"error": "Missing secret or provision identity"}), 401
 
-        expected_secret = generate_secret(provision_identity)
+        expected_secret = generate_secret(provision_identity, secret_version(provision_identity))
         if not hmac.compare_digest(secret, expected_secret):
             return jsonify({"error": "Invalid secret"}), 401
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Worker boot benchmark.
+Imports the app in fresh interpreters with `python -X importtime`, reports the total import time and the
+slowest modules, and exits non-zero when the median boot exceeds the target.
+
+    python startup_bench.py [module] [--runs N] [--target-ms MS] [--top N]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+def import_times(module):
+    """Run one cold import and return {module: (self_us, cumulative_us)} from the importtime report."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        raise SystemExit(f"Importing {module} failed")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure worker import time')
+    parser.add_argument('module', nargs='?', default='app', help='Module the worker imports')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--target-ms', type=float, default=400.0)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    totals = []
+    runs = []
+    for _ in range(args.runs):
+        times = import_times(args.module)
+        runs.append(times)
+        totals.append(times[args.module][1] / 1000)
+
+    median = statistics.median(totals)
+    print(f"{args.module}: median {median:.1f} ms, min {min(totals):.1f} ms, max {max(totals):.1f} ms "
+          f"over {args.runs} runs (target {args.target_ms:.0f} ms)")
+
+    # Slowest modules by self time, averaged over the runs
+    self_ms = {}
+    for times in runs:
+        for name, (self_us, _) in times.items():
+            self_ms[name] = self_ms.get(name, 0) + self_us / 1000 / len(runs)
+    print(f"\n{'self [ms]':>10}  module")
+    for name, value in sorted(self_ms.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{value:>10.1f}  {name}")
+
+    if median > args.target_ms:
+        print(f"\n❌ Boot import time {median:.1f} ms is above the {args.target_ms:.0f} ms target")
+        sys.exit(1)
+    print(f"\n✅ Boot import time within target")
+
+
+if __name__ == '__main__':
+    main()
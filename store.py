@@ -0,0 +1,383 @@
+"""
+Provisioning state store.
+One SQLite database in WAL mode holds every provision (identity, status, certificate serial and expiry, task id,
+secret version, tenant, timestamps), the outbox of events for the main site, the identities changed since the
+reconciler last looked at them and the dashboard users. WAL lets
+every gunicorn worker and Celery process read while one writes, and the state survives Redis flushes, unlike
+Celery results. Each process and thread gets its own connection, opened on first use after any fork.
+
+    python store.py import                      # backfill from the client directory and easyrsa's index.txt
+    python store.py add-user <username> [role]  # password read from stdin
+    python store.py requeue-events              # retry the outbox events whose delivery was given up
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from config import Config
+
+PENDING = 'pending'
+ISSUED = 'issued'
+FAILED = 'failed'
+REVOKED = 'revoked'
+DELETED = 'deleted'
+# A new provision may only take over an identity in one of these states
+REUSABLE = (FAILED, REVOKED, DELETED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS provisions (
+    identity TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    task_id TEXT,
+    cert_serial TEXT,
+    secret_version INTEGER NOT NULL DEFAULT 1,
+    tenant TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    issued_at REAL,
+    expires_at REAL,
+    revoked_at REAL
+);
+CREATE INDEX IF NOT EXISTS provisions_status ON provisions (status, identity);
+CREATE UNIQUE INDEX IF NOT EXISTS provisions_task ON provisions (task_id) WHERE task_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS provisions_expiry ON provisions (expires_at) WHERE status = 'issued';
+CREATE INDEX IF NOT EXISTS provisions_serial ON provisions (cert_serial);
+
+-- Events for the main site, removed once delivered; next_attempt_at is NULL when delivery was given up
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    event TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt_at) WHERE next_attempt_at IS NOT NULL;
+
+-- Identities whose certificate or config may have changed, until the reconciler (main/reconcile.py) takes them
+CREATE TABLE IF NOT EXISTS changes (
+    identity TEXT PRIMARY KEY,
+    changed_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+_local = threading.local()
+
+
+def get_db():
+    """Connection of the calling process and thread, created and migrated on first use."""
+    if getattr(_local, 'pid', None) != os.getpid():
+        os.makedirs(os.path.dirname(Config.STATE_DB), exist_ok=True)
+        db = sqlite3.connect(Config.STATE_DB, timeout=Config.STATE_DB_BUSY_TIMEOUT, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL only loses the last commits on power loss, never consistency
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        _migrate(db)
+        _seed_admin(db)
+        _local.db = db
+        _local.pid = os.getpid()
+    return _local.db
+
+
+def _migrate(db):
+    """Add the columns introduced after a database was created."""
+    columns = {row['name'] for row in db.execute("PRAGMA table_info(provisions)")}
+    if 'tenant' not in columns:
+        try:
+            db.execute("ALTER TABLE provisions ADD COLUMN tenant TEXT")
+        except sqlite3.OperationalError:
+            # Added by another process in the meantime
+            pass
+
+
+def _seed_admin(db):
+    """Create the initial admin from ADMIN_USERNAME/ADMIN_PASSWORD when there are no users yet."""
+    db.execute(
+        "INSERT INTO users (username, password_hash, role, created_at) "
+        "SELECT ?, ?, 'admin', ? WHERE NOT EXISTS (SELECT 1 FROM users)",
+        (Config.ADMIN_USERNAME, generate_password_hash(Config.ADMIN_PASSWORD), time.time())
+    )
+
+
+def _row(row):
+    return dict(row) if row is not None else None
+
+
+# Provisions
+
+def get_provision(identity):
+    return _row(get_db().execute("SELECT * FROM provisions WHERE identity = ?", (identity,)).fetchone())
+
+
+def issued_identities(identities):
+    """The identities among `identities` that are issued clients."""
+    identities = list(identities)
+    issued = set()
+    # Below SQLite's limit on query parameters
+    for start in range(0, len(identities), 500):
+        chunk = identities[start:start + 500]
+        issued.update(row['identity'] for row in get_db().execute(
+            f"SELECT identity FROM provisions WHERE status = ? AND identity IN ({','.join('?' * len(chunk))})",
+            (ISSUED, *chunk)
+        ))
+    return issued
+
+
+def provision_for_task(task_id):
+    return _row(get_db().execute("SELECT * FROM provisions WHERE task_id = ?", (task_id,)).fetchone())
+
+
+def claim_provision(identity, task_id=None, tenant=None):
+    """Record a new pending provision. Returns False when the identity is already pending or issued,
+    so concurrent requests for one identity cannot both start issuance.
+    """
+    now = time.time()
+    cursor = get_db().execute(
+        "INSERT INTO provisions (identity, status, task_id, tenant, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (identity) DO UPDATE SET status = excluded.status, task_id = excluded.task_id, "
+        "tenant = excluded.tenant, cert_serial = NULL, error = NULL, issued_at = NULL, expires_at = NULL, "
+        "revoked_at = NULL, "
+        "created_at = excluded.created_at, updated_at = excluded.updated_at "
+        f"WHERE provisions.status IN ({','.join('?' * len(REUSABLE))})",
+        (identity, PENDING, task_id, tenant, now, now, *REUSABLE)
+    )
+    if cursor.rowcount != 1:
+        return False
+    record_changes([identity], now)
+    return True
+
+
+def mark_issued(identity, cert_serial=None, expires_at=None):
+    now = time.time()
+    get_db().execute(
+        "INSERT INTO provisions (identity, status, cert_serial, created_at, updated_at, issued_at, expires_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (identity) DO UPDATE SET status = excluded.status, cert_serial = excluded.cert_serial, "
+        "error = NULL, updated_at = excluded.updated_at, issued_at = excluded.issued_at, "
+        "expires_at = excluded.expires_at, revoked_at = NULL",
+        (identity, ISSUED, cert_serial, now, now, now, expires_at)
+    )
+    record_changes([identity], now)
+
+
+def mark_failed(identity, error):
+    now = time.time()
+    get_db().execute(
+        "UPDATE provisions SET status = ?, error = ?, updated_at = ? WHERE identity = ?",
+        (FAILED, error, now, identity)
+    )
+    record_changes([identity], now)
+
+
+def mark_revoked(identity):
+    now = time.time()
+    get_db().execute(
+        "UPDATE provisions SET status = ?, revoked_at = ?, updated_at = ? WHERE identity = ?",
+        (REVOKED, now, now, identity)
+    )
+    record_changes([identity], now)
+
+
+def mark_deleted(identity):
+    now = time.time()
+    get_db().execute(
+        "UPDATE provisions SET status = ?, updated_at = ? WHERE identity = ?",
+        (DELETED, now, identity)
+    )
+    record_changes([identity], now)
+
+
+def secret_version(identity):
+    """Current download secret version of an identity (1 for identities issued before the store)."""
+    row = get_db().execute("SELECT secret_version FROM provisions WHERE identity = ?", (identity,)).fetchone()
+    return row['secret_version'] if row else 1
+
+
+def rotate_secret(identity):
+    """Invalidate the identity's download secret. Returns the new version."""
+    db = get_db()
+    db.execute(
+        "UPDATE provisions SET secret_version = secret_version + 1, updated_at = ? WHERE identity = ?",
+        (time.time(), identity)
+    )
+    return secret_version(identity)
+
+
+def count_by_status():
+    return {row['status']: row['count'] for row in
+            get_db().execute("SELECT status, COUNT(*) AS count FROM provisions GROUP BY status")}
+
+
+def backfill():
+    """Record clients issued before the store existed, from the client directory and easyrsa's index.txt.
+    Existing rows are left untouched. Returns the number of imported provisions.
+    """
+    from main.expiry import get_expiry_index
+    from main.registry import read_client_list
+
+    index = get_expiry_index()
+    now = time.time()
+    rows = []
+    for identity, client in read_client_list().items():
+        certificate = index.by_cn.get(identity)
+        rows.append((identity, ISSUED, certificate['serial'] if certificate else None, now, now,
+                     certificate['expires'] if certificate else None))
+
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        before = db.total_changes
+        db.executemany(
+            "INSERT OR IGNORE INTO provisions (identity, status, cert_serial, created_at, updated_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        imported = db.total_changes - before
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return imported
+
+
+# Changes for the reconciler
+
+def record_changes(identities, now=None):
+    """Note identities whose PKI files or config were (or are about to be) changed."""
+    now = time.time() if now is None else now
+    get_db().executemany(
+        "INSERT INTO changes (identity, changed_at) VALUES (?, ?) "
+        "ON CONFLICT (identity) DO UPDATE SET changed_at = excluded.changed_at",
+        [(identity, now) for identity in identities]
+    )
+
+
+def pending_changes():
+    """{identity: changed_at} of every change not yet taken by the reconciler."""
+    return {row['identity']: row['changed_at'] for row in get_db().execute("SELECT * FROM changes")}
+
+
+def clear_changes(changes):
+    """Forget changes the reconciler took; an identity changed again since is kept."""
+    get_db().executemany("DELETE FROM changes WHERE identity = ? AND changed_at = ?", list(changes.items()))
+
+
+# Outbox
+
+def enqueue_event(event, payload):
+    now = time.time()
+    get_db().execute(
+        "INSERT INTO outbox (event, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+        (event, json.dumps(payload), now, now)
+    )
+
+
+def claim_events(limit, lease):
+    """Take up to `limit` due events, oldest first, hiding them from other dispatchers for `lease` seconds
+    (they come back if this one dies before settling them).
+    """
+    db = get_db()
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute(
+            "SELECT * FROM outbox WHERE next_attempt_at IS NOT NULL AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at, id LIMIT ?", (now, limit)
+        ).fetchall()
+        db.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                       [(now + lease, row['id']) for row in rows])
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+
+def delete_events(ids):
+    get_db().executemany("DELETE FROM outbox WHERE id = ?", [(event_id,) for event_id in ids])
+
+
+def retry_events(ids, delay, error, max_attempts):
+    """Count a failed attempt; events that reached `max_attempts` are parked (next_attempt_at NULL).
+    Returns the number parked.
+    """
+    db = get_db()
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, last_error = ?, "
+            "next_attempt_at = CASE WHEN attempts + 1 >= ? THEN NULL ELSE ? END WHERE id = ?",
+            [(error, max_attempts, now + delay, event_id) for event_id in ids]
+        )
+        parked = db.execute(
+            f"SELECT COUNT(*) FROM outbox WHERE next_attempt_at IS NULL AND id IN ({','.join('?' * len(ids))})",
+            ids
+        ).fetchone()[0] if ids else 0
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return parked
+
+
+def requeue_parked():
+    """Schedule every parked event for delivery again. Returns the number requeued."""
+    return get_db().execute(
+        "UPDATE outbox SET attempts = 0, next_attempt_at = ? WHERE next_attempt_at IS NULL", (time.time(),)
+    ).rowcount
+
+
+def outbox_counts():
+    row = get_db().execute(
+        "SELECT COUNT(*) AS pending, COALESCE(SUM(next_attempt_at IS NULL), 0) AS parked, "
+        "MIN(created_at) AS oldest FROM outbox"
+    ).fetchone()
+    return {'pending': row['pending'] - row['parked'], 'parked': row['parked'], 'oldest': row['oldest']}
+
+
+# Users
+
+def verify_user(username, password):
+    """The user's record when the password matches, otherwise None."""
+    row = get_db().execute("SELECT * FROM users WHERE username = ?", (username or '',)).fetchone()
+    if row is None or not check_password_hash(row['password_hash'], password or ''):
+        return None
+    return {'username': row['username'], 'role': row['role']}
+
+
+def set_user(username, password, role='admin'):
+    get_db().execute(
+        "INSERT INTO users (username, password_hash, role, created_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (username) DO UPDATE SET password_hash = excluded.password_hash, role = excluded.role",
+        (username, generate_password_hash(password), role, time.time())
+    )
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'import':
+        print(f"Imported {backfill()} provisions into {Config.STATE_DB}")
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'add-user':
+        set_user(sys.argv[2], sys.stdin.readline().rstrip('\n'), sys.argv[3] if len(sys.argv) > 3 else 'admin')
+        print(f"User {sys.argv[2]} saved")
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'requeue-events':
+        print(f"Requeued {requeue_parked()} events")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -1,24 +1,146 @@
+import time
+
+from celery.signals import setup_logging as celery_setup_logging
+
 from celery_config import celery
-from helper import generate_openvpn_config
+from helper import generate_openvpn_config, renew_openvpn_config
 from config import Config
+from admission import record_completion
+from bootstrap import write_bootstrap_bundle
+from logging_config import setup_logging
+from main import accounting, expiry, prober, reconcile, registry
+import profiling
+import store
+import webhooks
 
+profiling.init_celery()
 
-@celery.task
-def generate_certificate(provision_identity):
-    """Generate OpenVPN certificate and configuration for a client."""
+
+@celery_setup_logging.connect(weak=False)
+def _setup_logging(**kwargs):
+    # Replaces Celery's own logging setup; the prefork children restart the listener after the fork
+    setup_logging()
+
+
+def record_issued(provision_identity):
+    """Store the serial and expiry of the certificate just issued to a client."""
+    certificate = expiry.get_expiry_index().by_cn.get(provision_identity)
+    store.mark_issued(provision_identity, certificate['serial'] if certificate else None,
+                      certificate['expires'] if certificate else None)
+    return certificate
+
+
+@celery.task(bind=True)
+def generate_certificate(self, provision_identity, tenant=None):
+    """Generate OpenVPN certificate and configuration for a client, signed by its tenant's CA if it has one."""
+    started = time.monotonic()
     try:
         # Generate OpenVPN configuration
         config_path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
-        generate_openvpn_config(provision_identity, config_path)
+        generate_openvpn_config(provision_identity, config_path, tenant=tenant)
+        # Pre-render the router bootstrap bundle so it is served straight from cache
+        write_bootstrap_bundle(provision_identity)
+        certificate = record_issued(provision_identity)
+        # Tell the main site instead of making it poll get_task_status
+        webhooks.emit(webhooks.PROVISION_COMPLETED, {
+            "provision_identity": provision_identity,
+            "task_id": self.request.id,
+            "tenant": tenant,
+            "serial": certificate['serial'] if certificate else None,
+            "expires_at": certificate['expires'] if certificate else None
+        })
 
         return {
             "status": "success",
             "message": "Certificate generated successfully",
             "provision_identity": provision_identity
         }
+    except Exception as e:
+        store.mark_failed(provision_identity, str(e))
+        webhooks.emit(webhooks.PROVISION_FAILED, {
+            "provision_identity": provision_identity,
+            "task_id": self.request.id,
+            "tenant": tenant,
+            "message": str(e)
+        })
+        return {
+            "status": "error",
+            "message": str(e),
+            "provision_identity": provision_identity
+        }
+    finally:
+        record_completion(self.request.id, time.monotonic() - started)
+
+
+@celery.task
+def sample_traffic():
+    """Record per-client traffic counters and session changes from the status files."""
+    return {"sampled": accounting.sample()}
+
+
+@celery.task
+def probe_fleet():
+    """Check the RouterOS API and hotspot of every connected router."""
+    healthy = prober.run_probe()
+    if healthy is None:
+        return {"skipped": "already running"}
+    return {"healthy": healthy}
+
+
+@celery.task
+def refresh_registry():
+    """Publish the client registry snapshot to all web workers when it changed."""
+    return {"version": registry.publish_snapshot()}
+
+
+@celery.task(rate_limit=f"{Config.RENEWAL_MAX_PER_HOUR}/h")
+def renew_certificate(provision_identity):
+    """Re-issue a client's certificate and pre-stage its new config and bootstrap bundle."""
+    provision = store.get_provision(provision_identity)
+    if not provision or provision['status'] != store.ISSUED:
+        # Revoked or deleted since it was planned, or not a client at all (server, intermediate CA)
+        return {
+            "status": "skipped",
+            "message": "Not an issued client",
+            "provision_identity": provision_identity
+        }
+    try:
+        config_path = f"{Config.VPN_CLIENT_DIR}/{provision_identity}.ovpn"
+        renew_openvpn_config(provision_identity, config_path)
+        write_bootstrap_bundle(provision_identity)
+        record_issued(provision_identity)
+        return {
+            "status": "success",
+            "message": "Certificate renewed successfully",
+            "provision_identity": provision_identity
+        }
     except Exception as e:
         return {
             "status": "error",
             "message": str(e),
             "provision_identity": provision_identity
-        }
\ No newline at end of file
+        }
+
+
+@celery.task
+def plan_renewals():
+    """Spread the renewals of soon-to-expire certificates over the renewal window."""
+    return {"planned": expiry.plan_renewals()}
+
+
+@celery.task
+def dispatch_renewals():
+    """Queue the renewals that are due."""
+    due = expiry.due_renewals()
+    for provision_identity in due:
+        renew_certificate.delay(provision_identity)
+    return {"dispatched": len(due)}
+
+
+@celery.task
+def reconcile_clients():
+    """Repair or clean up a batch of clients whose PKI files and configs disagree."""
+    counts = reconcile.reconcile()
+    if counts.get('repaired') or counts.get('removed'):
+        registry.refresh_snapshot()
+    return counts
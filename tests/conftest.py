@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+import pki  # noqa: E402
+import store  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Point every path in Config into a temporary directory and drop the per-process caches."""
+    from main import expiry
+    import instances
+    import ipam
+
+    paths = {
+        'STATE_DB': 'state/state.db',
+        'VPN_CLIENT_DIR': 'client',
+        'VPN_BOOTSTRAP_DIR': 'client/bootstrap',
+        'EASYRSA_DIR': 'easy-rsa',
+        'CA_SHARDS_DIR': 'ca-shards',
+        'CA_BUNDLE_PATH': 'server/ca-bundle.pem',
+        'CRL_DIR': 'server/crl.d',
+        'CRL_PATH': 'crl.pem',
+        'VPN_CCD_DIR': 'server/ccd',
+        'VPN_IPAM_STATE': 'server/ipam.json',
+        'RECONCILE_STATE': 'state/reconcile.json',
+        'VPN_SERVER_CONF': 'server/server.conf',
+    }
+    for name, path in paths.items():
+        monkeypatch.setattr(Config, name, str(tmp_path / path))
+    os.makedirs(tmp_path / 'client' / 'bootstrap')
+    os.makedirs(tmp_path / 'easy-rsa' / 'pki')
+    monkeypatch.setattr(Config, 'FAKE_PKI', False)
+    monkeypatch.setattr(Config, 'FSYNC_WRITES', False)
+
+    monkeypatch.setattr(pki, '_shards', {})
+    monkeypatch.setattr(store, '_local', type(store._local)())
+    monkeypatch.setattr(expiry, '_index', None)
+    monkeypatch.setattr(ipam, '_allocator', None)
+    monkeypatch.setattr(instances, '_instances', None)
+    return tmp_path
+
+
+def write_index(shard, *entries):
+    """Write an index.txt of (status, expiry YYMMDDHHMMSSZ, CN) entries, with a cert and key for the valid ones."""
+    lines = []
+    for serial, (status, expires, cn) in enumerate(entries, 1):
+        lines.append(f"{status}\t{expires}\t\t{serial:02X}\tunknown\t/CN={cn}\n")
+        if status == 'V':
+            for directory, suffix in (('issued', '.crt'), ('private', '.key')):
+                os.makedirs(shard.path(directory), exist_ok=True)
+                with open(shard.path(directory, f"{cn}{suffix}"), 'w') as f:
+                    f.write(f"{cn}{suffix}\n")
+    os.makedirs(shard.path(), exist_ok=True)
+    with open(shard.path('index.txt'), 'w') as f:
+        f.writelines(lines)
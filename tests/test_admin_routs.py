@@ -0,0 +1,55 @@
+import pytest
+from flask import Flask
+
+from main import admin_routs, vpn
+import store
+
+
+class Manager:
+    created = None
+
+    def create_client(self, client_name):
+        return self.created
+
+
+@pytest.fixture
+def client(workdir, monkeypatch):
+    monkeypatch.setattr(admin_routs, 'CLIENT_DIR', str(workdir / 'client'))
+    monkeypatch.setattr(admin_routs, 'refresh_snapshot', lambda: None)
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    admin_routs.init(app)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['username'] = 'admin'
+    return client
+
+
+def test_created_client_is_marked_issued(client, monkeypatch):
+    monkeypatch.setattr(Manager, 'created', True)
+    monkeypatch.setattr(vpn, 'OpenVPNManager', Manager)
+
+    client.post('/create_client', data={'client_name': 'client1'})
+
+    assert store.get_provision('client1')['status'] == store.ISSUED
+
+
+def test_unusable_manager_does_not_leave_the_claim_pending(client, monkeypatch):
+    # The real manager refuses to start without root
+    monkeypatch.setattr(vpn.os, 'geteuid', lambda: 1000)
+
+    client.post('/create_client', data={'client_name': 'client1'})
+
+    assert store.get_provision('client1')['status'] == store.FAILED
+
+
+def test_refused_client_is_marked_failed(client, monkeypatch):
+    monkeypatch.setattr(Manager, 'created', False)
+    monkeypatch.setattr(vpn, 'OpenVPNManager', Manager)
+
+    client.post('/create_client', data={'client_name': 'client1'})
+
+    provision = store.get_provision('client1')
+    assert provision['status'] == store.FAILED
+    # Failed claims can be retried
+    assert store.claim_provision('client1')
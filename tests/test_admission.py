@@ -0,0 +1,87 @@
+import time
+
+import fakeredis
+
+import admission
+from admission import provisioning_pools
+from config import Config
+
+
+class Inspect:
+    def __init__(self, stats, queues):
+        self._stats = stats
+        self._queues = queues
+
+    def stats(self):
+        return self._stats
+
+    def active_queues(self):
+        return self._queues
+
+
+def test_pool_sizes_follow_earlier_resizes():
+    inspect = Inspect({
+        # Started with 2 processes, grown to 6 since
+        'provision@a': {'pool': {'max-concurrency': 2, 'processes': [11, 12, 13, 14, 15, 16]}},
+        'maintenance@b': {'pool': {'max-concurrency': 2, 'processes': [21, 22]}},
+        'provision@c': {'pool': {'max-concurrency': 4}},
+    }, {
+        'provision@a': [{'name': Config.PROVISION_QUEUE}],
+        'maintenance@b': [{'name': 'maintenance'}],
+        'provision@c': [{'name': Config.PROVISION_QUEUE}],
+    })
+
+    assert provisioning_pools(inspect) == {'provision@a': 6, 'provision@c': 4}
+
+
+def test_quiet_period_does_not_shrink_the_drain_rate(workdir, monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(admission, 'get_redis', lambda: r)
+    monkeypatch.setattr(admission, 'worker_capacity', lambda: 8)
+    depth = {'value': 1}
+    monkeypatch.setattr(admission, 'queue_depth', lambda: depth['value'])
+    # 3 completions of 4s in the last 5 minutes: little demand, but 8 workers drain 2 tasks/s
+    for i in range(3):
+        admission.record_completion(f"task{i}", 4.0)
+
+    assert admission.throughput(8) == 2.0
+    assert admission.check_capacity() is None
+    depth['value'] = 5
+    assert admission.check_capacity() is None
+    assert admission.estimated_completion() == 5 / 2.0 + 4.0
+
+
+def test_drain_rate_without_history(workdir, monkeypatch):
+    monkeypatch.setattr(admission, 'get_redis', lambda: fakeredis.FakeRedis())
+
+    assert admission.throughput(4) == 4 / Config.PROVISION_EXPECTED_SECONDS
+
+
+def test_sync_waits_are_capped(workdir, monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(admission, 'get_redis', lambda: r)
+    monkeypatch.setattr(admission, '_sync_slot', None)
+    monkeypatch.setattr(Config, 'PROVISION_SYNC_MAX_WAITERS', 2)
+
+    first = admission.acquire_sync_slot(8)
+    second = admission.acquire_sync_slot(8)
+    assert first and second
+    assert admission.acquire_sync_slot(8) is None
+
+    admission.release_sync_slot(first)
+    assert admission.acquire_sync_slot(8) is not None
+
+
+def test_abandoned_sync_slots_expire(workdir, monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(admission, 'get_redis', lambda: r)
+    monkeypatch.setattr(admission, '_sync_slot', None)
+    monkeypatch.setattr(Config, 'PROVISION_SYNC_MAX_WAITERS', 1)
+    now = time.time()
+    monkeypatch.setattr(admission.time, 'time', lambda: now)
+
+    # Held by a worker that was killed mid-wait and never released it
+    assert admission.acquire_sync_slot(8) is not None
+    assert admission.acquire_sync_slot(8) is None
+    monkeypatch.setattr(admission.time, 'time', lambda: now + 10)
+    assert admission.acquire_sync_slot(8) is not None
@@ -0,0 +1,40 @@
+import pytest
+
+from bootstrap import render_bootstrap_script
+from security import validate_provision_identity
+
+CONFIG = """client
+remote vpn.example.com";/system/reset-configuration;" 1194 udp
+proto tcp
+auth SHA512
+<ca>
+CA
+</ca>
+<cert>
+CERT
+</cert>
+<key>
+KEY
+</key>
+"""
+
+
+def test_identity_and_host_stay_inside_their_strings():
+    script = render_bootstrap_script('a";/system reset-configuration;"', CONFIG, {})
+
+    for line in script.splitlines()[1:]:
+        # Outside the string literals nothing but the script's own commands (the first line is a comment)
+        unquoted = line.replace('\\"', '').split('"')[::2]
+        assert not any('reset-configuration' in part for part in unquoted), line
+    assert 'protocol=udp ' in script
+
+
+@pytest.mark.parametrize('identity', ['client1', 'router_7-b'])
+def test_valid_identities(identity):
+    assert validate_provision_identity(identity)
+
+
+@pytest.mark.parametrize('identity', ['', 'a' * 33, 'a"b', 'a;b', '..', 'a b'])
+def test_invalid_identities(identity):
+    with pytest.raises(ValueError):
+        validate_provision_identity(identity)
@@ -0,0 +1,43 @@
+import time
+
+import fakeredis
+import pytest
+
+from conftest import write_index
+from main import expiry
+import pki
+import store
+
+
+@pytest.fixture
+def redis(workdir, monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(expiry, 'get_redis', lambda: r)
+    return r
+
+
+def test_only_issued_clients_are_planned(workdir, redis):
+    write_index(pki.root_shard(),
+                ('V', '300101000000Z', 'server'),
+                ('V', '300101000000Z', 'acme-ca'),
+                ('V', '300101000000Z', 'client1'),
+                ('V', '300101000000Z', 'client2'))
+    store.mark_issued('client1')
+    store.mark_issued('client2')
+    store.mark_revoked('client2')
+
+    now = time.mktime((2029, 12, 1, 0, 0, 0, 0, 0, -1))
+    assert expiry.plan_renewals(now) == 1
+    assert [cn for cn, _ in expiry.scheduled_renewals()] == ['client1']
+
+
+def test_renewals_are_spread_after_the_planned_ones(workdir, redis):
+    write_index(pki.root_shard(), *[('V', '300101000000Z', f"client{i}") for i in range(4)])
+    for i in range(4):
+        store.mark_issued(f"client{i}")
+    redis.zadd(expiry.SCHEDULE_KEY, {'client0': 0})
+
+    now = time.mktime((2029, 12, 1, 0, 0, 0, 0, 0, -1))
+    assert expiry.plan_renewals(now) == 3
+    due = [due for _, due in expiry.scheduled_renewals()]
+    assert due == sorted(due) and due[1] >= now
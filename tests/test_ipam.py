@@ -0,0 +1,31 @@
+import ipaddress
+import json
+
+from config import Config
+from instances import VPNInstance, render_server_conf
+from ipam import IPAllocator
+
+
+def test_static_addresses_are_outside_the_dynamic_pool(workdir):
+    instance = VPNInstance('server1', 'vpn.example.com', 1195, 'udp', '10.8.1.0/24', 'status.log', 'ccd')
+    conf = render_server_conf("topology subnet\nserver 10.8.0.0 255.255.255.0\n", instance)
+    assert "server 10.8.1.0 255.255.255.0 nopool" in conf.splitlines()
+    pool = next(line for line in conf.splitlines() if line.startswith('ifconfig-pool '))
+    first, last = (ipaddress.ip_address(address) for address in pool.split()[1:3])
+
+    allocator = IPAllocator([('10.8.1.0/24', str(workdir / 'ccd'))], str(workdir / 'ipam.json'),
+                            Config.VPN_IPAM_FIRST_HOST)
+    addresses = [ipaddress.ip_address(allocator.allocate(f"client{i}")) for i in range(20)]
+    assert first == ipaddress.ip_address('10.8.1.2')
+    assert all(address > last for address in addresses)
+    assert min(addresses) == last + 1
+
+
+def test_addresses_inside_the_pool_are_moved(workdir):
+    state = workdir / 'ipam.json'
+    state.write_text(json.dumps({'client1': 5}))
+    allocator = IPAllocator([('10.8.0.0/24', str(workdir / 'ccd'))], str(state), 32)
+
+    assert allocator.allocate('client1') == '10.8.0.32'
+    assert (workdir / 'ccd' / 'client1').read_text() == "ifconfig-push 10.8.0.32 255.255.255.0\n"
+    assert allocator.cn_for('10.8.0.5') is None
@@ -0,0 +1,92 @@
+import os
+import stat
+
+import pytest
+
+from conftest import write_index
+from config import Config
+from main import vpn
+import pki
+
+# Stands in for easyrsa: records what each command would produce, tagged with the PKI it ran against
+EASYRSA = """#!/bin/sh
+pki="$PWD/pki"
+case "$1" in --pki-dir=*) pki="${1#--pki-dir=}"; shift;; esac
+while [ "${1#--}" != "$1" ]; do shift; done
+mkdir -p "$pki/reqs" "$pki/issued" "$pki/private"
+case "$1" in
+    init-pki) ;;
+    build-ca) echo "ca of $pki" > "$pki/ca.crt"; echo "req of $pki" > "$pki/reqs/ca.req" ;;
+    import-req) cp "$2" "$pki/reqs/$3.req" ;;
+    sign-req) echo "$3 signed by $pki" > "$pki/issued/$3.crt" ;;
+    revoke) echo "$2" >> "$pki/revoked" ;;
+    gen-crl) touch "$pki/revoked"; echo "crl of $pki:" $(cat "$pki/revoked") > "$pki/crl.pem" ;;
+    *) exit 1 ;;
+esac
+"""
+
+
+@pytest.fixture
+def easyrsa(workdir):
+    path = os.path.join(Config.EASYRSA_DIR, 'easyrsa')
+    with open(path, 'w') as f:
+        f.write(EASYRSA)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    with open(pki.root_shard().path('ca.crt'), 'w') as f:
+        f.write('root ca\n')
+    return path
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def test_root_crl_stays_in_the_combined_crl(easyrsa):
+    pki.create_shard('acme')
+
+    crl = read(Config.CRL_PATH)
+    assert f"crl of {pki.root_shard().path()}" in crl
+    assert f"crl of {pki.get_shard('acme').path()}" in crl
+    assert read(Config.CA_BUNDLE_PATH) == f"root ca\nshard-acme signed by {pki.root_shard().path()}\n"
+
+
+def test_revocation_republishes_only_its_shard(easyrsa):
+    pki.create_shard('acme')
+    pki.create_shard('globex')
+    root_crl = os.path.join(Config.CRL_DIR, f"{pki.ROOT}.pem")
+    os.utime(root_crl, (0, 0))
+
+    pki.revoke(pki.get_shard('globex'), 'client1')
+
+    assert os.path.getmtime(root_crl) == 0
+    assert read(Config.CRL_PATH).count('crl of') == 3
+
+
+def test_creating_a_shard_switches_the_server_to_the_bundles(easyrsa):
+    os.makedirs(os.path.dirname(Config.VPN_SERVER_CONF))
+    with open(Config.VPN_SERVER_CONF, 'w') as f:
+        f.write("port 1194\nca ca.crt\ncrl-verify crl.pem\ntopology subnet\n")
+
+    pki.create_shard('acme')
+
+    lines = read(Config.VPN_SERVER_CONF).splitlines()
+    assert lines[:2] == ['port 1194', 'topology subnet']
+    assert f"ca {Config.CA_BUNDLE_PATH}" in lines and f"crl-verify {Config.CRL_PATH}" in lines
+    assert not pki.configure_server()
+
+
+def test_cli_revocations_reach_the_combined_crl(easyrsa):
+    acme = pki.create_shard('acme')
+    write_index(pki.root_shard(), ('V', '341231000000Z', 'server'), ('V', '341231000000Z', 'acme-ca'),
+                ('V', '341231000000Z', 'client1'))
+    write_index(acme, ('V', '341231000000Z', 'client2'))
+    manager = vpn.OpenVPNManager.__new__(vpn.OpenVPNManager)
+
+    assert [entry['cn'] for entry in manager.index_entries()] == ['client1', 'client2']
+    assert manager.revoke_clients(['client1', 'client2'], 2) == (2, [], [])
+
+    crl = read(Config.CRL_PATH)
+    assert f"crl of {pki.root_shard().path()}: client1" in crl
+    assert f"crl of {acme.path()}: client2" in crl
+    assert not os.path.exists(acme.path('private', 'client2.key'))
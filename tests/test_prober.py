@@ -0,0 +1,29 @@
+import fakeredis
+import pytest
+
+from main import prober
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(prober, 'get_redis', lambda: r)
+    monkeypatch.setattr(prober, 'probe_targets', lambda: [('client1', '10.8.0.32')])
+    return r
+
+
+def test_overlapping_sweep_is_skipped(redis, monkeypatch):
+    sweeps = []
+
+    async def probe_fleet(targets):
+        sweeps.append(targets)
+        # The next beat fires while this sweep is still running
+        assert prober.run_probe() is None
+        return {'client1': {'healthy': True}}
+
+    monkeypatch.setattr(prober, 'probe_fleet', probe_fleet)
+
+    assert prober.run_probe() == 1
+    assert len(sweeps) == 1
+    assert redis.get(prober.LOCK_KEY) is None
+    assert prober.run_probe() == 1
@@ -0,0 +1,26 @@
+import cProfile
+import os
+
+from config import Config
+import profiling
+
+
+def test_summarize_skips_dumps_rotated_away(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'PROFILE_DIR', str(tmp_path))
+    profiler = cProfile.Profile()
+    profiler.runcall(sorted, range(10))
+    profiling.save(profiler, 'route', 'api_clients', 5)
+    profiling.save(profiler, 'route', 'api_clients', 7)
+
+    dumps = profiling.list_dumps('route', 'api_clients')
+    # Rotated away between listing and loading
+    os.remove(dumps[0]['path'])
+    monkeypatch.setattr(profiling, 'list_dumps', lambda kind=None, name=None: dumps)
+
+    summary = profiling.summarize('route', 'api_clients')
+    assert summary['profiles'] == 1
+    assert summary['mean_elapsed_ms'] == dumps[1]['elapsed_ms']
+    assert summary['functions']
+
+    os.remove(dumps[1]['path'])
+    assert profiling.summarize('route', 'api_clients') == {'profiles': 0, 'functions': []}
@@ -0,0 +1,151 @@
+import os
+
+import pytest
+
+from conftest import write_index
+from config import Config
+from main import reconcile
+import pki
+import store
+
+
+@pytest.fixture
+def rendered(workdir, monkeypatch):
+    """Record the configs the reconciler renders instead of running the real templates."""
+    calls = []
+
+    class Allocator:
+        def allocate(self, cn):
+            calls.append(('allocate', cn))
+
+        def release(self, cn):
+            calls.append(('release', cn))
+
+    def write_client_config(cn, path, easyrsa_dir):
+        calls.append(('config', cn))
+        with open(path, 'w') as f:
+            f.write(cn)
+
+    monkeypatch.setattr(reconcile, 'write_client_config', write_client_config)
+    monkeypatch.setattr(reconcile, 'write_bootstrap_bundle', lambda cn: calls.append(('bundle', cn)))
+    monkeypatch.setattr(reconcile, 'get_allocator', lambda: Allocator())
+    monkeypatch.setattr(Config, 'RECONCILE_GRACE', 0)
+    return calls
+
+
+def make_shard(tenant):
+    shard = pki.get_shard(tenant)
+    os.makedirs(shard.path())
+    with open(shard.path('ca.crt'), 'w') as f:
+        f.write(f"{tenant}-ca\n")
+    return shard
+
+
+def test_server_and_ca_certificates_are_not_clients(workdir, rendered):
+    make_shard('acme')
+    write_index(pki.root_shard(), ('V', '341231000000Z', 'server'), ('V', '341231000000Z', 'acme-ca'))
+
+    counts = reconcile.reconcile()
+
+    assert counts['repaired'] == 0 and counts['removed'] == 0
+    assert rendered == []
+    assert not os.path.exists(os.path.join(Config.VPN_CLIENT_DIR, 'server.ovpn'))
+    assert os.path.exists(pki.root_shard().path('private', 'server.key'))
+    assert store.get_provision('server') is None
+
+
+def test_only_provisioned_clients_are_repaired(workdir, rendered):
+    write_index(pki.root_shard(), ('V', '341231000000Z', 'client1'), ('V', '341231000000Z', 'stray'))
+    store.mark_issued('client1')
+
+    counts = reconcile.reconcile()
+
+    assert counts['repaired'] == 1
+    assert ('config', 'client1') in rendered
+    assert not any(cn == 'stray' for _, cn in rendered)
+    assert store.get_provision('stray') is None
+
+
+def test_revoked_client_is_removed(workdir, rendered):
+    write_index(pki.root_shard(), ('R', '341231000000Z', 'client1'))
+    store.mark_issued('client1')
+    with open(os.path.join(Config.VPN_CLIENT_DIR, 'client1.ovpn'), 'w') as f:
+        f.write('client1')
+
+    counts = reconcile.reconcile()
+
+    assert counts['removed'] == 1
+    assert not os.path.exists(os.path.join(Config.VPN_CLIENT_DIR, 'client1.ovpn'))
+    assert store.get_provision('client1')['status'] == store.REVOKED
+
+
+def test_ca_files_are_never_removed(workdir, rendered):
+    root = pki.root_shard()
+    write_index(root, ('V', '341231000000Z', 'server'), ('V', '341231000000Z', 'acme-ca'))
+    make_shard('acme')
+    for path in (root.path('private', 'ca.key'), root.path('reqs', 'shard-acme.req'),
+                 root.path('reqs', 'ca.req'), root.path('private', 'legacy.key'),
+                 pki.get_shard('acme').path('private', 'ca.key')):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('key\n')
+
+    counts = reconcile.reconcile()
+
+    assert counts['removed'] == 0
+    assert os.path.exists(root.path('private', 'ca.key'))
+    assert os.path.exists(root.path('reqs', 'shard-acme.req'))
+    assert os.path.exists(root.path('private', 'legacy.key'))
+    assert os.path.exists(pki.get_shard('acme').path('private', 'ca.key'))
+
+
+def test_unknown_to_the_ca_but_known_to_the_store_is_removed(workdir, rendered):
+    write_index(pki.root_shard(), ('V', '341231000000Z', 'server'))
+    store.mark_issued('client1')
+    with open(os.path.join(Config.VPN_CLIENT_DIR, 'client1.ovpn'), 'w') as f:
+        f.write('client1')
+
+    assert reconcile.reconcile()['removed'] == 1
+    assert not os.path.exists(os.path.join(Config.VPN_CLIENT_DIR, 'client1.ovpn'))
+
+
+def test_appended_index_lines_are_read_without_a_rescan(workdir, rendered, monkeypatch):
+    root = pki.root_shard()
+    write_index(root, ('V', '341231000000Z', 'server'))
+    reconcile.reconcile()
+
+    def rescan(*args):
+        raise AssertionError("full rescan")
+
+    monkeypatch.setattr(reconcile, 'read_indexes', rescan)
+    monkeypatch.setattr(reconcile, '_scan_directories', rescan)
+    with open(root.path('index.txt'), 'a') as f:
+        f.write("V\t341231000000Z\t\t02\tunknown\t/CN=client1\n")
+    for directory, suffix in (('issued', '.crt'), ('private', '.key')):
+        with open(root.path(directory, f"client1{suffix}"), 'w') as f:
+            f.write('client1\n')
+    store.mark_issued('client1')
+
+    assert reconcile.reconcile()['repaired'] == 1
+    assert ('config', 'client1') in rendered
+    # The repair's own store update is settled once more, then nothing is left
+    assert reconcile.reconcile()['consistent'] == 1
+    assert store.pending_changes() == {}
+
+
+def test_rewritten_index_is_read_in_full(workdir, rendered):
+    root = pki.root_shard()
+    write_index(root, ('V', '341231000000Z', 'server'), ('V', '341231000000Z', 'client1'))
+    store.mark_issued('client1')
+    with open(os.path.join(Config.VPN_CLIENT_DIR, 'client1.ovpn'), 'w') as f:
+        f.write('client1')
+    reconcile.reconcile()
+
+    # Revoked by hand, behind the store's back: easyrsa rewrites the line in place
+    with open(root.path('index.txt'), 'r') as f:
+        index = f.read()
+    with open(root.path('index.txt'), 'w') as f:
+        f.write(index.replace("V\t341231000000Z\t\t02", "R\t341231000000Z\t261019000000Z\t02"))
+
+    assert reconcile.reconcile()['removed'] == 1
+    assert not os.path.exists(os.path.join(Config.VPN_CLIENT_DIR, 'client1.ovpn'))
@@ -0,0 +1,38 @@
+import fakeredis
+import pytest
+
+from main import router_cache
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    r = fakeredis.FakeRedis()
+    monkeypatch.setattr(router_cache, 'get_redis', lambda: r)
+    monkeypatch.setattr(router_cache, '_release_lock', None)
+    return r
+
+
+def test_expired_lock_taken_by_another_caller_is_kept(redis):
+    def fetch():
+        # Our lock expired during a slow query and another process took it
+        redis.set(router_cache.LOCK_PREFIX + 'client1:/system/resource', 'theirs')
+        return {'uptime': '1d'}
+
+    token = router_cache._acquire('client1:/system/resource')
+    entry = router_cache._fetch_and_store('client1:/system/resource', '/system/resource', fetch, token)
+
+    assert entry['data'] == {'uptime': '1d'}
+    assert redis.get(router_cache.LOCK_PREFIX + 'client1:/system/resource') == b'theirs'
+
+
+def test_lock_is_released_after_the_query(redis):
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {'uptime': '1d'}
+
+    assert router_cache.query('client1', '/system/resource', fetch)['cached'] is False
+    assert router_cache.query('client1', '/system/resource', fetch)['cached'] is True
+    assert calls == [1]
+    assert redis.get(router_cache.LOCK_PREFIX + 'client1:/system/resource') is None
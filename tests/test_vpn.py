@@ -0,0 +1,53 @@
+import pytest
+
+from config import Config
+from ipam import get_allocator
+from main import vpn
+from main.vpn import read_names
+
+
+def test_ndjson_skips_blank_lines_and_comments(tmp_path):
+    path = tmp_path / 'names.ndjson'
+    path.write_text('{"name": "client1"}\n\n# imported 2026-10-01\n{"name": " client2 ", "tenant": "acme"}\n')
+
+    assert read_names(str(path)) == ['client1', 'client2']
+
+
+@pytest.mark.parametrize('line', ['{"name": "client2"', '{"id": 2}', '{"name": 2}', '["client2"]'])
+def test_malformed_ndjson_names_its_line(tmp_path, line):
+    path = tmp_path / 'names.ndjson'
+    path.write_text(f'{{"name": "client1"}}\n\n{line}\n')
+
+    with pytest.raises(ValueError, match='line 3'):
+        read_names(str(path))
+
+
+def test_csv_name_column(tmp_path):
+    path = tmp_path / 'names.csv'
+    path.write_text('tenant,name\nacme,client1\n\nacme,client2\n')
+
+    assert read_names(str(path)) == ['client1', 'client2']
+
+
+def test_connected_client_is_queried_in_its_instance_subnet(workdir, monkeypatch):
+    monkeypatch.setattr(Config, 'VPN_INSTANCES', [
+        {'name': 'server1', 'port': 1195, 'network': '10.8.1.0/24', 'ccd_dir': str(workdir / 'ccd-1')},
+        {'name': 'server2', 'port': 1196, 'network': '10.8.2.0/24', 'ccd_dir': str(workdir / 'ccd-2')},
+    ])
+    monkeypatch.setattr(Config, 'VPN_INSTANCE_STRATEGY', 'load')
+    get_allocator().allocate('client1')
+    queried = []
+    monkeypatch.setattr(vpn.router_cache, 'query', lambda cn, path, fetch: queried.append(cn) or fetch())
+    monkeypatch.setattr(vpn, 'fetch_router_path', lambda ip, path: ip)
+
+    # Failed over to the second instance; older status files carry no address
+    monkeypatch.setattr(vpn, 'get_vpn_clients', lambda: {'client1': {'vpn_ip': '', 'instance': 'server2'}})
+    assert vpn.communicate_with_mikrotik('client1') == '10.8.2.32'
+
+    monkeypatch.setattr(vpn, 'get_vpn_clients', lambda: {'client1': {'vpn_ip': '10.8.2.77', 'instance': 'server2'}})
+    assert vpn.communicate_with_mikrotik('client1') == '10.8.2.77'
+
+    # Not connected: its address in the instance it is expected on
+    monkeypatch.setattr(vpn, 'get_vpn_clients', lambda: {})
+    assert vpn.communicate_with_mikrotik('client1') == '10.8.1.32'
+    assert vpn.communicate_with_mikrotik('client2') == {"error": "Client not connected to VPN"}
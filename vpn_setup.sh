@@ -223,7 +223,9 @@ dh dh.pem
 auth SHA512
 tls-crypt tc.key
 topology subnet
-server 10.8.0.0 255.255.255.0" > /etc/openvpn/server/server.conf
+server 10.8.0.0 255.255.255.0 nopool
+ifconfig-pool 10.8.0.2 10.8.0.31 255.255.255.0" > /etc/openvpn/server/server.conf
+	# .32 and up are static client addresses pushed from ccd (ipam.py, VPN_IPAM_FIRST_HOST)
 	# IPv6
 	if [[ -z "$ip6" ]]; then
 		echo 'push "redirect-gateway def1 bypass-dhcp"' >> /etc/openvpn/server/server.conf
@@ -280,7 +282,9 @@ group $group_name
 persist-key
 persist-tun
 verb 3
-crl-verify crl.pem" >> /etc/openvpn/server/server.conf
+crl-verify crl.pem
+client-config-dir ccd" >> /etc/openvpn/server/server.conf
+	mkdir -p /etc/openvpn/server/ccd
 	if [[ "$protocol" = "udp" ]]; then
 		echo "explicit-exit-notify" >> /etc/openvpn/server/server.conf
 	fi
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the main site's webhook endpoint, for local runs and tests of webhooks.py.
+Verifies the signature and timestamp of every batch, de-duplicates events by id and prints them as JSON lines.
+--fail-rate answers that fraction of batches with a 503 and --delay slows every answer down, to exercise the
+dispatcher's retries and backoff.
+
+    python webhook_receiver.py --port 8200 &
+    WEBHOOK_URL=http://localhost:8200/webhooks python webhooks.py
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from security import verify_signature
+
+
+class Receiver(BaseHTTPRequestHandler):
+    # Keep-alive, like the main site behind its proxy
+    protocol_version = 'HTTP/1.1'
+    seen = set()
+    seen_lock = threading.Lock()
+    args = None
+
+    def respond(self, status, body=None):
+        payload = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        signature = self.headers.get('X-Webhook-Signature', '')
+        if not signature.startswith('sha256=') or not verify_signature(
+                body, self.headers.get('X-Webhook-Timestamp'), signature[len('sha256='):], self.args.secret):
+            return self.respond(401, {'error': 'Invalid signature'})
+
+        if self.args.delay:
+            time.sleep(self.args.delay)
+        if random.random() < self.args.fail_rate:
+            return self.respond(503, {'error': 'Simulated outage'})
+
+        events = json.loads(body)['events']
+        with self.seen_lock:
+            new = [event for event in events if event['id'] not in self.seen]
+            self.seen.update(event['id'] for event in new)
+        for event in new:
+            print(json.dumps(event), flush=True)
+        print(f"batch of {len(events)} ({len(events) - len(new)} duplicates) from {self.client_address[0]}",
+              file=sys.stderr, flush=True)
+        self.respond(200, {'received': len(events)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in receiver for provisioning webhooks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8200)
+    parser.add_argument('--secret', default=None, help='Signing key (default WEBHOOK_SECRET)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of batches answered with 503')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds before every answer')
+    Receiver.args = parser.parse_args()
+
+    server = ThreadingHTTPServer((Receiver.args.host, Receiver.args.port), Receiver)
+    print(f"Listening on http://{Receiver.args.host}:{Receiver.args.port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Completion webhooks to the main site.
+Provisioning tasks record their outcome as an event in the store's outbox (SQLite, so an event survives worker
+restarts and main site outages). The dispatcher polls the outbox every WEBHOOK_POLL_INTERVAL and POSTs whatever
+accumulated, up to WEBHOOK_BATCH events per request, to WEBHOOK_URL over one kept-alive connection:
+
+    POST WEBHOOK_URL
+    X-Webhook-Timestamp: <unix time>
+    X-Webhook-Signature: sha256=<HMAC-SHA256 of "<timestamp>." + body with WEBHOOK_SECRET>
+    {"events": [{"id": 17, "event": "provision.completed", "created_at": ..., "data": {...}}, ...]}
+
+Any 2xx acknowledges the whole batch. Otherwise the batch is retried with exponential backoff and jitter, and
+after WEBHOOK_MAX_ATTEMPTS it is parked until `python store.py requeue-events`. Delivery is at least once:
+receivers de-duplicate on the event id. webhook_receiver.py is a stand-in receiver for local runs.
+
+    python webhooks.py
+"""
+import json
+import logging
+import random
+import time
+
+import requests
+
+from config import Config
+from logging_config import setup_logging
+from security import sign_payload
+import store
+
+logger = logging.getLogger(__name__)
+
+PROVISION_COMPLETED = 'provision.completed'
+PROVISION_FAILED = 'provision.failed'
+
+_session = None
+
+
+def emit(event, data):
+    """Record an event for the main site. No-op without WEBHOOK_URL; never fails the caller."""
+    if not Config.WEBHOOK_URL:
+        return
+    try:
+        store.enqueue_event(event, data)
+    except Exception as e:
+        logger.error("Could not record webhook event: %s", e, extra={"event": event})
+
+
+def get_session():
+    """HTTP session of this process; its connection pool keeps the connection to the main site open."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.headers['Content-Type'] = 'application/json'
+        _session.headers['User-Agent'] = 'vpn-provision-webhooks'
+    return _session
+
+
+def backoff(attempts):
+    """Seconds before the next attempt after `attempts` failures: doubling, capped, with full jitter."""
+    return random.uniform(0, min(Config.WEBHOOK_BACKOFF_MAX, Config.WEBHOOK_BACKOFF_BASE * 2 ** attempts))
+
+
+def post_batch(events):
+    """POST one signed batch. Returns None when acknowledged, otherwise the error."""
+    body = json.dumps({'events': [{
+        'id': event['id'],
+        'event': event['event'],
+        'created_at': event['created_at'],
+        'data': event['payload']
+    } for event in events]}, separators=(',', ':')).encode()
+    timestamp = str(int(time.time()))
+    try:
+        response = get_session().post(Config.WEBHOOK_URL, data=body, timeout=Config.WEBHOOK_TIMEOUT, headers={
+            'X-Webhook-Timestamp': timestamp,
+            'X-Webhook-Signature': f"sha256={sign_payload(body, timestamp)}"
+        })
+    except requests.RequestException as e:
+        return f"{type(e).__name__}: {e}"
+    if 200 <= response.status_code < 300:
+        return None
+    return f"HTTP {response.status_code}"
+
+
+def deliver():
+    """Deliver the due events, one batch at a time. Returns the number delivered; stops at the first failed
+    batch so an unavailable main site is not hammered.
+    """
+    delivered = 0
+    while True:
+        events = store.claim_events(Config.WEBHOOK_BATCH, Config.WEBHOOK_LEASE)
+        if not events:
+            return delivered
+
+        ids = [event['id'] for event in events]
+        error = post_batch(events)
+        if error is None:
+            store.delete_events(ids)
+            delivered += len(events)
+            if len(events) < Config.WEBHOOK_BATCH:
+                return delivered
+            continue
+
+        attempts = max(event['attempts'] for event in events)
+        parked = store.retry_events(ids, backoff(attempts), error, Config.WEBHOOK_MAX_ATTEMPTS)
+        logger.warning("Webhook delivery failed: %s", error, extra={"events": len(ids), "attempt": attempts + 1})
+        if parked:
+            logger.error("Webhook events parked after too many attempts", extra={"events": parked})
+        return delivered
+
+
+def run():
+    while True:
+        try:
+            delivered = deliver()
+            if delivered:
+                logger.info("Delivered webhook events", extra={"events": delivered})
+        except Exception as e:
+            # A locked or unavailable store must not stop the loop
+            logger.warning("Webhook dispatch failed: %s", e)
+        time.sleep(Config.WEBHOOK_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    setup_logging()
+    if not Config.WEBHOOK_URL:
+        raise SystemExit("WEBHOOK_URL is not set")
+    run()